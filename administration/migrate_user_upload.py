@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#
+# Move user-upload predictions, and their docking tasks, from the flat
+# layout '{identifier}' into the layout sharded by date
+# '{yyyy-mm-dd}/{identifier}'. The web-server resolves both layouts,
+# so this can run while prankweb is running. Predictions and docking
+# tasks that are not finished are skipped, as they are referenced by
+# queued tasks; run the script again later to move them.
+#
+# Predictions sharing results of another prediction, aliases, use
+# relative links. The links are updated right after the alias or the
+# prediction it points to is moved.
+#
+import argparse
+import json
+import logging
+import os
+import re
+import time
+import typing
+
+import prediction_index
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+IDENTIFIER_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2})-.+")
+
+FINISHED_STATUS = {"successful", "failed"}
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--database", required=True,
+        help="Path to user-upload prediction directory, "
+             "e.g. '/data/prankweb/predictions/v3-user-upload'.")
+    parser.add_argument(
+        "--docking",
+        help="Path to user-upload docking directory, "
+             "e.g. '/data/prankweb/docking/v3-user-upload'.")
+    parser.add_argument(
+        "--index",
+        help="Path to prediction index where locations of moved "
+             "predictions are updated, default is PRANKWEB_PREDICTION_INDEX.")
+    parser.add_argument(
+        "--delay", default=0.0, type=float,
+        help="Seconds to sleep after each moved prediction.")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Only print what would be moved.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    _init_logging()
+    logger.info("Collecting predictions in flat layout ...")
+    identifiers = list_flat_identifiers(arguments["database"])
+    logger.info(f"Found {len(identifiers)} predictions to move.")
+    aliases = find_aliases(arguments["database"])
+    index_path = arguments["index"] or prediction_index.get_index_path()
+    connection = None
+    if index_path is not None and not arguments["dry_run"]:
+        connection = prediction_index.connect(index_path)
+    moved_counter = 0
+    try:
+        for identifier in identifiers:
+            if migrate_prediction(
+                    arguments["database"], arguments["docking"], identifier,
+                    arguments["dry_run"], connection):
+                moved_counter += 1
+                if not arguments["dry_run"]:
+                    relink_moved(arguments["database"], identifier, aliases)
+                time.sleep(arguments["delay"])
+    finally:
+        if connection is not None:
+            connection.close()
+    logger.info(f"Moved {moved_counter} out of {len(identifiers)}.")
+    if not arguments["dry_run"]:
+        # Aliases created during the migration are not in the map.
+        logger.info("Updating links of predictions sharing results ...")
+        relink_aliases(arguments["database"])
+    logger.info("All done")
+
+
+def _init_logging():
+    formatter = logging.Formatter(
+        "%(asctime)s %(name)s [%(levelname)s] : %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S")
+
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(formatter)
+
+    logger.addHandler(handler)
+
+
+def list_flat_identifiers(predictions_directory: str) -> typing.List[str]:
+    return [
+        name
+        for name in os.listdir(predictions_directory)
+        if IDENTIFIER_PATTERN.fullmatch(name)
+    ]
+
+
+def sharded_directory(root: str, identifier: str) -> str:
+    return os.path.join(root, identifier[:10], identifier)
+
+
+def prediction_directory(root: str, identifier: str) -> str:
+    """Return directory of the prediction in the layout it is in."""
+    directory = sharded_directory(root, identifier)
+    if os.path.exists(directory):
+        return directory
+    return os.path.join(root, identifier)
+
+
+def list_prediction_directories(
+        predictions_directory: str) -> typing.List[str]:
+    """Return directories of predictions in both layouts."""
+    result = []
+    for name in os.listdir(predictions_directory):
+        directory = os.path.join(predictions_directory, name)
+        if IDENTIFIER_PATTERN.fullmatch(name):
+            result.append(directory)
+        elif re.fullmatch(r"\d{4}-\d{2}-\d{2}", name):
+            result.extend(
+                os.path.join(directory, identifier)
+                for identifier in os.listdir(directory))
+    return result
+
+
+def migrate_prediction(
+        predictions_directory: str,
+        docking_directory: typing.Optional[str],
+        identifier: str,
+        dry_run: bool,
+        connection=None) -> bool:
+    source = os.path.join(predictions_directory, identifier)
+    if not is_prediction_finished(source):
+        logger.info(f"Skipping unfinished prediction '{identifier}'.")
+        return False
+    docking_source = None
+    if docking_directory is not None:
+        docking_source = os.path.join(docking_directory, identifier)
+        if not os.path.exists(docking_source):
+            docking_source = None
+        elif not is_docking_finished(docking_source):
+            logger.info(f"Skipping '{identifier}' with unfinished docking.")
+            return False
+    if dry_run:
+        logger.info(f"Would move '{identifier}'.")
+        return True
+    # Move the prediction first, the docking executor can locate
+    # prediction in both layouts.
+    target = sharded_directory(predictions_directory, identifier)
+    move_directory(source, target)
+    if connection is not None:
+        # Databases are stored in directories of the same name.
+        database = os.path.basename(os.path.normpath(predictions_directory))
+        with connection:
+            prediction_index.update_directory(
+                connection, database, identifier, target)
+    if docking_source is not None:
+        move_directory(docking_source, sharded_directory(
+            docking_directory, identifier))
+    return True
+
+
+def is_prediction_finished(directory: str) -> bool:
+    info = load_json_or_none(os.path.join(directory, "info.json"))
+    return info is not None and info.get("status") in FINISHED_STATUS
+
+
+def is_docking_finished(directory: str) -> bool:
+    """State of a task is in the task directory, older registries keep
+    the states in a list in the info file."""
+    info = load_json_or_none(os.path.join(directory, "info.json"))
+    if info is None:
+        return False
+    tasks = info.get("tasks", [])
+    for task_id in range(info.get("taskCount", len(tasks))):
+        task = load_json_or_none(
+            os.path.join(directory, str(task_id), "info.json"))
+        if task is None and task_id < len(tasks):
+            task = tasks[task_id]
+        if task is None or task.get("status") not in FINISHED_STATUS:
+            return False
+    return True
+
+
+def load_json_or_none(path: str):
+    try:
+        with open(path, encoding="utf-8") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+
+def move_directory(source: str, target: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Rename is atomic, so the web-server sees the prediction in one of
+    # the layouts.
+    os.rename(source, target)
+
+
+def find_aliases(
+        predictions_directory: str) -> typing.Dict[str, typing.List[str]]:
+    """Return identifiers of aliases for every prediction with aliases."""
+    result = {}
+    for directory in list_prediction_directories(predictions_directory):
+        info = load_json_or_none(os.path.join(directory, "info.json"))
+        if info is None or "aliasOf" not in info.get("metadata", {}):
+            continue
+        result.setdefault(info["metadata"]["aliasOf"], []).append(
+            os.path.basename(directory))
+    return result
+
+
+def relink_moved(
+        predictions_directory: str, identifier: str,
+        aliases: typing.Dict[str, typing.List[str]]):
+    """Update links of moved prediction and of its aliases."""
+    for name in [identifier, *aliases.get(identifier, [])]:
+        relink_alias(predictions_directory,
+                     prediction_directory(predictions_directory, name))
+
+
+def relink_aliases(predictions_directory: str):
+    """Predictions sharing results use relative links, that may point
+    to the old location."""
+    for directory in list_prediction_directories(predictions_directory):
+        relink_alias(predictions_directory, directory)
+
+
+def relink_alias(predictions_directory: str, directory: str):
+    info = load_json_or_none(os.path.join(directory, "info.json"))
+    if info is None or "aliasOf" not in info.get("metadata", {}):
+        return
+    original = info["metadata"]["aliasOf"]
+    original_directory = prediction_directory(predictions_directory, original)
+    for name in ["public", "log"]:
+        link = os.path.join(directory, name)
+        if not os.path.islink(link) or os.path.exists(link):
+            continue
+        target = os.path.relpath(
+            os.path.join(original_directory, name), directory)
+        os.remove(link)
+        os.symlink(target, link)
+        logger.info(f"Updated link '{link}' to '{target}'.")
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
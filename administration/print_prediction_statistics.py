@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 #
 # For given prediction directory {code[2:3]}/{code} load all predictions
-# and print statistics.
+# and print statistics. With --index the statistics are computed from
+# the prediction index instead, see executor-p2rank/prediction_index.py .
 #
 import argparse
 import os
@@ -11,6 +12,8 @@ import json
 import dataclasses
 import collections
 
+import prediction_index
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -30,16 +33,27 @@ def _read_arguments() -> typing.Dict[str, str]:
     parser.add_argument(
         "--pocket-size", action="store_true",
         help="Also print information about pocket sizes.")
+    parser.add_argument(
+        "--index",
+        help="Path to prediction index, when set the index is used "
+             "instead of scanning the directories.")
     return vars(parser.parse_args())
 
 
 def main(arguments):
     _init_logging()
+    count_pockets = arguments["pocket_size"]
+    if arguments["index"] is not None:
+        logger.info("Loading predictions from index ...")
+        predictions = load_predictions_from_index(
+            arguments["index"], arguments["database"])
+        print_statistics(predictions, count_pockets)
+        logger.info("All done")
+        return
     logger.info("Collecting predictions ...")
     directories = collect_predictions_directories(arguments["database"])
     logger.info(f"Found {len(directories)} prediction directories")
     logger.info("Loading predictions ...")
-    count_pockets = arguments["pocket_size"]
     predictions = [load_prediction(directory, count_pockets)
                    for directory in directories]
     print_statistics(predictions, count_pockets)
@@ -82,6 +96,20 @@ def load_prediction(directory: str, load_pockets: bool) -> Prediction:
     return Prediction(info["id"], info["status"], predicted_site)
 
 
+def load_predictions_from_index(
+        index_path: str, database_directory: str) -> typing.List[Prediction]:
+    # Databases are stored in directories of the same name.
+    database = os.path.basename(os.path.normpath(database_directory))
+    connection = prediction_index.connect(index_path)
+    try:
+        return [
+            Prediction(item.identifier, item.status, item.pockets)
+            for item in prediction_index.query(connection, database)
+        ]
+    finally:
+        connection.close()
+
+
 def load_json(path: str):
     with open(path, "r", encoding="utf-8") as stream:
         return json.load(stream)
@@ -9,10 +9,21 @@ import logging
 import argparse
 import shutil
 import os
+import re
+
+import prediction_index
+from migrate_user_upload import sharded_directory
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Must be same as in web-server, see database_v3.py .
+CONTENT_INDEX_DIRECTORY = ".content-index"
+
+CONTENT_KEY_FILE = "content-key"
+
+USER_UPLOAD_SHARD_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
 
 def _read_arguments() -> typing.Dict[str, str]:
     parser = argparse.ArgumentParser()
@@ -31,12 +42,20 @@ def _read_arguments() -> typing.Dict[str, str]:
     parser.add_argument(
         "--user-upload", action="store_true",
         help="If set is used for flat directories like user-upload.")
+    parser.add_argument(
+        "--index",
+        help="Path to prediction index, when set the predictions are "
+             "selected using the index and removed from it.")
 
     return vars(parser.parse_args())
 
 
 def main(arguments):
     _init_logging()
+    if arguments["index"] is not None:
+        prune_using_index(arguments)
+        logger.info("All done")
+        return
     logger.info("Scanning jobs ...")
     predictions = list_prankweb_predictions(
         arguments["database"], arguments["user_upload"])
@@ -46,14 +65,21 @@ def main(arguments):
         if not os.path.exists(info_path):
             logger.info(f"Removing prediction '{code}' with no info.json file.")
             removed_counter += 1
-            shutil.rmtree(directory)
+            remove_prediction(arguments["database"], directory)
             continue
         with open(info_path) as stream:
             info = json.load(stream)
         if should_be_deleted(info, arguments):
             logger.info(f"Removing '{code}' in '{directory}'.")
             removed_counter += 1
-            shutil.rmtree(directory)
+            remove_prediction(arguments["database"], directory)
+    if arguments["user_upload"]:
+        # Predictions sharing results with removed predictions.
+        for (code, directory) in predictions:
+            if is_dangling_alias(directory):
+                logger.info(f"Removing alias '{code}' in '{directory}'.")
+                removed_counter += 1
+                remove_prediction(arguments["database"], directory)
     logger.info(f"Removed {removed_counter} out of {len(predictions)}.")
     logger.info("All done")
 
@@ -70,16 +96,67 @@ def _init_logging():
     logger.addHandler(handler)
 
 
+def prune_using_index(arguments):
+    # Databases are stored in directories of the same name.
+    database = os.path.basename(os.path.normpath(arguments["database"]))
+    statuses = [
+        status for status in ["queued", "running", "failed"]
+        if arguments[status]
+    ]
+    connection = prediction_index.connect(arguments["index"])
+    try:
+        predictions = prediction_index.query(connection, database, statuses)
+        removed_counter = 0
+        for prediction in predictions:
+            directory = resolve_prediction_directory(
+                arguments["database"], prediction)
+            if directory is None:
+                logger.warning(
+                    f"Missing directory for '{prediction.identifier}', "
+                    "use rebuild_prediction_index.py to update the index.")
+                continue
+            logger.info(f"Removing '{prediction.identifier}' "
+                        f"in '{directory}'.")
+            remove_prediction(arguments["database"], directory)
+            if os.path.exists(directory):
+                logger.warning(f"Can't remove '{directory}'.")
+                continue
+            removed_counter += 1
+            with connection:
+                prediction_index.remove(
+                    connection, database, prediction.identifier)
+        logger.info(
+            f"Removed {removed_counter} out of {len(predictions)} predictions.")
+    finally:
+        connection.close()
+
+
+def resolve_prediction_directory(
+        predictions_directory: str,
+        prediction: prediction_index.IndexedPrediction) \
+        -> typing.Optional[str]:
+    """The prediction may have been moved since it was indexed,
+    user uploads can be moved from flat layout to date shards."""
+    identifier = prediction.identifier
+    candidates = [
+        prediction.directory,
+        sharded_directory(predictions_directory, identifier),
+        os.path.join(predictions_directory, identifier),
+    ]
+    for candidate in candidates:
+        if os.path.isdir(candidate):
+            return candidate
+    return None
+
+
 def list_prankweb_predictions(
         predictions_directory: str, user_predictions: bool) \
         -> typing.List[typing.Tuple[str, str]]:
     if user_predictions:
         return [
-            (
-                code.lower(),
-                os.path.join(predictions_directory, code)
-            )
-            for code in os.listdir(predictions_directory)
+            (code.lower(), directory)
+            for code, directory in list_user_upload_predictions(
+                predictions_directory)
         ]
 
     return [
@@ -92,6 +169,51 @@ def list_prankweb_predictions(
     ]
 
 
+def list_user_upload_predictions(predictions_directory: str) \
+        -> typing.List[typing.Tuple[str, str]]:
+    """User uploads are sharded by date, older ones are stored directly
+    in the database directory."""
+    result = []
+    for name in os.listdir(predictions_directory):
+        # Ignore service directories, like the content index.
+        if name.startswith("."):
+            continue
+        path = os.path.join(predictions_directory, name)
+        if USER_UPLOAD_SHARD_PATTERN.fullmatch(name):
+            result.extend(
+                (code, os.path.join(path, code))
+                for code in os.listdir(path))
+        else:
+            result.append((name, path))
+    return result
+
+
+def remove_prediction(predictions_directory: str, directory: str):
+    """Remove prediction directory together with its content index entry."""
+    content_key_path = os.path.join(directory, CONTENT_KEY_FILE)
+    if os.path.exists(content_key_path):
+        with open(content_key_path, encoding="utf-8") as stream:
+            content_key = stream.read().strip()
+        index_path = os.path.join(
+            predictions_directory, CONTENT_INDEX_DIRECTORY,
+            content_key + ".json")
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as stream:
+                identifier = json.load(stream)["identifier"]
+            # The entry may already point to other prediction.
+            if identifier == os.path.basename(directory):
+                os.remove(index_path)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+
+def is_dangling_alias(directory: str) -> bool:
+    """True for prediction sharing results with a removed prediction."""
+    public_directory = os.path.join(directory, "public")
+    return os.path.islink(public_directory) \
+        and not os.path.exists(public_directory)
+
+
 def should_be_deleted(info, arguments):
     return (info["status"] == "running" and arguments["running"]) or \
            (info["status"] == "queued" and arguments["queued"]) or \
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# Reconcile the prediction index with the prediction directories.
+# Records are created or updated for all predictions on the disk,
+# records of predictions that no longer exist are removed.
+# This can run while prankweb is running.
+#
+import argparse
+import json
+import logging
+import os
+import re
+import typing
+
+import prediction_index
+from prune_prediction import list_prankweb_predictions
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DATABASE_PATTERN = re.compile(r"v\d+(-.+)?")
+
+# Number of directories loaded before a commit.
+BATCH_SIZE = 1000
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--predictions", required=True,
+        help="Path to directory with all databases, "
+             "e.g. '/data/prankweb/predictions'.")
+    parser.add_argument(
+        "--index",
+        help="Path to prediction index, "
+             "default is PRANKWEB_PREDICTION_INDEX.")
+    parser.add_argument(
+        "--statistics", action="store_true",
+        help="Also compute number of pockets and size of predictions.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    _init_logging()
+    index_path = arguments["index"] or prediction_index.get_index_path()
+    if index_path is None:
+        logger.error("Missing path to the prediction index.")
+        return
+    connection = prediction_index.connect(index_path)
+    try:
+        for database in list_databases(arguments["predictions"]):
+            logger.info(f"Reconciling database '{database}' ...")
+            reconcile_database(
+                connection, arguments["predictions"], database,
+                arguments["statistics"])
+    finally:
+        connection.close()
+    logger.info("All done")
+
+
+def _init_logging():
+    formatter = logging.Formatter(
+        "%(asctime)s %(name)s [%(levelname)s] : %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S")
+
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(formatter)
+
+    logger.addHandler(handler)
+
+
+def list_databases(predictions_directory: str) -> typing.List[str]:
+    return sorted(
+        name for name in os.listdir(predictions_directory)
+        if DATABASE_PATTERN.fullmatch(name)
+        and os.path.isdir(os.path.join(predictions_directory, name))
+    )
+
+
+def reconcile_database(
+        connection, predictions_directory: str, database: str,
+        statistics: bool):
+    database_directory = os.path.join(predictions_directory, database)
+    user_upload = database.endswith("user-upload")
+    directories = [
+        directory for _, directory in
+        list_prankweb_predictions(database_directory, user_upload)
+    ]
+    found = set()
+    for start in range(0, len(directories), BATCH_SIZE):
+        with connection:
+            for directory in directories[start:start + BATCH_SIZE]:
+                info = load_json_or_none(
+                    os.path.join(directory, "info.json"))
+                if info is None:
+                    continue
+                # Info files of older databases may miss some fields.
+                info.setdefault("database", database)
+                info.setdefault("id", os.path.basename(directory))
+                if "status" not in info:
+                    logger.warning(
+                        f"Skipping '{directory}' without status in info.")
+                    continue
+                found.add(info["id"])
+                if statistics:
+                    pockets, size = \
+                        prediction_index.collect_statistics(directory)
+                else:
+                    pockets, size = None, None
+                prediction_index.update(
+                    connection, directory, info, pockets, size)
+    removed = 0
+    with connection:
+        for prediction in prediction_index.query(connection, database):
+            if prediction.identifier in found:
+                continue
+            # The prediction could be created while we were scanning.
+            if os.path.exists(prediction.directory):
+                continue
+            prediction_index.remove(
+                connection, database, prediction.identifier)
+            removed += 1
+    logger.info(f"Indexed {len(found)} predictions, removed {removed}.")
+
+
+def load_json_or_none(path: str):
+    try:
+        with open(path, encoding="utf-8") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import celery.signals
+import cpu_slots
 import run_task
 
 prankweb = celery.Celery("prankweb")
@@ -27,6 +28,10 @@ elif "CELERY_BROKER_PATH" in os.environ:
     )
 
 
+# Every docking uses at least one CPU, so there is no use for more workers.
+prankweb.conf.worker_concurrency = cpu_slots.get_cpu_budget()
+
+
 # when uncommented, this will disable logging for Celery (including prints to stdout)
 @celery.signals.setup_logging.connect
 def setup_celery_logging(**kwargs):
@@ -38,9 +43,26 @@ def setup_celery_logging(**kwargs):
 prankweb.log.setup()
 
 
-@prankweb.task(name="docking")
-def celery_run_docking(directory: str, taskId):
+@prankweb.task(name="docking", bind=True, max_retries=None)
+def celery_run_docking(self, directory: str, taskId):
+    if not os.path.isdir(directory):
+        print(f"Given directory does not exist {directory}")
+        return
+    cpus = run_task.get_task_cpus(directory, taskId)
+    if self.request.retries < cpu_slots.MAX_DEFERRALS:
+        reservation = cpu_slots.try_reserve(cpus)
+        if reservation is None:
+            # Free the worker for dockings that fit the free CPUs.
+            raise self.retry(countdown=cpu_slots.DEFER_INTERVAL)
+    else:
+        reservation = cpu_slots.reserve(cpus)
+    with reservation:
+        run_task.execute_directory_task(directory, taskId, cpus)
+
+
+@prankweb.task(name="docking-batch")
+def celery_run_batch_docking(directory: str, taskId):
     if os.path.isdir(directory):
-        run_task.execute_directory_task(directory, taskId)
+        run_task.execute_batch_task(directory, taskId)
     else:
         print(f"Given directory does not exist {directory}")
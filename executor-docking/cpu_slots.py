@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# Host-local reservation of CPUs for docking.
+#
+# Every CPU of the budget is represented by a slot file, a docking holds
+# an exclusive lock on as many slots as it uses threads. Locks are shared
+# by all worker processes on the host and are released by the kernel when
+# a process dies, so a crashed docking never leaks its CPUs.
+#
+# Slots are collected under a gate lock. A large docking waiting for slots
+# holds the gate, so smaller dockings can not keep taking the slots it
+# waits for.
+#
+# Celery tasks first try to reserve the CPUs without waiting, see
+# try_reserve, and are deferred when the CPUs are not free. A worker thus
+# does not wait for CPUs while smaller dockings could run. Worker
+# concurrency is the budget, as every docking uses at least one CPU.
+#
+# Vina is limited to the reserved CPUs by a wrapper, see vina.sh and
+# limit_vina_threads.
+#
+import contextlib
+import fcntl
+import math
+import os
+import time
+import typing
+
+GATE_FILE = "gate.lock"
+
+# How long to wait before checking slots again, in seconds.
+POLL_INTERVAL = 0.5
+
+# How long to wait before a deferred task tries again, in seconds.
+DEFER_INTERVAL = 5
+
+# Number of times a task is deferred, then it waits for the CPUs
+# holding the gate, so it is not starved by smaller dockings.
+MAX_DEFERRALS = 12
+
+
+def get_cpu_budget() -> int:
+    """Return number of CPUs available for docking on this host."""
+    budget = os.environ.get("DOCKING_CPU_BUDGET", "")
+    if budget:
+        return max(1, int(budget))
+    return os.cpu_count() or 1
+
+
+def get_slots_directory() -> str:
+    return os.environ.get(
+        "DOCKING_CPU_SLOTS_DIRECTORY", "/tmp/prankweb-docking-cpu")
+
+
+def cpus_for_exhaustiveness(exhaustiveness: int) -> int:
+    """Return number of CPUs to use for a docking with given exhaustiveness.
+    Vina runs 'exhaustiveness' independent searches spread over the CPUs,
+    so there is no gain in using more CPUs than searches."""
+    per_cpu = max(1, int(os.environ.get(
+        "DOCKING_EXHAUSTIVENESS_PER_CPU", "4")))
+    cpus = math.ceil(int(exhaustiveness) / per_cpu)
+    return min(max(cpus, 1), get_cpu_budget())
+
+
+def limit_vina_threads(cpus: int):
+    """Make Vina started by this process use given number of threads.
+    Worker processes run one docking at a time, so the environment
+    is not shared by dockings."""
+    os.environ["DOCKING_VINA_CPU"] = str(cpus)
+
+
+class Reservation:
+    """CPUs held till the reservation is released."""
+
+    def __init__(self, slots: typing.List[typing.IO]):
+        self._slots = slots
+
+    def release(self):
+        for stream in self._slots:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+            stream.close()
+        self._slots = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def reserve(cpus: int) -> Reservation:
+    """Block until the given number of CPUs is available and hold them."""
+    directory = get_slots_directory()
+    os.makedirs(directory, exist_ok=True)
+    cpus = min(max(cpus, 1), get_cpu_budget())
+    with _locked(os.path.join(directory, GATE_FILE)):
+        return Reservation(_acquire_slots(directory, cpus))
+
+
+def try_reserve(cpus: int) -> typing.Optional[Reservation]:
+    """Hold the given number of CPUs, return None if they are not free
+    or a docking is waiting for CPUs."""
+    directory = get_slots_directory()
+    os.makedirs(directory, exist_ok=True)
+    cpus = min(max(cpus, 1), get_cpu_budget())
+    with _locked(os.path.join(directory, GATE_FILE), False) as locked:
+        if not locked:
+            return None
+        slots = _acquire_free_slots(directory, cpus)
+    if len(slots) < cpus:
+        Reservation(slots).release()
+        return None
+    return Reservation(slots)
+
+
+def _acquire_slots(directory: str, cpus: int) -> typing.List[typing.IO]:
+    result = []
+    try:
+        while True:
+            result.extend(_acquire_free_slots(directory, cpus - len(result)))
+            if len(result) == cpus:
+                return result
+            time.sleep(POLL_INTERVAL)
+    except BaseException:
+        for stream in result:
+            stream.close()
+        raise
+
+
+def _acquire_free_slots(directory: str, cpus: int) -> typing.List[typing.IO]:
+    """Lock up to given number of free slots, slots locked by this process
+    are not free."""
+    result = []
+    for index in range(get_cpu_budget()):
+        if len(result) == cpus:
+            break
+        stream = open(os.path.join(directory, f"slot-{index}"), "a")
+        try:
+            fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            stream.close()
+            continue
+        result.append(stream)
+    return result
+
+
+@contextlib.contextmanager
+def _locked(path: str, blocking: bool = True):
+    """Hold exclusive lock on the file, without blocking yield false
+    when the lock is held by someone else."""
+    with open(path, "a") as stream:
+        try:
+            fcntl.flock(
+                stream, fcntl.LOCK_EX if blocking
+                else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# Cache of docking results shared by all predictions.
+#
+# The same structure is often available in multiple databases, e.g. 'v3'
+# and 'v3-conservation-hmm', so the same docking can be requested more
+# than once. The results are stored under a key computed from the content
+# of the structure, preparation of the receptor, canonical SMILES of
+# the ligand and docking parameters.
+#
+# The cache is used only when DOCKING_CACHE_DIRECTORY is set.
+#
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import typing
+
+# Change when the docking changes, so old results are not used.
+CACHE_VERSION = "2"
+
+# Number of decimal places used for bounding box, in Angstroms.
+BOX_PRECISION = 2
+
+# Files of a task that are specific to the task and are not cached.
+TASK_FILES = ["result.json"]
+
+
+def get_cache_directory() -> typing.Optional[str]:
+    return os.environ.get("DOCKING_CACHE_DIRECTORY", None)
+
+
+def cache_key(
+        structure_digest: str, preparation: str, input_json: dict) -> str:
+    """Return key for a docking of given structure with given input,
+    the digest is SHA-256 of the decompressed structure. The preparation
+    is how the receptor was prepared, see receptor.py."""
+    content = {
+        "version": CACHE_VERSION,
+        "structure": structure_digest,
+        "preparation": preparation,
+        "ligand": canonical_smiles(input_json["smiles"]),
+        "box": _round_numbers(input_json["bounding_box"]),
+        "exhaustiveness": int(input_json["exhaustiveness"]),
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def canonical_smiles(smiles: str) -> str:
+    """Return canonical SMILES, so the same ligand written in a different
+    way shares the results. Fall back to the given SMILES."""
+    smiles = smiles.strip()
+    try:
+        result = subprocess.run(
+            ["obabel", "-:" + smiles, "-ocan"],
+            capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return smiles
+    # Output is 'SMILES\tTITLE' followed by a new line.
+    lines = result.stdout.strip().split("\n")
+    if result.returncode != 0 or not lines[0]:
+        return smiles
+    return lines[0].split("\t")[0].strip()
+
+
+def _round_numbers(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return round(float(value), BOX_PRECISION)
+    if isinstance(value, str):
+        try:
+            return round(float(value), BOX_PRECISION)
+        except ValueError:
+            return value
+    if isinstance(value, list):
+        return [_round_numbers(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _round_numbers(item) for key, item in value.items()}
+    return value
+
+
+def _entry_directory(cache_directory: str, key: str) -> str:
+    return os.path.join(cache_directory, key[:2], key)
+
+
+def restore(key: str, public_directory: str) -> bool:
+    """Put cached results into the public directory, return true on hit."""
+    cache_directory = get_cache_directory()
+    if cache_directory is None:
+        return False
+    entry = _entry_directory(cache_directory, key)
+    if not os.path.isdir(entry):
+        return False
+    os.makedirs(public_directory, exist_ok=True)
+    for file_name in os.listdir(entry):
+        source = os.path.join(entry, file_name)
+        target = os.path.join(public_directory, file_name)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            # Results are never modified, so we can share the files.
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+    return True
+
+
+def store(key: str, public_directory: str):
+    """Store results from the public directory into the cache."""
+    cache_directory = get_cache_directory()
+    if cache_directory is None:
+        return
+    entry = _entry_directory(cache_directory, key)
+    if os.path.exists(entry):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    # Prepare the entry aside and rename it, so an entry is always complete.
+    working_directory = tempfile.mkdtemp(
+        dir=os.path.dirname(entry), prefix=key, suffix=".swp")
+    try:
+        for file_name in os.listdir(public_directory):
+            source = os.path.join(public_directory, file_name)
+            if file_name in TASK_FILES or not os.path.isfile(source):
+                continue
+            shutil.copyfile(source, os.path.join(working_directory, file_name))
+        os.rename(working_directory, entry)
+    except OSError:
+        # Other worker stored the same entry.
+        shutil.rmtree(working_directory, ignore_errors=True)
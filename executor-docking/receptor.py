@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Receptor shared by all docking tasks of one prediction.
+#
+# The structure is decompressed and prepared for docking only once,
+# under a lock, in the 'receptor' directory next to the task directories.
+# The digest file is written last, so its presence marks a complete
+# receptor.
+#
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import typing
+
+RECEPTOR_DIRECTORY = "receptor"
+
+LOCK_FILE = "receptor.lock"
+
+DIGEST_FILE = "structure.sha256"
+
+PREPARED_RECEPTOR_FILE = "receptor.pdbqt"
+
+
+class Receptor(typing.NamedTuple):
+    # Decompressed structure.
+    structure_file: str
+    # SHA-256 of the decompressed structure.
+    structure_digest: str
+    # Receptor prepared for Vina, None if the preparation failed.
+    prepared_file: typing.Optional[str]
+
+    def preparation(self) -> str:
+        """Return how the receptor for docking was prepared."""
+        if self.prepared_file is not None:
+            return "prepare_receptor4"
+        return "none"
+
+    def docking_receptor(self) -> str:
+        """Return the receptor file to use for docking."""
+        if self.prepared_file is not None:
+            return self.prepared_file
+        return self.structure_file
+
+
+def get_receptor(docking_directory: str, structure_file_gzip: str) -> Receptor:
+    """Return receptor for the prediction, prepare it if needed."""
+    directory = os.path.join(docking_directory, RECEPTOR_DIRECTORY)
+    receptor = _load_receptor(directory)
+    if receptor is not None:
+        return receptor
+    with _lock(os.path.join(docking_directory, LOCK_FILE)):
+        # Other task could have prepared it while we waited.
+        receptor = _load_receptor(directory)
+        if receptor is not None:
+            return receptor
+        return _prepare_receptor(directory, structure_file_gzip)
+
+
+def _load_receptor(directory: str) -> typing.Optional[Receptor]:
+    try:
+        with open(os.path.join(directory, DIGEST_FILE)) as stream:
+            digest = stream.read().strip()
+    except OSError:
+        return None
+    structure_file = None
+    for file_name in os.listdir(directory):
+        if file_name.startswith("structure.") and file_name != DIGEST_FILE:
+            structure_file = os.path.join(directory, file_name)
+    if structure_file is None:
+        return None
+    prepared_file = os.path.join(directory, PREPARED_RECEPTOR_FILE)
+    if not os.path.exists(prepared_file):
+        prepared_file = None
+    return Receptor(structure_file, digest, prepared_file)
+
+
+def _prepare_receptor(directory: str, structure_file_gzip: str) -> Receptor:
+    # Remove leftovers of a failed preparation.
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    # For 'structure.cif.gz' we get 'cif'.
+    extension = structure_file_gzip.split(".")[-2]
+    structure_file = os.path.join(directory, "structure." + extension)
+    digest = hashlib.sha256()
+    with gzip.open(structure_file_gzip, "rb") as input_stream, \
+            open(structure_file, "wb") as output_stream:
+        while chunk := input_stream.read(1024 * 1024):
+            digest.update(chunk)
+            output_stream.write(chunk)
+    prepared_file = os.path.join(directory, PREPARED_RECEPTOR_FILE)
+    if not _prepare_pdbqt(structure_file, prepared_file):
+        prepared_file = None
+    with open(os.path.join(directory, DIGEST_FILE), "w") as stream:
+        stream.write(digest.hexdigest())
+    return Receptor(structure_file, digest.hexdigest(), prepared_file)
+
+
+def _prepare_pdbqt(structure_file: str, output_file: str) -> bool:
+    """Prepare receptor using MGLTools, return true on success."""
+    script = shutil.which("prepare_receptor4.py")
+    if script is None:
+        return False
+    try:
+        result = subprocess.run(
+            ["python2.7", script, "-r", structure_file, "-o", output_file],
+            cwd=os.path.dirname(output_file),
+            capture_output=True, text=True, timeout=600)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Can't prepare receptor {structure_file}: {repr(e)}")
+        return False
+    if result.returncode != 0 or not os.path.exists(output_file):
+        print(f"Can't prepare receptor {structure_file}:\n{result.stderr}")
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def _lock(path: str):
+    with open(path, "a") as stream:
+        fcntl.flock(stream, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
@@ -7,12 +7,16 @@ import sys
 import datetime
 import enum
 import json
-import time
+import tempfile
 import glob
-import gzip
 import shutil
+import subprocess
+import concurrent.futures
 
 from run_docking import run_docking
+import docking_cache
+import receptor
+import cpu_slots
 
 class Status(enum.Enum):
     """
@@ -32,22 +36,48 @@ def _load_json(path: str):
     with open(path, encoding="utf-8") as stream:
         return json.load(stream)
 
-def _save_status_file(path: str, status: any, taskId: int):
+def _load_json_or_none(path: str):
     """
-    Method to save the status file. It will update the lastChange field with the current time.
+    Method to load a json file, returns None if the file does not exist or is not valid.
+    """
+    try:
+        return _load_json(path)
+    except (OSError, ValueError):
+        return None
+
+def _task_status_file(docking_directory: str, taskId: int) -> str:
+    """
+    Method to get the path to the status file of a task, see web-server/src/docking_registry.py.
+    """
+    return os.path.join(docking_directory, str(taskId), "info.json")
+
+def _load_task_status(docking_directory: str, taskId: int):
+    """
+    Method to load the status of a task. Older registries keep statuses of all tasks in a shared info.json file.
+    """
+    status = _load_json_or_none(_task_status_file(docking_directory, taskId))
+    if status is not None:
+        return status
+    registry = _load_json(os.path.join(docking_directory, "info.json"))
+    return registry["tasks"][taskId]
+
+def _save_task_status(docking_directory: str, taskId: int, status: any, value: Status):
+    """
+    Method to save the status of a task. It will update the status and lastChange fields.
+    Only the task file is written, so tasks of the same prediction do not overwrite each other.
     """
     now = datetime.datetime.today()
-    status["tasks"][taskId]["lastChange"] = now.strftime('%Y-%m-%dT%H:%M:%S')
-    _save_json(path, status)
+    status["status"] = value.value
+    status["lastChange"] = now.strftime('%Y-%m-%dT%H:%M:%S')
+    _save_json(_task_status_file(docking_directory, taskId), status)
 
 def _save_json(path: str, content: any):
     """
     Method to save a json file to a given path.
     """
-    path_swp = path + ".swp"
-    if(os.path.exists(path_swp)):
-        time.sleep(1)
-    with open(path_swp, "w", encoding="utf-8") as stream:
+    #unique swap file, so concurrent writers do not need to wait for each other
+    descriptor, path_swp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path), suffix=".swp")
+    with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
         json.dump(content, stream, ensure_ascii=True)
     os.replace(path_swp, path)
 
@@ -56,7 +86,21 @@ def get_prediction_directory(docking_directory: str):
     Method to get the path to the prediction directory from the docking directory.
     """
     #currently assuming that the docking and predictions paths are different just by the name
-    return str.replace(docking_directory, "docking", "predictions")
+    result = str.replace(docking_directory, "docking", "predictions")
+    if os.path.exists(result):
+        return result
+    #user uploads can be stored flat or sharded by date, the two trees may be in a different layout during migration
+    identifier = os.path.basename(result)
+    parent = os.path.dirname(result)
+    if os.path.basename(parent) == identifier[:10]:
+        legacy = os.path.join(os.path.dirname(parent), identifier)
+        if os.path.exists(legacy):
+            return legacy
+    else:
+        sharded = os.path.join(parent, identifier[:10], identifier)
+        if os.path.exists(sharded):
+            return sharded
+    return result
 
 def get_prediction_path(docking_directory: str):
     """
@@ -65,15 +109,12 @@ def get_prediction_path(docking_directory: str):
     #currently assuming that the docking and predictions paths are different just by the name
     return os.path.join(get_prediction_directory(docking_directory), "public", "prediction.json")
 
-def prepare_docking(input_file: str, structure_file_gzip: str, task_directory: str):
-    # unzip the pdb/mmCIF file
-    extension = structure_file_gzip.split(".")[-2]
-    structureFile = os.path.join(task_directory, ("structure." + extension))
-
-    with gzip.open(structure_file_gzip, 'rb') as f_in:
-        with open(structureFile, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    
+def prepare_docking(input_file: str, receptor_file: str, task_directory: str, cpu: int):
+    """
+    Method to prepare the ligand and docking parameters for a task.
+    The receptor is shared by all tasks of the prediction, see receptor.py.
+    The cpu is the number of threads the docking may use, see cpu_slots.py.
+    """
     # create a smiles file from the ligand
     ligandFile = os.path.join(task_directory, "ligand.smi")
     with open(input_file) as inp, open(ligandFile, "w") as f:
@@ -86,18 +127,60 @@ def prepare_docking(input_file: str, structure_file_gzip: str, task_directory: s
         input_json = json.load(inp)
         out_json = {}
 
-        out_json["receptor"] = structureFile
+        out_json["receptor"] = receptor_file
         out_json["ligand"] = ligandFile
         out_json["output"] = os.path.join(task_directory, "public", "out_vina.pdbqt")
         out_json["center"] = input_json["bounding_box"]["center"]
         out_json["size"] = input_json["bounding_box"]["size"]
         out_json["exhaustiveness"] = input_json["exhaustiveness"]
+        out_json["cpu"] = cpu
 
         json.dump(out_json, out)
 
-def execute_directory_task(docking_directory: str, taskId: int):
+def _find_structure_file(docking_directory: str) -> str:
+    """
+    Method to find the gz file with the structure, returns an empty string if there is none.
+    """
+    for file_path in glob.glob(os.path.join(get_prediction_directory(docking_directory), "public") + "/*.gz"):
+        return file_path
+    return ""
+
+def _result_url_prefix(docking_directory: str, status: any) -> str:
+    """
+    Method to get the URL of the public directory of a task.
+    API is /docking/<database_name>/<prediction_name>/<hash>/public/<file_name>
+    """
+    #split docking_directory to get database_name
+    database_name = docking_directory.split("/")[4]
+    # The directory layout differs between databases, so we use the identifier.
+    prediction_name = _load_json(os.path.join(docking_directory, "info.json"))["identifier"]
+    return "./api/v2/docking/" + database_name + "/" + prediction_name + "/" + status["initialData"]["hash"] + "/public/"
+
+def _save_result_file(result_file: str, result: list):
+    """
+    Method to save the list of results of a task.
+    """
+    #save the result file (this directory should already exist, though...)
+    os.makedirs(os.path.dirname(result_file), exist_ok=True)
+    with open(result_file, "w", encoding="utf-8") as stream:
+        try:
+            stream.write(json.dumps(result))
+        finally:
+            stream.flush()
+
+def get_task_cpus(docking_directory: str, taskId: int) -> int:
+    """
+    Method to get the number of CPUs to reserve for a task, see cpu_slots.py.
+    """
+    input_json = _load_json_or_none(os.path.join(docking_directory, str(taskId), "input.json"))
+    if input_json is None:
+        return 1
+    return cpu_slots.cpus_for_exhaustiveness(input_json["exhaustiveness"])
+
+def execute_directory_task(docking_directory: str, taskId: int, cpu: int):
     """
     Method to execute a task for a given directory and a given taskId.
+    The caller holds reservation of the given number of CPUs, see get_task_cpus.
     """
 
     result_file = os.path.join(docking_directory, str(taskId), "public", "result.json")
@@ -108,72 +191,186 @@ def execute_directory_task(docking_directory: str, taskId: int):
         return
     
     #first update the status file
-    status_file = os.path.join(docking_directory, "info.json")
-    status = _load_json(status_file)
-
-    status["tasks"][taskId]["status"] = Status.RUNNING.value
-    _save_status_file(status_file, status, taskId)
+    status = _load_task_status(docking_directory, taskId)
+    _save_task_status(docking_directory, taskId, status, Status.RUNNING)
 
     #do the actual work here!
     #first, look for the gz file with the structure
-    structure_file = ""
-    for file_path in glob.glob(os.path.join(get_prediction_directory(docking_directory), "public") + "/*.gz"):
-        structure_file = file_path
-        break
+    structure_file = _find_structure_file(docking_directory)
 
     if structure_file == "":
         #no structure file found, we cannot do anything
         #this should not happen because the structure has to be downloadable for the prediction...
-        status["tasks"][taskId]["status"] = Status.FAILED.value
-        _save_status_file(status_file, status, taskId)
+        _save_task_status(docking_directory, taskId, status, Status.FAILED)
         return
     
-    #try to dock the molecule
+    task_directory = os.path.join(docking_directory, str(taskId))
+    public_directory = os.path.join(task_directory, "public")
+    input_file = os.path.join(task_directory, "input.json")
+
+    #decompress and prepare the structure only once for all tasks of the prediction
     try:
-        prepare_docking(os.path.join(docking_directory, str(taskId), "input.json"), structure_file, os.path.join(docking_directory, str(taskId)))
-        run_docking(os.path.join(docking_directory, str(taskId), "docking_parameters.json"), os.path.join(docking_directory, str(taskId)), os.path.join(docking_directory, str(taskId)), "public")
+        prepared_receptor = receptor.get_receptor(docking_directory, structure_file)
     except Exception as e:
         print(repr(e))
-        print(str(e))
-        #something went wrong during the docking
-        #TODO: add some more error handling here, provide a log?
-        status["tasks"][taskId]["status"] = Status.FAILED.value
-        _save_status_file(status_file, status, taskId)
+        _save_task_status(docking_directory, taskId, status, Status.FAILED)
         return
 
-    #parse the prediction file and do some calculations - in this case just counting the number of residues per pocket
-    #API is /docking/<database_name>/<prediction_name>/<hash>/public/<file_name>
-    #split docking_directory to get database_name and prediction_name
-    result = []
-    database_name = docking_directory.split("/")[4]
-    if "user-upload" in database_name:
-        prediction_name = docking_directory.split("/")[5]
+    #the same docking may have been computed for another prediction with the same structure
+    cache_key = None
+    if docking_cache.get_cache_directory() is not None:
+        cache_key = docking_cache.cache_key(prepared_receptor.structure_digest, prepared_receptor.preparation(), _load_json(input_file))
+
+    if cache_key is not None and docking_cache.restore(cache_key, public_directory):
+        print(f"Using cached results for task {taskId} in {docking_directory}")
     else:
-        prediction_name = docking_directory.split("/")[6]
+        #try to dock the molecule
+        try:
+            prepare_docking(input_file, prepared_receptor.docking_receptor(), task_directory, cpu)
+            cpu_slots.limit_vina_threads(cpu)
+            run_docking(os.path.join(task_directory, "docking_parameters.json"), task_directory, task_directory, "public")
+        except Exception as e:
+            print(repr(e))
+            print(str(e))
+            #something went wrong during the docking
+            #TODO: add some more error handling here, provide a log?
+            _save_task_status(docking_directory, taskId, status, Status.FAILED)
+            return
+        if cache_key is not None:
+            docking_cache.store(cache_key, public_directory)
 
-    result_url = "./api/v2/docking/" + database_name + "/" + prediction_name + "/" + status["tasks"][taskId]["initialData"]["hash"] + "/public/results.zip"
-    result.append({
+    result_url = _result_url_prefix(docking_directory, status) + "results.zip"
+    _save_result_file(result_file, [{
         "url": result_url
-    })
-    result_json = json.dumps(result)
+    }])
 
-    #save the result file (this directory should already exist, though...)
-    os.makedirs(os.path.join(docking_directory, str(taskId), "public"), exist_ok=True)
+    _save_task_status(docking_directory, taskId, status, Status.SUCCESSFUL)
 
-    with open(result_file, "w", encoding="utf-8") as stream:
-        try:
-            stream.write(result_json)
-        finally:
-            stream.flush()
-    
-    #update the status file, reload it first to make sure we don't overwrite any changes
-    status = _load_json(status_file)
-    
-    status["tasks"][taskId]["status"] = Status.SUCCESSFUL.value
-    _save_status_file(status_file, status, taskId)
+def _batch_parallelism() -> int:
+    """
+    Method to get the number of ligands of a batch task docked at the same time.
+    """
+    return max(1, int(os.environ.get("DOCKING_BATCH_PARALLELISM", "4")))
+
+def _dock_batch_ligand(ligand_directory: str, receptor_file: str, cache_key: str, cpu: int) -> bool:
+    """
+    Method to dock one ligand of a batch task, returns true on success.
+    The docking runs in a separate process, see main, as Celery worker processes can not have children of their own.
+    The CPUs are reserved here, so the batch shares the CPU budget with other tasks.
+    """
+    public_directory = os.path.join(ligand_directory, "public")
+    if cache_key is not None and docking_cache.restore(cache_key, public_directory):
+        print(f"Using cached results for {ligand_directory}")
+        return True
+    with cpu_slots.reserve(cpu):
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "dock", ligand_directory, receptor_file, str(cpu)])
+    if completed.returncode != 0:
+        return False
+    if cache_key is not None:
+        docking_cache.store(cache_key, public_directory)
+    return True
+
+def execute_batch_task(docking_directory: str, taskId: int):
+    """
+    Method to execute a batch task, i.e. dock a list of ligands into one pocket.
+    Ligands are docked in parallel, the progress is written to the task status as they finish.
+    """
+    task_directory = os.path.join(docking_directory, str(taskId))
+    public_directory = os.path.join(task_directory, "public")
+    result_file = os.path.join(public_directory, "result.json")
+
+    #check if the directory exists - if not, we did not ask for this task
+    #check if the result file exists - if it does, we already calculated it
+    if not os.path.isdir(docking_directory) or os.path.exists(result_file):
+        return
+
+    status = _load_task_status(docking_directory, taskId)
+    _save_task_status(docking_directory, taskId, status, Status.RUNNING)
+
+    structure_file = _find_structure_file(docking_directory)
+    if structure_file == "":
+        _save_task_status(docking_directory, taskId, status, Status.FAILED)
+        return
+
+    try:
+        prepared_receptor = receptor.get_receptor(docking_directory, structure_file)
+    except Exception as e:
+        print(repr(e))
+        _save_task_status(docking_directory, taskId, status, Status.FAILED)
+        return
+
+    task_input = _load_json(os.path.join(task_directory, "input.json"))
+    url_prefix = _result_url_prefix(docking_directory, status)
+    ligands = task_input["ligands"]
+    status["progress"] = {"total": len(ligands), "successful": 0, "failed": 0}
+    status["ligands"] = [{"smiles": smiles, "status": Status.QUEUED.value} for smiles in ligands]
+
+    os.makedirs(public_directory, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_batch_parallelism()) as executor:
+        futures = {}
+        for index, smiles in enumerate(ligands):
+            #every ligand has its own directory, so it looks like a regular task to the docking
+            ligand_directory = os.path.join(task_directory, "ligands", str(index))
+            os.makedirs(ligand_directory, exist_ok=True)
+            ligand_input = {
+                "smiles": smiles,
+                "bounding_box": task_input["bounding_box"],
+                "exhaustiveness": task_input["exhaustiveness"],
+            }
+            _save_json(os.path.join(ligand_directory, "input.json"), ligand_input)
+            cache_key = None
+            if docking_cache.get_cache_directory() is not None:
+                cache_key = docking_cache.cache_key(prepared_receptor.structure_digest, prepared_receptor.preparation(), ligand_input)
+            cpu = cpu_slots.cpus_for_exhaustiveness(task_input["exhaustiveness"])
+            future = executor.submit(_dock_batch_ligand, ligand_directory, prepared_receptor.docking_receptor(), cache_key, cpu)
+            futures[future] = (index, ligand_directory)
+
+        #only this thread writes the status, so there is no need for locking
+        for future in concurrent.futures.as_completed(futures):
+            index, ligand_directory = futures[future]
+            ligand_status = status["ligands"][index]
+            try:
+                successful = future.result()
+            except Exception as e:
+                print(repr(e))
+                successful = False
+            if successful:
+                file_name = f"results-{index}.zip"
+                shutil.copyfile(os.path.join(ligand_directory, "public", "results.zip"), os.path.join(public_directory, file_name))
+                ligand_status["status"] = Status.SUCCESSFUL.value
+                ligand_status["url"] = url_prefix + file_name
+                status["progress"]["successful"] += 1
+            else:
+                ligand_status["status"] = Status.FAILED.value
+                status["progress"]["failed"] += 1
+            _save_task_status(docking_directory, taskId, status, Status.RUNNING)
+
+    if status["progress"]["successful"] == 0:
+        _save_task_status(docking_directory, taskId, status, Status.FAILED)
+        return
+
+    _save_result_file(result_file, [
+        {"smiles": item["smiles"], "url": item["url"]}
+        for item in status["ligands"] if "url" in item
+    ])
+    _save_task_status(docking_directory, taskId, status, Status.SUCCESSFUL)
 
 def main(arguments):
-    pass
+    """
+    Entry point used by batch tasks to dock one ligand: dock <ligand_directory> <receptor_file> <cpu>
+    """
+    if len(arguments) != 4 or arguments[0] != "dock":
+        print("Usage: run_task.py dock <ligand_directory> <receptor_file> <cpu>")
+        return 1
+    ligand_directory, receptor_file, cpu = arguments[1], arguments[2], int(arguments[3])
+    try:
+        prepare_docking(os.path.join(ligand_directory, "input.json"), receptor_file, ligand_directory, cpu)
+        cpu_slots.limit_vina_threads(cpu)
+        run_docking(os.path.join(ligand_directory, "docking_parameters.json"), ligand_directory, ligand_directory, "public")
+    except Exception as e:
+        print(repr(e))
+        return 1
+    return 0
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# Vina uses all CPUs by default, limit it to the CPUs reserved
+# for the docking, see cpu_slots.py .
+if [ -n "$DOCKING_VINA_CPU" ]; then
+  for argument in "$@"; do
+    case "$argument" in
+      --cpu|--cpu=*)
+        exec /opt/vina/bin/vina "$@"
+        ;;
+    esac
+  done
+  exec /opt/vina/bin/vina --cpu "$DOCKING_VINA_CPU" "$@"
+fi
+exec /opt/vina/bin/vina "$@"
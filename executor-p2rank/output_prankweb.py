@@ -8,6 +8,8 @@ import collections
 import gzip
 import shutil
 
+import brotli
+
 from model import *
 
 logger = logging.getLogger("prankweb.output_prankweb")
@@ -101,15 +103,39 @@ def _prepare_prediction_file(
         f" --output={structure_file}"
     )
 
+    pockets = load_pockets(predictions_file)
     with open(output_file, "w", encoding="utf-8") as stream:
         json.dump({
             "structure": load_structure_file(structure_file, conservation),
-            "pockets": load_pockets(predictions_file),
+            "pockets": pockets,
             "metadata": {
                 **structure.metadata,
                 "p2rank_version": _get_p2rank_version(parameters_file)
             },
         }, stream, indent=2)
+    _prepare_pockets_file(
+        os.path.join(os.path.dirname(output_file), "pockets.jsonl"), pockets)
+    _precompress_file(output_file)
+
+
+def _precompress_file(path: str):
+    """Store gzip and brotli variants next to the file, so the web-server
+    can serve them without compressing on every request."""
+    with open(path, "rb") as stream:
+        content = stream.read()
+    with gzip.open(path + ".gz", "wb") as stream:
+        stream.write(content)
+    with open(path + ".br", "wb") as stream:
+        stream.write(brotli.compress(content))
+
+
+def _prepare_pockets_file(output_file: str, pockets: typing.List[dict]):
+    """Write one pocket per line in order of rank, so the web-server
+    can serve top pockets without parsing the whole prediction file."""
+    with open(output_file, "w", encoding="utf-8") as stream:
+        for pocket in pockets:
+            stream.write(json.dumps(pocket, separators=(",", ":")))
+            stream.write("\n")
 
 
 def load_pockets(predictions_file: str):
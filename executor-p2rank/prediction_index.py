@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+#
+# Index of predictions from all databases stored in SQLite.
+#
+# The index is updated by the web-server and executor on every status change,
+# so administration does not need to scan all prediction directories.
+# The index is only a cache, it can be rebuilt from the directories.
+#
+# This module is shared by the executor, web-server and administration,
+# see their Dockerfiles.
+#
+import json
+import logging
+import os
+import sqlite3
+import threading
+import typing
+
+logger = logging.getLogger("prankweb.index")
+logger.setLevel(logging.DEBUG)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS prediction (
+  database TEXT NOT NULL,
+  identifier TEXT NOT NULL,
+  status TEXT NOT NULL,
+  created TEXT,
+  last_change TEXT,
+  pockets INTEGER,
+  size INTEGER,
+  directory TEXT NOT NULL,
+  PRIMARY KEY (database, identifier)
+);
+CREATE INDEX IF NOT EXISTS prediction_status
+  ON prediction (database, status);
+"""
+
+_UPSERT = """
+INSERT INTO prediction
+  (database, identifier, status, created, last_change,
+   pockets, size, directory)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (database, identifier) DO UPDATE SET
+  status = excluded.status,
+  created = excluded.created,
+  last_change = excluded.last_change,
+  pockets = COALESCE(excluded.pockets, prediction.pockets),
+  size = COALESCE(excluded.size, prediction.size),
+  directory = excluded.directory
+"""
+
+
+class IndexedPrediction(typing.NamedTuple):
+    database: str
+    identifier: str
+    status: str
+    created: typing.Optional[str]
+    last_change: typing.Optional[str]
+    pockets: typing.Optional[int]
+    size: typing.Optional[int]
+    directory: str
+
+
+def get_index_path() -> typing.Optional[str]:
+    """Return path to the index or None if the index is not used."""
+    return os.environ.get("PRANKWEB_PREDICTION_INDEX", None)
+
+
+def connect(path: str, check_same_thread: bool = True) \
+        -> sqlite3.Connection:
+    connection = sqlite3.connect(
+        path, timeout=30, check_same_thread=check_same_thread)
+    # WAL allows readers to work while the index is being updated.
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+class _SharedConnection:
+    """One connection per process used for all status changes, so the
+    schema is created only once. Forked processes open a new connection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection: typing.Optional[sqlite3.Connection] = None
+        self.path: typing.Optional[str] = None
+        self.pid: typing.Optional[int] = None
+
+    def get(self, path: str) -> sqlite3.Connection:
+        if self.connection is None or self.path != path \
+                or self.pid != os.getpid():
+            self.close()
+            self.connection = connect(path, check_same_thread=False)
+            self.path = path
+            self.pid = os.getpid()
+        return self.connection
+
+    def close(self):
+        # Connection of a parent process is not ours to close.
+        if self.connection is not None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+
+
+_shared = _SharedConnection()
+
+
+def on_status_change(
+        directory: str, info: typing.Dict,
+        pockets: typing.Optional[int] = None,
+        size: typing.Optional[int] = None) -> None:
+    """Update index with given info file content, if the index is used.
+    Failure to update the index does not fail the caller."""
+    path = get_index_path()
+    if path is None:
+        return
+    with _shared.lock:
+        try:
+            connection = _shared.get(path)
+            with connection:
+                update(connection, directory, info, pockets, size)
+        except sqlite3.Error:
+            logger.exception("Can't update prediction index.")
+            # Open the index again next time, it may have been replaced.
+            _shared.close()
+
+
+def update(
+        connection: sqlite3.Connection, directory: str, info: typing.Dict,
+        pockets: typing.Optional[int] = None,
+        size: typing.Optional[int] = None) -> None:
+    connection.execute(_UPSERT, (
+        info["database"],
+        info["id"],
+        info["status"],
+        info.get("created", None),
+        info.get("lastChange", None),
+        pockets,
+        size,
+        os.path.abspath(directory),
+    ))
+
+
+def update_directory(
+        connection: sqlite3.Connection, database: str, identifier: str,
+        directory: str) -> None:
+    """Record new location of a moved prediction."""
+    connection.execute(
+        "UPDATE prediction SET directory = ? "
+        "WHERE database = ? AND identifier = ?",
+        (os.path.abspath(directory), database, identifier))
+
+
+def remove(
+        connection: sqlite3.Connection, database: str,
+        identifier: str) -> None:
+    connection.execute(
+        "DELETE FROM prediction WHERE database = ? AND identifier = ?",
+        (database, identifier))
+
+
+def query(
+        connection: sqlite3.Connection, database: str,
+        statuses: typing.Optional[typing.Iterable[str]] = None) \
+        -> typing.List[IndexedPrediction]:
+    """Return predictions in given database, optionally only those
+    with one of given statuses."""
+    sql = "SELECT database, identifier, status, created, last_change, " \
+          "pockets, size, directory FROM prediction WHERE database = ?"
+    parameters = [database]
+    if statuses is not None:
+        statuses = list(statuses)
+        sql += " AND status IN (" + ",".join("?" * len(statuses)) + ")"
+        parameters.extend(statuses)
+    return [IndexedPrediction(*row)
+            for row in connection.execute(sql, parameters)]
+
+
+def collect_statistics(directory: str) \
+        -> typing.Tuple[typing.Optional[int], int]:
+    """Return number of pockets and size of public files in bytes."""
+    public_directory = os.path.join(directory, "public")
+    size = 0
+    if os.path.isdir(public_directory):
+        for root, _, files in os.walk(public_directory):
+            for file in files:
+                size += os.path.getsize(os.path.join(root, file))
+    pockets = None
+    prediction_file = os.path.join(public_directory, "prediction.json")
+    if os.path.exists(prediction_file):
+        try:
+            with open(prediction_file, encoding="utf-8") as stream:
+                pockets = len(json.load(stream)["pockets"])
+        except (OSError, ValueError, KeyError):
+            pass
+    return pockets, size
@@ -13,6 +13,7 @@ import shutil
 
 from model import *
 from executor import execute
+import prediction_index
 
 
 class Status(enum.Enum):
@@ -100,6 +101,7 @@ def _execute_directory_task(
 
     status["status"] = Status.RUNNING.value
     _save_status_file(status_file, status)
+    prediction_index.on_status_change(directory, status)
 
     configuration = _load_json(
         os.path.join(directory, "input", "configuration.json"))
@@ -139,6 +141,8 @@ def _execute_directory_task(
         logger.exception("Execution failed.")
 
     _save_status_file(status_file, status)
+    prediction_index.on_status_change(
+        directory, status, *prediction_index.collect_statistics(directory))
 
     if not keep_working:
         shutil.rmtree(os.path.join(directory, "working"))
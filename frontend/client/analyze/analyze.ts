@@ -18,6 +18,18 @@ enum UserInterface {
  */
 let queuedTimeout = 500;
 
+/**
+ * Last seen lastChange of the task, the server uses it to hold the request
+ * until the task changes.
+ */
+let lastChange: string | undefined = undefined;
+
+/**
+ * Last seen status of the task. We wait for a change only while the task
+ * is queued, lastChange of a running task does not change with the log.
+ */
+let lastStatus: string | undefined = undefined;
+
 async function checkTaskStatus() {
   const params = getUrlQueryParams();
   if (params.database === null || params.id === null) {
@@ -26,7 +38,8 @@ async function checkTaskStatus() {
   }
   let response;
   try {
-    response = await fetchPrediction(params.database, params.id);
+    const since = lastStatus === TaskStatus.queued ? lastChange : undefined;
+    response = await fetchPrediction(params.database, params.id, since);
   } catch (ex) {
     renderInvalidHttpResponse();
     setTimeout(checkTaskStatus, 7000);
@@ -41,6 +54,8 @@ async function checkTaskStatus() {
     renderUnexpectedResponse(response.statusCode);
     return;
   }
+  lastChange = response.content.lastChange;
+  lastStatus = response.content.status;
   switch (response.content.status) {
     case TaskStatus.queued:
       renderQueued()
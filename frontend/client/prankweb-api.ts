@@ -36,13 +36,19 @@ export interface HttpWrap<T> {
  * A method to fetch the prediction info from the API.
  * @param database The database to fetch the prediction from.
  * @param id The ID of the prediction.
+ * @param since Optional, last known lastChange of the prediction. If given,
+ *  the server waits up to wait seconds for a change before responding.
+ * @param wait Maximum number of seconds the server should wait for a change.
  * @returns A promise that resolves to the prediction info.
  */
 export async function fetchPrediction(
-  database: string, id: string
+  database: string, id: string, since?: string, wait: number = 20
 ): Promise<HttpWrap<PredictionInfo>> {
   // We need to navigate to the root, and then we can request the data.
-  const url = getApiEndpoint(database, id);
+  let url = getApiEndpoint(database, id);
+  if (since !== undefined) {
+    url += `?wait=${wait}&since=${encodeURIComponent(since)}`;
+  }
   const response = await fetch(url);
   let result;
   try {
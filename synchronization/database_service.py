@@ -1,7 +1,21 @@
 #!/usr/bin/env python3
+#
+# Synchronization database stored in SQLite.
+#
+# Every record is a row, so a change of one record does not rewrite the
+# whole database. Records are indexed by status, as every phase of the
+# synchronization works only with records in one status.
+#
+# Older versions stored the database in 'index.json', it is imported
+# in one transaction together with the 'pdb' section. The database is
+# imported until the section exists, so an interrupted import is started
+# again. The JSON file can still be exported in the same format.
+#
 import os
 import json
 import enum
+import sqlite3
+import typing
 
 
 class EntryStatus(enum.Enum):
@@ -22,25 +36,159 @@ class EntryStatus(enum.Enum):
     CONVERTED = "converted"
 
 
-def load_database(directory: str):
-    if not os.path.exists(_get_database_file(directory)):
-        # Create default database.
-        return {
-            "version": "1",
-            "pdb": {},
-            "data": {}
-        }
-    with open(_get_database_file(directory), "r", encoding="utf-8") as stream:
-        return json.load(stream)
+DATABASE_VERSION = "1"
+
+# Status is stored in its own column, the content holds the rest.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS record (
+  code TEXT NOT NULL PRIMARY KEY,
+  status TEXT NOT NULL,
+  content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS record_status ON record (status);
+CREATE TABLE IF NOT EXISTS section (
+  name TEXT NOT NULL PRIMARY KEY,
+  content TEXT NOT NULL
+);
+"""
+
+
+def open_database(directory: str) -> sqlite3.Connection:
+    """Open the database in given directory, create it if missing."""
+    connection = sqlite3.connect(_get_database_file(directory))
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SCHEMA)
+    if not _is_imported(connection):
+        with connection:
+            _import_json(connection, _get_json_file(directory))
+    return connection
 
 
 def _get_database_file(directory: str):
+    return os.path.join(directory, "index.sqlite")
+
+
+def _get_json_file(directory: str):
     return os.path.join(directory, "index.json")
 
 
-def save_database(directory: str, database):
-    destination = _get_database_file(directory)
+def _is_imported(connection: sqlite3.Connection) -> bool:
+    return connection.execute(
+        "SELECT 1 FROM section WHERE name = 'pdb'").fetchone() is not None
+
+
+def _import_json(connection: sqlite3.Connection, path: str):
+    if not os.path.exists(path):
+        set_section(connection, "pdb", {})
+        return
+    with open(path, "r", encoding="utf-8") as stream:
+        database = json.load(stream)
+    set_section(connection, "pdb", database.get("pdb", {}))
+    for code, record in database["data"].items():
+        insert_record(connection, code, record)
+
+
+def get_section(connection: sqlite3.Connection, name: str) -> dict:
+    row = connection.execute(
+        "SELECT content FROM section WHERE name = ?", (name,)).fetchone()
+    return {} if row is None else json.loads(row[0])
+
+
+def set_section(connection: sqlite3.Connection, name: str, content: dict):
+    connection.execute(
+        "INSERT OR REPLACE INTO section (name, content) VALUES (?, ?)",
+        (name, json.dumps(content, ensure_ascii=False)))
+
+
+def get_record(
+        connection: sqlite3.Connection, code: str) -> typing.Optional[dict]:
+    row = connection.execute(
+        "SELECT status, content FROM record WHERE code = ?",
+        (code,)).fetchone()
+    return None if row is None else _to_record(*row)
+
+
+def insert_record(
+        connection: sqlite3.Connection, code: str, record: dict) -> bool:
+    """Insert the record, return false if there already is one."""
+    cursor = connection.execute(
+        "INSERT OR IGNORE INTO record (code, status, content) "
+        "VALUES (?, ?, ?)",
+        (code, record["status"], _to_content(record)))
+    return cursor.rowcount > 0
+
+
+def update_record(connection: sqlite3.Connection, code: str, record: dict):
+    connection.execute(
+        "UPDATE record SET status = ?, content = ? WHERE code = ?",
+        (record["status"], _to_content(record), code))
+
+
+def change_status(
+        connection: sqlite3.Connection,
+        source: EntryStatus, target: EntryStatus) -> int:
+    """Change status of all records in source status,
+    return number of changed records."""
+    cursor = connection.execute(
+        "UPDATE record SET status = ? WHERE status = ?",
+        (target.value, source.value))
+    return cursor.rowcount
+
+
+def list_records(
+        connection: sqlite3.Connection,
+        status: typing.Optional[EntryStatus] = None) \
+        -> typing.List[typing.Tuple[str, dict]]:
+    """Return records in given status in the order they were added."""
+    if status is None:
+        cursor = connection.execute(
+            "SELECT code, status, content FROM record ORDER BY rowid")
+    else:
+        cursor = connection.execute(
+            "SELECT code, status, content FROM record WHERE status = ? "
+            "ORDER BY rowid", (status.value,))
+    return [(code, _to_record(status, content))
+            for code, status, content in cursor]
+
+
+def count_by_status(connection: sqlite3.Connection) -> typing.Dict[str, int]:
+    return dict(connection.execute(
+        "SELECT status, COUNT(*) FROM record GROUP BY status"))
+
+
+def _to_content(record: dict) -> str:
+    return json.dumps(
+        {key: value for key, value in record.items() if key != "status"},
+        ensure_ascii=False)
+
+
+def _to_record(status: str, content: str) -> dict:
+    return {"status": status, **json.loads(content)}
+
+
+def export_json(connection: sqlite3.Connection, directory: str):
+    """Write the database to 'index.json' in the format used by older
+    versions. Records are written one by one, so the whole database
+    is never in memory."""
+    destination = _get_json_file(directory)
     destination_swp = destination + ".swp"
     with open(destination_swp, "w", encoding="utf-8") as stream:
-        json.dump(database, stream, ensure_ascii=False, indent=2)
+        stream.write("{\n")
+        stream.write(f"  \"version\": {json.dumps(DATABASE_VERSION)},\n")
+        pdb = json.dumps(
+            get_section(connection, "pdb"), ensure_ascii=False, indent=2)
+        stream.write("  \"pdb\": " + pdb.replace("\n", "\n  ") + ",\n")
+        stream.write("  \"data\": {")
+        cursor = connection.execute(
+            "SELECT code, status, content FROM record ORDER BY rowid")
+        separator = "\n"
+        for code, status, content in cursor:
+            record = json.dumps(
+                _to_record(status, content), ensure_ascii=False, indent=2)
+            stream.write(
+                f"{separator}    {json.dumps(code, ensure_ascii=False)}: "
+                + record.replace("\n", "\n    "))
+            separator = ",\n"
+        stream.write("\n  }\n}" if separator == ",\n" else "}\n}")
     os.replace(destination_swp, destination)
@@ -4,7 +4,13 @@ import logging
 import csv
 import json
 import collections
+import contextlib
 import dataclasses
+import time
+import typing
+
+import jsonschema
+import requests
 
 from funpdbe_validator.validator.validator import Validator
 from funpdbe_validator.validator.residue_index import ResidueIndexes
@@ -12,6 +18,13 @@ from funpdbe_validator.validator.residue_index import ResidueIndexes
 logger = logging.getLogger("prankweb.pdbe")
 logger.setLevel(logging.DEBUG)
 
+# Change when the output changes, so all files are converted again.
+CONVERTER_VERSION = "1"
+
+# How long is the schema cached on disk used without checking for a new
+# version, in seconds.
+SCHEMA_TTL = 24 * 60 * 60
+
 
 @dataclasses.dataclass
 class Configuration:
@@ -20,24 +33,110 @@ class Configuration:
     release_day: str
     url_template: str
     p2rank_version: str
+    # Path to file with cached FunPDBe schema, None to not cache on disk.
+    schema_cache: typing.Optional[str] = None
+
+
+class CachedValidator(Validator):
+    """Validator sharing the schema in the process, the schema is
+    downloaded and compiled only once."""
+    _schema = None
+    _schema_validator = None
+
+    def __init__(self, resource: str, schema_cache: typing.Optional[str]):
+        super().__init__(resource)
+        if CachedValidator._schema_validator is None:
+            schema = _load_schema(self.json_url, schema_cache)
+            validator_class = jsonschema.validators.validator_for(schema)
+            validator_class.check_schema(schema)
+            CachedValidator._schema = schema
+            CachedValidator._schema_validator = validator_class(schema)
+        self.schema = CachedValidator._schema
+
+    def load_schema(self):
+        # The schema is already loaded.
+        ...
+
+    def validate_against_schema(self):
+        try:
+            CachedValidator._schema_validator.validate(self.json_data)
+            return True
+        except jsonschema.ValidationError as err:
+            self.error_log = "JSON does not comply with schema: %s" % err
+            return False
+
+
+class ListingResidueIndexes(ResidueIndexes):
+    """Residue validation in the mmcif mode using a residue listing
+    read beforehand, see residue_service, instead of the mmcif file."""
+
+    def __init__(self, data, residue_listing):
+        super().__init__(data)
+        self.mmcif_mode = True
+        self.mmcif_data = residue_listing
+
+    def _get_mmcif_residue_list(self):
+        # The listing is already read.
+        ...
 
 
 class ValidatorFactory:
     """We need to cache schema, to not download it each time."""
-    _cached_schema = None
 
     @staticmethod
-    def create(resource: str, pdbe_file: str):
-        result = Validator(resource)
-        if ValidatorFactory._cached_schema is None:
-            result.load_schema()
-            ValidatorFactory._cached_schema = result.schema
-        else:
-            result.schema = ValidatorFactory._cached_schema
+    def create(
+            resource: str, pdbe_file: str,
+            schema_cache: typing.Optional[str] = None):
+        result = CachedValidator(resource, schema_cache)
         result.load_json(pdbe_file)
         return result
 
 
+def _load_schema(url: str, schema_cache: typing.Optional[str]):
+    """Return schema from the cache file, download it when the cache is
+    older than SCHEMA_TTL and the schema has changed."""
+    cached = None
+    if schema_cache is not None and os.path.exists(schema_cache):
+        with open(schema_cache, "r", encoding="utf-8") as stream:
+            cached = json.load(stream)
+        if cached.get("url", None) != url:
+            cached = None
+    if cached is not None and time.time() - cached["checked"] < SCHEMA_TTL:
+        return cached["schema"]
+    headers = {}
+    if cached is not None and cached.get("etag", None):
+        headers["If-None-Match"] = cached["etag"]
+    try:
+        response = requests.get(url, headers=headers, timeout=60)
+    except requests.RequestException:
+        response = None
+    if response is not None and response.status_code == 304:
+        schema, etag = cached["schema"], cached["etag"]
+    elif response is not None and 199 < response.status_code < 299:
+        schema, etag = response.json(), response.headers.get("ETag", None)
+    elif cached is not None:
+        logger.warning("Can't check FunPDBe schema, using cached schema.")
+        return cached["schema"]
+    else:
+        raise RuntimeError(f"Can't download FunPDBe schema from '{url}'.")
+    if schema_cache is not None:
+        _save_json(schema_cache, {
+            "url": url,
+            "etag": etag,
+            "checked": time.time(),
+            "schema": schema,
+        })
+    return schema
+
+
+def _save_json(path: str, content):
+    # Workers may save the file at the same time.
+    path_swp = f"{path}.{os.getpid()}.swp"
+    with open(path_swp, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+    os.replace(path_swp, path)
+
+
 ResidueRef = collections.namedtuple("ResidueReference", ["chain", "index"])
 
 
@@ -45,14 +144,51 @@ class EmptyPrediction(Exception):
     ...
 
 
+class ValidationFailed(RuntimeError):
+    """The FunPDBe file is not valid."""
+
+    def __init__(self, message: str, validation_time: float):
+        super().__init__(message)
+        # Duration of the validation in seconds.
+        self.validation_time = validation_time
+
+
 def convert_p2rank_to_pdbe(
         configuration: Configuration,
         pdb_id: str,
-        predictions_path: str,
-        residues_path: str,
-        output_path: str):
-    residues = _read_residues(residues_path)
-    pockets = _read_predictions(predictions_path)
+        predictions: typing.Union[str, typing.TextIO],
+        residues: typing.Union[str, typing.TextIO],
+        output_path: str,
+        residue_listing=None):
+    """Convert P2Rank prediction to FunPDBe file, predictions and residues
+    are CSV files given as paths or opened streams. When residue_listing
+    is given it is used to validate residues instead of PDBe API.
+    Return duration of the validation in seconds."""
+    content = create_funpdbe_content(
+        configuration, pdb_id, predictions, residues)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as out_stream:
+        json.dump(content, out_stream, indent=2)
+
+    if len(content["chains"]) == 0:
+        raise EmptyPrediction()
+
+    return validate_file(
+        configuration.data_resource, output_path, residue_listing,
+        configuration.schema_cache)
+
+
+def create_funpdbe_content(
+        configuration: Configuration,
+        pdb_id: str,
+        predictions: typing.Union[str, typing.TextIO],
+        residues: typing.Union[str, typing.TextIO]) -> dict:
+    """Return content of FunPDBe file for given P2Rank prediction."""
+    with _open_csv(residues) as stream:
+        residues = _read_residues(stream)
+    residue_index = _index_residues(residues)
+    with _open_csv(predictions) as stream:
+        pockets = _read_predictions(stream)
 
     sites = []
     chains_dictionary = {}
@@ -61,22 +197,20 @@ def convert_p2rank_to_pdbe(
         site = _create_site(pocket)
         sites.append(site)
         for residue in _iterate_site_residues(
-                pocket, residues, site["site_id"]):
+                pocket, residues, residue_index, site["site_id"]):
             _add_residue_to_chains(residue, chains_dictionary)
     chains = _flat_chains_dictionary(chains_dictionary)
 
-    content = _create_output_file(configuration, pdb_id, sites, chains)
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, "w") as out_stream:
-        json.dump(content, out_stream, indent=2)
+    return _create_output_file(configuration, pdb_id, sites, chains)
 
-    if len(chains) == 0:
-        raise EmptyPrediction()
 
-    validate_file(configuration.data_resource, output_path)
+def _open_csv(source):
+    if isinstance(source, str):
+        return open(source)
+    return contextlib.nullcontext(source)
 
 
-def _read_residues(residues_path):
+def _read_residues(stream):
     # chain, residue_label, residue_name, score, zscore, probability, pocket
     return [{
         "chains": row["chain"],
@@ -85,25 +219,35 @@ def _read_residues(residues_path):
         "score": float(row["score"]),
         "probability": float(row["probability"]),
         "pocket": row["pocket"]
-    } for row in _iterate_csv_file(residues_path)]
+    } for row in _iterate_csv_file(stream)]
 
 
-def _iterate_csv_file(path):
-    with open(path) as stream:
-        csv_reader = csv.reader(stream, delimiter=",", skipinitialspace=True)
-        header = [key.rstrip() for key in next(csv_reader)]
-        for row in csv_reader:
-            yield {key: value.rstrip() for key, value in zip(header, row)}
+def _index_residues(residues):
+    """Return positions of residues in the list for each residue."""
+    result = collections.defaultdict(list)
+    for position, residue in enumerate(residues):
+        residue_ref = ResidueRef(residue["chains"], residue["label"])
+        result[residue_ref].append(position)
+    return result
 
 
-def _read_predictions(predictions_path):
+def _iterate_csv_file(stream):
+    csv_reader = csv.reader(stream, delimiter=",", skipinitialspace=True)
+    header = [key.rstrip() for key in next(csv_reader)]
+    for row in csv_reader:
+        yield {key: value.rstrip() for key, value in zip(header, row)}
+
+
+def _read_predictions(stream):
     # name, rank, score, sas_points, surf_atoms,
     # center_x, center_y, center_z,
     # residue_ids, surf_atom_ids
+    # Score and center are written to the output as they are in the file.
     return [{
         "name": row["name"],
+        "site_id": int(row["name"].replace("pocket", "")),
         "score": row["score"],
-        "rank": row["rank"],
+        "rank": int(row["rank"]),
         "center_x": row["center_x"],
         "center_y": row["center_y"],
         "center_z": row["center_z"],
@@ -111,12 +255,12 @@ def _read_predictions(predictions_path):
             ResidueRef(*item.split("_"))
             for item in row["residue_ids"].split(" ")
         ]
-    } for row in _iterate_csv_file(predictions_path)]
+    } for row in _iterate_csv_file(stream)]
 
 
 def _create_site(pocket):
     site = {
-        "site_id": int(pocket["name"].replace("pocket", "")),
+        "site_id": pocket["site_id"],
         "label": pocket["name"],
         "additional_site_annotations": {
             "score": pocket["score"],
@@ -130,11 +274,15 @@ def _create_site(pocket):
     return site
 
 
-def _iterate_site_residues(pocket, residues, site_id):
-    for residue in residues:
-        residue_ref = ResidueRef(residue["chains"], residue["label"])
-        if residue_ref in pocket["residues"]:
-            yield _residue_to_site_data(residue, site_id)
+def _iterate_site_residues(pocket, residues, residue_index, site_id):
+    # Residues are reported in the order of the residues file.
+    positions = sorted(
+        position
+        for residue_ref in set(pocket["residues"])
+        for position in residue_index.get(residue_ref, ())
+    )
+    for position in positions:
+        yield _residue_to_site_data(residues[position], site_id)
 
 
 def _residue_to_site_data(residue, site_id):
@@ -206,21 +354,36 @@ def _create_output_file(
     }
 
 
-def validate_file(resource: str, pdbe_file: str):
-    validator = ValidatorFactory.create(resource, pdbe_file)
+def validate_file(
+        resource: str, pdbe_file: str, residue_listing=None,
+        schema_cache: typing.Optional[str] = None) -> float:
+    """Validate the file, return duration of the validation in seconds."""
+    start = time.perf_counter()
+    validator = ValidatorFactory.create(resource, pdbe_file, schema_cache)
     if not validator.basic_checks():
         logger.error(validator.error_log)
-        raise RuntimeError(
+        raise ValidationFailed(
             "Basic checks failed for {}\n{}".format(
-                pdbe_file, validator.error_log))
+                pdbe_file, validator.error_log),
+            time.perf_counter() - start)
     if not validator.validate_against_schema():
         logger.error(validator.error_log)
-        raise RuntimeError(
+        raise ValidationFailed(
             "Invalid schema for {}\n{}".format(
-                pdbe_file, validator.error_log))
-    residue_indexes = ResidueIndexes(validator.json_data)
-    if not residue_indexes.check_every_residue():
+                pdbe_file, validator.error_log),
+            time.perf_counter() - start)
+    if residue_listing is None:
+        residue_indexes = ResidueIndexes(validator.json_data)
+    else:
+        residue_indexes = ListingResidueIndexes(
+            validator.json_data, residue_listing)
+    # In mmcif mode a chain passes when any of its residues matches,
+    # so we also check for the mismatches.
+    if not residue_indexes.check_every_residue() \
+            or residue_indexes.mismatches:
         logger.error(residue_indexes.mismatches)
-        raise RuntimeError(
+        raise ValidationFailed(
             "Invalid residues: {}\n{}".format(
-                pdbe_file, validator.error_log))
+                pdbe_file, validator.error_log),
+            time.perf_counter() - start)
+    return time.perf_counter() - start
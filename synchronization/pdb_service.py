@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import requests
+import requests.adapters
 import collections
+import concurrent.futures
 import logging
+import threading
 import typing
 import time
 
@@ -10,31 +13,99 @@ PdbRecord = collections.namedtuple("PdbRecord", ["code", "release"])
 logger = logging.getLogger("pdb")
 logger.setLevel(logging.DEBUG)
 
+# Number of entries in one page.
+PAGE_SIZE = 300
+
+# Minimal time between two requests to PDB, in seconds.
+POLITENESS_INTERVAL = 1.0
+
+# Number of attempts to fetch one page.
+MAX_ATTEMPTS = 4
+
+
+class _Politeness:
+    """Keep given interval between starts of requests from all threads."""
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self._interval
+        time.sleep(max(0.0, start - now))
+
+
+_session = requests.Session()
+
+_politeness = _Politeness(POLITENESS_INTERVAL)
+
 
 def get_deposited_from(date: typing.Optional[str]) -> typing.List[PdbRecord]:
+    result = []
+    harvest_deposited_from(
+        date, set(), lambda offset, records: result.extend(records))
+    logger.info(f"Total number entries: {len(result)}")
+    return result
+
+
+def harvest_deposited_from(
+        date: typing.Optional[str],
+        completed: typing.Set[int],
+        on_page: typing.Callable[[int, typing.List[PdbRecord]], None],
+        max_in_flight: int = 2) -> bool:
+    """Fetch entries released from given date page by page. Pages with
+    offsets in completed are skipped. Every fetched page is passed to
+    on_page in the order of offsets, so the caller can store the page
+    and its offset and resume an interrupted harvest.
+    Return true when all pages were fetched."""
     logger.info("Fetching number of new entries")
     response_with_count = _fetch_json(_create_pdb_solr_count_query(date))
     if response_with_count is None:
         logger.error("Can't get number of entries.")
-        return []
+        return False
     rows = response_with_count["grouped"]["pdb_id"]["ngroups"]
-    result = []
     logger.info(f"Total number entries to fetch: {rows}")
-    for offset in range(0, rows, 300):
-        limit = min(rows, offset + 300)
-        logger.info(f"Fetching entries {offset} - {limit}")
-        response_with_data = _fetch_json(
-            _create_pdb_solr_query(date, offset, limit))
-        if response_with_data is None:
-            logger.error("Can't fetch entries terminating download.")
-            return result
-        for item in response_with_data["grouped"]["pdb_id"]["doclist"]["docs"]:
-            result.append(PdbRecord(
-                item["pdb_id"].upper(),
-                item["release_date"]
-            ))
-    logger.info(f"Total number entries: {len(result)}")
-    return result
+    offsets = [
+        offset for offset in range(0, rows, PAGE_SIZE)
+        if offset not in completed
+    ]
+    if len(offsets) < len(range(0, rows, PAGE_SIZE)):
+        logger.info(f"Resuming download, {len(offsets)} pages left.")
+    # Connections are reused by all threads.
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max_in_flight)
+    _session.mount("https://", adapter)
+    with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+        pages = executor.map(
+            lambda offset: _fetch_page(date, offset, rows), offsets)
+        try:
+            for offset, records in zip(offsets, pages):
+                if records is None:
+                    logger.error("Can't fetch entries terminating download.")
+                    return False
+                on_page(offset, records)
+        finally:
+            executor.shutdown(cancel_futures=True)
+    return True
+
+
+def _fetch_page(
+        date: typing.Optional[str], offset: int, rows: int) \
+        -> typing.Optional[typing.List[PdbRecord]]:
+    limit = min(PAGE_SIZE, rows - offset)
+    logger.info(f"Fetching entries {offset} - {offset + limit}")
+    response_with_data = _fetch_json(
+        _create_pdb_solr_query(date, offset, limit))
+    if response_with_data is None:
+        return None
+    return [
+        PdbRecord(item["pdb_id"].upper(), item["release_date"])
+        for item in response_with_data["grouped"]["pdb_id"]["doclist"]["docs"]
+    ]
 
 
 def _create_pdb_solr_count_query(date: typing.Optional[str]) -> str:
@@ -55,20 +126,30 @@ def _create_pdb_solr_query(
     query = "q=*:*"
     if date is not None:
         query = f"q=release_date:[{date} TO *]"
+    # Entries are sorted also by code, so the pages are stable.
     return "https://www.ebi.ac.uk/pdbe/search/pdb/select?" \
            "group=true&" \
            "group.ngroups=true&" \
            "group.field=pdb_id&" \
            "fl=pdb_id,release_date&" \
            f"{query}&start={offset}&rows={limit}&wjt=json&" \
-           f"group.format=simple&sort=release_date%20asc"
+           f"group.format=simple&sort=release_date%20asc,pdb_id%20asc"
 
 
 def _fetch_json(url: str):
-    # Sleep to give PDB some time.
-    time.sleep(3)
-    response = requests.get(url)
-    if 199 < response.status_code < 299:
-        return response.json()
-    else:
-        return None
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt > 0:
+            # Back off, PDB may be overloaded.
+            time.sleep(POLITENESS_INTERVAL * 2 ** attempt)
+        _politeness.wait()
+        try:
+            response = _session.get(url, timeout=120)
+        except requests.RequestException:
+            logger.warning(f"Can't connect to '{url}'.")
+            continue
+        if 199 < response.status_code < 299:
+            return response.json()
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        logger.warning(f"Response {response.status_code} for '{url}'.")
+    return None
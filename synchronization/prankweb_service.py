@@ -2,12 +2,15 @@
 import os.path
 
 import requests
+import requests.adapters
 import logging
 import typing
 import dataclasses
+import threading
 import time
 import json
 import shutil
+import concurrent.futures
 
 @dataclasses.dataclass
 class PrankWebResponse:
@@ -18,16 +21,96 @@ class PrankWebResponse:
 logger = logging.getLogger("prankweb")
 logger.setLevel(logging.DEBUG)
 
+# Maximum number of codes in one status request to the server.
+STATUS_BATCH_SIZE = 500
+
+# Number of attempts for a request the server could not handle.
+MAX_ATTEMPTS = 3
+
+
+class RateLimiter:
+    """Adaptive limit of requests per second shared by all threads.
+    The rate grows additively with every successful response and is
+    halved when the server is overloaded, i.e. it responds with 429
+    or 5xx, or we can not connect. Responses to requests sent at the same
+    time usually fail together, so the rate is halved at most once
+    a second."""
+
+    def __init__(
+            self, rate: float,
+            min_rate: float = 0.1, max_rate: float = 50.0,
+            increase: float = 0.1):
+        self._rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._next_time = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for permission to send a request."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + 1.0 / self._rate
+        time.sleep(max(0.0, start - now))
+
+    def on_response(self, status: int, retry_after: typing.Optional[float]):
+        with self._lock:
+            now = time.monotonic()
+            if _is_transient(status):
+                if now - self._last_decrease > 1.0:
+                    self._rate = max(self._min_rate, self._rate / 2)
+                    self._last_decrease = now
+                if retry_after is not None:
+                    self._next_time = max(
+                        self._next_time, now + retry_after)
+            else:
+                self._rate = min(self._max_rate, self._rate + self._increase)
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+
 _server_url = None
 
 _server_directory = None
 
+_session = requests.Session()
+
+_rate_limiter = RateLimiter(0.5)
 
-def initialize(server_url: str, server_directory: typing.Optional[str]):
+_max_in_flight = 1
+
+
+def initialize(
+        server_url: str, server_directory: typing.Optional[str],
+        max_in_flight: int = 1, rate: float = 0.5):
+    """Set the server, max_in_flight is the maximum number of concurrent
+    requests and rate is the initial number of requests per second."""
     global _server_url
     _server_url = server_url
     global _server_directory
     _server_directory = server_directory
+    global _max_in_flight
+    _max_in_flight = max(1, max_in_flight)
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rate)
+    global _session
+    # Connections are reused by all threads.
+    _session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=_max_in_flight)
+    _session.mount("http://", adapter)
+    _session.mount("https://", adapter)
+
+
+def get_settings() -> typing.Tuple:
+    """Return arguments for initialize with the current settings."""
+    return (_server_url, _server_directory, _max_in_flight,
+            _rate_limiter.rate)
 
 
 def retrieve_info(pdb_code: str) -> PrankWebResponse:
@@ -37,33 +120,159 @@ def retrieve_info(pdb_code: str) -> PrankWebResponse:
         return _retrieve_info_directory(pdb_code)
 
 
+def retrieve_info_concurrent(
+        pdb_codes: typing.List[str]) -> typing.Dict[str, PrankWebResponse]:
+    """Retrieve info for multiple codes with up to max_in_flight
+    concurrent requests, missing predictions are created on the server."""
+    if _max_in_flight == 1:
+        return {code: retrieve_info(code) for code in pdb_codes}
+    with concurrent.futures.ThreadPoolExecutor(_max_in_flight) as executor:
+        responses = executor.map(retrieve_info, pdb_codes)
+        return dict(zip(pdb_codes, responses))
+
+
 def _retrieve_info_url(pdb_code: str) -> PrankWebResponse:
-    # Sleep to give prankweb some time.
-    time.sleep(2)
     url = f"{_server_url}/api/v2/prediction/{database()}/{pdb_code}"
-    try:
-        response = requests.get(url)
-    except:
+    response = _send("GET", url)
+    if response is None:
         return PrankWebResponse(-1, {})
-    return PrankWebResponse(response.status_code, response.json())
+    if response.status_code == 429:
+        return PrankWebResponse(response.status_code, {})
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    return PrankWebResponse(response.status_code, body)
+
+
+def _send(method: str, url: str, **kwargs) -> typing.Optional[requests.Response]:
+    """Send a request respecting the rate limit, retry when the server
+    is overloaded. Return None when we can not connect."""
+    response = None
+    for _ in range(MAX_ATTEMPTS):
+        _rate_limiter.acquire()
+        try:
+            response = _session.request(
+                method, url, headers=_headers(), **kwargs)
+        except requests.RequestException:
+            response = None
+            _rate_limiter.on_response(-1, None)
+            continue
+        _rate_limiter.on_response(
+            response.status_code, _retry_after(response))
+        if not _is_transient(response.status_code):
+            break
+        logger.debug(
+            f"Server responded with {response.status_code} for '{url}', "
+            f"rate changed to {_rate_limiter.rate:.2f} requests/s.")
+    return response
+
+
+def _is_transient(status: int) -> bool:
+    return status == -1 or status == 429 or 499 < status < 600
+
+
+def _retry_after(response: requests.Response) -> typing.Optional[float]:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
 
 
 def _retrieve_info_directory(pdb_code: str) -> PrankWebResponse:
+    response = _retrieve_info_local(pdb_code)
+    if response is None:
+        return _retrieve_info_url(pdb_code)
+    return response
+
+
+def retrieve_info_batch(
+        pdb_codes: typing.List[str], create: bool = True) \
+        -> typing.Dict[str, PrankWebResponse]:
+    """Retrieve info for multiple codes, if create is true missing
+    predictions are created on the server."""
+    result = {}
+    remote_codes = []
+    for pdb_code in pdb_codes:
+        response = _retrieve_info_local(pdb_code)
+        if response is None:
+            remote_codes.append(pdb_code)
+        else:
+            result[pdb_code] = response
+    batches = [
+        remote_codes[start:start + STATUS_BATCH_SIZE]
+        for start in range(0, len(remote_codes), STATUS_BATCH_SIZE)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(_max_in_flight) as executor:
+        for responses in executor.map(
+                lambda codes: _retrieve_info_batch_url(codes, create),
+                batches):
+            result.update(responses)
+    return result
+
+
+def _retrieve_info_local(pdb_code: str) -> typing.Optional[PrankWebResponse]:
+    if _server_directory is None:
+        return None
     path = os.path.join(
         str(_server_directory), pdb_code[1:3].upper(), pdb_code.upper(),
         "info.json")
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as stream:
-            content = json.load(stream)
-        return PrankWebResponse(200, content)
-    else:
-        return _retrieve_info_url(pdb_code)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as stream:
+        content = json.load(stream)
+    return PrankWebResponse(200, content)
+
+
+def _retrieve_info_batch_url(
+        pdb_codes: typing.List[str], create: bool) \
+        -> typing.Dict[str, PrankWebResponse]:
+    url = f"{_server_url}/api/v2/prediction/{database()}/status"
+    response = _send("POST", url, json={
+        "identifiers": pdb_codes,
+        "create": create,
+    })
+    if response is None:
+        return {code: PrankWebResponse(-1, {}) for code in pdb_codes}
+    if not 199 < response.status_code < 299:
+        return {
+            code: PrankWebResponse(response.status_code, {})
+            for code in pdb_codes
+        }
+    predictions = response.json()["predictions"]
+    result = {}
+    for code in pdb_codes:
+        info = predictions.get(code.upper(), None)
+        if info is None:
+            result[code] = PrankWebResponse(404, {})
+        else:
+            result[code] = PrankWebResponse(200, info)
+    return result
+
+
+def _headers() -> typing.Dict[str, str]:
+    # With API key, the server admits more predictions from us.
+    api_key = os.environ.get("PRANKWEB_API_KEY", None)
+    if api_key is None:
+        return {}
+    return {"X-API-Key": api_key}
 
 
 def database() -> str:
     return "v3-conservation-hmm"
 
 
+def get_local_file(pdb_code: str, file_name: str) -> typing.Optional[str]:
+    """Return path to a public file in the server directory, None when
+    there is no such file and the file must be retrieved."""
+    if _server_directory is None:
+        return None
+    path = os.path.join(
+        str(_server_directory), pdb_code[1:3].upper(), pdb_code.upper(),
+        "public", file_name)
+    return path if os.path.exists(path) else None
+
+
 def retrieve_archive(pdb_code: str, destination: str):
     if _server_directory is None:
         _retrieve_archive_url(pdb_code, destination)
@@ -72,22 +281,43 @@ def retrieve_archive(pdb_code: str, destination: str):
 
 
 def _retrieve_archive_url(pdb_code: str, destination: str):
+    _retrieve_public_file_url(pdb_code, "prankweb.zip", destination)
+
+
+def _retrieve_public_file_url(
+        pdb_code: str, file_name: str, destination: str):
     url = f"{_server_url}/api/v2/prediction/{database()}/{pdb_code}/" \
-          "public/prankweb.zip"
-    response = requests.get(url)
+          f"public/{file_name}"
+    response = _send("GET", url)
+    if response is None:
+        raise RuntimeError(f"Can't connect to '{url}'")
     if not 199 < response.status_code < 299:
         raise RuntimeError(f"Invalid response code: '{response.status_code}'")
     open(destination, "wb").write(response.content)
 
 
 def _retrieve_archive_directory(pdb_code: str, destination: str):
+    _retrieve_public_file_directory(pdb_code, "prankweb.zip", destination)
+
+
+def _retrieve_public_file_directory(
+        pdb_code: str, file_name: str, destination: str):
     path = os.path.join(
         str(_server_directory), pdb_code[1:3].upper(), pdb_code.upper(),
-        "public", "prankweb.zip")
+        "public", file_name)
     if not os.path.exists(path):
         raise RuntimeError(f"Missing file: '{path}'")
     shutil.copy(path, destination)
 
 
+def retrieve_structure(pdb_code: str, destination: str):
+    """Retrieve gzipped mmCIF structure used for the prediction."""
+    if _server_directory is None:
+        _retrieve_public_file_url(pdb_code, "structure.cif.gz", destination)
+    else:
+        _retrieve_public_file_directory(
+            pdb_code, "structure.cif.gz", destination)
+
+
 def prediction_url_template() -> str:
     return f"{_server_url}/analyze?database={database()}&code=" + "{}"
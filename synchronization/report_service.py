@@ -1,4 +1,12 @@
 #!/usr/bin/env python3
+#
+# Report of changes made by the synchronization.
+#
+# Every run appends its changes as one line to a file of the day, in
+# a directory next to the JSON report. Reports of days are merged from
+# the lines, so a run never reads reports of other days. The JSON report
+# with all days is assembled from the merged reports of days.
+#
 import json
 import os
 import typing
@@ -8,45 +16,49 @@ from database_service import EntryStatus
 
 _state = {
     # New codes.
-    "new": [],
+    "new": set(),
     # Result of p2rank prediction.
     # Values are removed from predicted once processed by funPDBe.
-    "predicted": [],
-    "prankweb-failed": [],
+    "predicted": set(),
+    "prankweb-failed": set(),
     # Results of funPDBe processing.
-    "converted": [],
-    "empty": [],
-    "funpdbe-failed": [],
+    "converted": set(),
+    "empty": set(),
+    "funpdbe-failed": set(),
     # Statistics.
     "statistics": {}
 }
 
+REPORT_KEYS = [
+    "predicted", "converted", "empty", "funpdbe-failed", "prankweb-failed"]
+
 
 def on_new_pdb_records(pdb_codes: typing.List[str]) -> None:
-    _state["new"].extend(pdb_codes)
+    _state["new"].update(pdb_codes)
 
 
 def on_prediction_finished(pdb_code: str) -> None:
-    _state["predicted"].append(pdb_code)
+    _state["predicted"].add(pdb_code)
 
 
 def on_prediction_failed(pdb_code: str) -> None:
-    _state["prankweb-failed"].append(pdb_code)
+    _state["prankweb-failed"].add(pdb_code)
 
 
 def on_funpdbe_conversion_finished(pdb_code: str) -> None:
-    _state["predicted"].remove(pdb_code)
-    _state["converted"].append(pdb_code)
+    # The prediction may have finished in one of the previous runs.
+    _state["predicted"].discard(pdb_code)
+    _state["converted"].add(pdb_code)
 
 
 def on_funpdbe_conversion_empty(pdb_code: str) -> None:
-    _state["predicted"].remove(pdb_code)
-    _state["empty"].append(pdb_code)
+    _state["predicted"].discard(pdb_code)
+    _state["empty"].add(pdb_code)
 
 
 def on_funpdbe_conversion_failed(pdb_code: str) -> None:
-    _state["predicted"].remove(pdb_code)
-    _state["funpdbe-failed"].append(pdb_code)
+    _state["predicted"].discard(pdb_code)
+    _state["funpdbe-failed"].add(pdb_code)
 
 
 def on_counts(counts: typing.Dict[EntryStatus, int]) -> None:
@@ -54,64 +66,93 @@ def on_counts(counts: typing.Dict[EntryStatus, int]) -> None:
 
 
 def synchronize_report(path: str) -> None:
-    if os.path.exists(path):
-        report = _load_json(path)
-    else:
-        # Create new report object.
-        report = {"metadata": {"version": 1}, "data": []}
-    today = _load_or_create_today_report(report["data"])
-    _add_state_to_report(today)
-    _save_json(path, report)
+    directory = _get_days_directory(path)
+    if not os.path.exists(directory):
+        _import_report(path, directory)
+    key = datetime.datetime.now().strftime("%Y-%m-%d")
+    changes = _state_to_changes()
+    with open(os.path.join(directory, f"{key}.jsonl"), "a",
+              encoding="utf-8") as stream:
+        stream.write(json.dumps(changes, ensure_ascii=False) + "\n")
+    _save_json(
+        os.path.join(directory, f"{key}.json"), _merge_day(directory, key))
+    _write_report(path, directory)
 
 
-def _load_json(path: str):
-    with open(path, "r", encoding="utf-8") as stream:
-        return json.load(stream)
+def _get_days_directory(path: str) -> str:
+    base, _ = os.path.splitext(path)
+    return base + "-days"
 
 
-def _load_or_create_today_report(reports: typing.List):
-    key = datetime.datetime.now().strftime("%Y-%m-%d")
-    if len(reports) > 0 and reports[-1]["date"] == key:
-        return reports[-1]
-    else:
-        new_report = _create_report(key)
-        reports.append(new_report)
-        return new_report
+def _import_report(path: str, directory: str):
+    """Split report created by older version into days."""
+    os.makedirs(directory, exist_ok=True)
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as stream:
+        report = json.load(stream)
+    for day in report["data"]:
+        with open(os.path.join(directory, f"{day['date']}.jsonl"), "w",
+                  encoding="utf-8") as stream:
+            stream.write(json.dumps(day, ensure_ascii=False) + "\n")
+        _save_json(os.path.join(directory, f"{day['date']}.json"), day)
 
 
-def _create_report(date: str):
+def _state_to_changes():
     return {
-        "new": [],
-        "report": {
-            "predicted": [],
-            "converted": [],
-            "empty": [],
-            "funpdbe-failed": [],
-            "prankweb-failed": [],
-        },
-        "statistics": {},
-        "date": date,
-        "updated": ""
+        "new": sorted(_state["new"]),
+        "report": {key: sorted(_state[key]) for key in REPORT_KEYS},
+        "statistics": _state["statistics"],
+        "updated": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
     }
 
 
-def _add_state_to_report(report):
-    _add_uniq(report["new"], _state["new"])
-    _add_uniq(report["report"]["predicted"], _state["predicted"])
-    _add_uniq(report["report"]["converted"], _state["converted"])
-    _add_uniq(report["report"]["empty"], _state["empty"])
-    _add_uniq(report["report"]["funpdbe-failed"], _state["funpdbe-failed"])
-    _add_uniq(report["report"]["prankweb-failed"], _state["prankweb-failed"])
-    report["statistics"] = _state["statistics"]
-    report["updated"] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+def _merge_day(directory: str, date: str):
+    """Merge changes from all runs of the day."""
+    new = set()
+    report = {key: set() for key in REPORT_KEYS}
+    statistics = {}
+    updated = ""
+    with open(os.path.join(directory, f"{date}.jsonl"), "r",
+              encoding="utf-8") as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            changes = json.loads(line)
+            new.update(changes["new"])
+            for key in REPORT_KEYS:
+                report[key].update(changes["report"].get(key, []))
+            statistics = changes["statistics"]
+            updated = changes["updated"]
+    return {
+        "new": sorted(new),
+        "report": {key: sorted(values) for key, values in report.items()},
+        "statistics": statistics,
+        "date": date,
+        "updated": updated,
+    }
 
 
-def _add_uniq(left: typing.List[str], right: typing.List[str]):
-    left.extend([item for item in right if item not in left])
+def _write_report(path: str, directory: str):
+    """Assemble the report from merged days, days are not parsed."""
+    days = sorted(
+        file_name for file_name in os.listdir(directory)
+        if file_name.endswith(".json"))
+    path_swp = path + ".swp"
+    with open(path_swp, "w", encoding="utf-8") as stream:
+        stream.write("{\"metadata\": {\"version\": 1}, \"data\": [")
+        separator = "\n"
+        for file_name in days:
+            with open(os.path.join(directory, file_name), "r",
+                      encoding="utf-8") as day_stream:
+                stream.write(separator + day_stream.read().strip())
+            separator = ",\n"
+        stream.write("\n]}\n")
+    os.replace(path_swp, path)
 
 
 def _save_json(path: str, content):
     path_swp = path + ".swp"
     with open(path_swp, "w", encoding="utf-8") as stream:
-        json.dump(content, stream, ensure_ascii=False, indent=2)
+        json.dump(content, stream, ensure_ascii=False)
     os.replace(path_swp, path)
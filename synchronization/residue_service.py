@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Residue listings used to validate residues in FunPDBe files.
+#
+# The listing is read from the structure used for the prediction, instead
+# of asking PDBe API for every entry and chain. Listings are cached on disk
+# together with the fingerprint of the prediction, so the structure is
+# downloaded only once for every prediction of an entry.
+#
+# Only the _atom_site category of the mmCIF file is parsed, the file is
+# streamed, so it is never loaded in the memory.
+#
+import gzip
+import os
+import json
+import logging
+import re
+import typing
+
+import prankweb_service
+
+logger = logging.getLogger("prankweb.residues")
+logger.setLevel(logging.DEBUG)
+
+# Key is chain, value is a dictionary of residue number with insertion code
+# to residue name, see funpdbe_validator.validator.residue_index.
+ResidueListing = typing.Dict[str, typing.Dict[str, str]]
+
+# Token of mmCIF file, quoted values may contain quotes not followed by space.
+_MMCIF_TOKEN = re.compile(r"""'(?:[^']|'(?=\S))*'|"(?:[^"]|"(?=\S))*"|\S+""")
+
+_ATOM_SITE = "_atom_site."
+
+
+def get_residue_listing(
+        cache_directory: str, working_directory: str, code: str,
+        fingerprint: str) -> typing.Optional[ResidueListing]:
+    """Return residue listing for given entry, None if it is not
+    available and residues must be validated using PDBe API.
+    The fingerprint identifies the prediction, a cached listing of other
+    prediction of the entry is not used."""
+    cache_file = _get_cache_file(cache_directory, code)
+    cached = _load_json_or_none(cache_file)
+    if cached is not None and cached.get("fingerprint") == fingerprint:
+        return cached["residues"]
+    # Structure in a local server directory is read in place.
+    local_file = prankweb_service.get_local_file(code, "structure.cif.gz")
+    structure_file = local_file or \
+        os.path.join(working_directory, "structure.cif.gz")
+    try:
+        if local_file is None:
+            prankweb_service.retrieve_structure(code, structure_file)
+        result = read_mmcif_residues(structure_file)
+    except Exception:
+        logger.warning(f"Can't read residues of '{code}' from structure.")
+        return None
+    finally:
+        if local_file is None and os.path.exists(structure_file):
+            os.remove(structure_file)
+    if not result:
+        return None
+    _save_json(cache_file, {"fingerprint": fingerprint, "residues": result})
+    return result
+
+
+def read_mmcif_residues(structure_file: str) -> ResidueListing:
+    """Return residues from the _atom_site category of given mmCIF file,
+    the file can be gzipped. Residues use auth numbering."""
+    result = {}
+    columns = []
+    values = []
+    # We are in a loop, and we have seen its values.
+    in_loop, loop_values = False, False
+    in_atom_site, atom_site_loop = False, False
+    opener = gzip.open if structure_file.endswith(".gz") else open
+    with opener(structure_file, "rt", encoding="utf-8", errors="replace") \
+            as stream:
+        for token, is_value in _read_mmcif_tokens(stream):
+            if is_value:
+                loop_values = True
+                if not in_atom_site:
+                    continue
+                values.append(token)
+                if atom_site_loop and len(values) == len(columns):
+                    _add_mmcif_atom(result, dict(zip(columns, values)))
+                    values = []
+            elif token.startswith(_ATOM_SITE):
+                if not in_atom_site:
+                    in_atom_site = True
+                    atom_site_loop = in_loop and not loop_values
+                columns.append(token[len(_ATOM_SITE):])
+            elif in_atom_site:
+                # The category ends with any other keyword.
+                break
+            elif token.lower() == "loop_":
+                in_loop, loop_values = True, False
+            elif loop_values:
+                # Keyword after values of a loop ends the loop.
+                in_loop, loop_values = False, False
+    if in_atom_site and not atom_site_loop and len(values) == len(columns):
+        # Category with a single atom.
+        _add_mmcif_atom(result, dict(zip(columns, values)))
+    return result
+
+
+def _read_mmcif_tokens(
+        stream: typing.TextIO) -> typing.Iterator[typing.Tuple[str, bool]]:
+    """Yield tokens with a flag set for values, the other tokens are
+    keywords and names of data items."""
+    text_field = None
+    for line in stream:
+        if text_field is not None:
+            if not line.startswith(";"):
+                text_field.append(line)
+                continue
+            # Multi-line text field ends with ';' at the start of a line.
+            yield "".join(text_field).rstrip("\r\n"), True
+            text_field = None
+            line = line[1:]
+        elif line.startswith(";"):
+            text_field = [line[1:]]
+            continue
+        for token in _MMCIF_TOKEN.findall(line):
+            if token[0] == "#":
+                # Rest of the line is a comment.
+                break
+            if len(token) > 1 and token[0] == token[-1] and token[0] in "'\"":
+                yield token[1:-1], True
+            else:
+                yield token, not _is_mmcif_keyword(token)
+
+
+def _is_mmcif_keyword(token: str) -> bool:
+    return token.startswith("_") or \
+        token.lower().startswith(("data_", "loop_", "save_", "global_"))
+
+
+def _add_mmcif_atom(residues: ResidueListing, atom: typing.Dict[str, str]):
+    inscode = atom.get("pdbx_PDB_ins_code", "?")
+    if inscode in ("?", "."):
+        inscode = ""
+    auth_residue_number = f"{atom['auth_seq_id']}{inscode}"
+    residues.setdefault(atom["auth_asym_id"], {})[auth_residue_number] = \
+        atom["auth_comp_id"]
+
+
+def _get_cache_file(cache_directory: str, code: str) -> str:
+    return os.path.join(
+        cache_directory, code.lower()[1:3], f"{code.lower()}.json")
+
+
+def _load_json_or_none(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_json(path: str, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_swp = path + ".swp"
+    with open(path_swp, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+    os.replace(path_swp, path)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 import collections
+import concurrent.futures
 import os
 import datetime
+import enum
+import hashlib
+import io
+import json
 import shutil
+import time
 import zipfile
 import typing
 import argparse
@@ -13,6 +19,7 @@ from database_service import EntryStatus
 import pdb_service
 import prankweb_service
 import p2rank_to_funpdbe
+import residue_service
 import report_service as report
 
 logger = logging.getLogger(__name__)
@@ -20,7 +27,6 @@ logger.setLevel(logging.DEBUG)
 
 
 def _read_arguments() -> typing.Dict[str, str]:
-    from_date = datetime.datetime.today() - datetime.timedelta(weeks=1)
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--server",
@@ -34,13 +40,19 @@ def _read_arguments() -> typing.Dict[str, str]:
         help="Path to database directory.")
     parser.add_argument(
         "--from",
-        default=from_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
-        help="XSD data to from which update in format 2021-12-01T00:00:00Z.")
+        help="XSD data to from which update in format 2021-12-01T00:00:00Z. "
+             "When not set an interrupted harvest is resumed, else "
+             "the start of the day a week ago is used.")
     parser.add_argument(
         "--check-pdb",
         help="If set new records are fetch from PDB.",
         action="store_true",
         default=False)
+    parser.add_argument(
+        "--pdb-max-in-flight",
+        help="Maximum number of concurrent requests to PDB.",
+        type=int,
+        default=2)
     parser.add_argument(
         "--p2rank-version",
         help="Used p2rank version.")
@@ -60,6 +72,33 @@ def _read_arguments() -> typing.Dict[str, str]:
              "managed by the synchronization.",
         type=int,
         default=4)
+    parser.add_argument(
+        "--max-in-flight",
+        help="Maximum number of concurrent requests to prankweb server.",
+        type=int,
+        default=4)
+    parser.add_argument(
+        "--request-rate",
+        help="Initial number of requests per second to prankweb server, "
+             "the rate adapts to the server load.",
+        type=float,
+        default=2.0)
+    parser.add_argument(
+        "--parallel",
+        help="Number of processes used to prepare FunPDBe files.",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--rescan-funpdbe",
+        help="Check all converted records and regenerate FunPDBe files "
+             "of those with changed prediction.",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--skip-json-export",
+        help="Do not export the database to index.json file.",
+        action="store_true",
+        default=False)
     parser.add_argument(
         "--json-report-file",
         help="Path to JSON report file.")
@@ -70,36 +109,43 @@ def main(args):
     _init_logging()
     data_directory = args["data"]
     os.makedirs(data_directory, exist_ok=True)
-    database = database_service.load_database(data_directory)
+    database = database_service.open_database(data_directory)
+    from_date = args["from"]
+    if from_date is None:
+        from_date = select_default_from_date(database)
     if args["check_pdb"]:
-        logger.info(f"Fetching PDB records from '{args['from']} ...")
-        new_pdb_records = pdb_service.get_deposited_from(args["from"])
-        logger.info(f"Found {len(new_pdb_records)} new records.")
-        logger.debug("New records: " + ",".join(
-            [record.code for record in new_pdb_records]))
-        add_pdb_to_database(database, new_pdb_records)
-        database_service.save_database(data_directory, database)
+        logger.info(f"Fetching PDB records from '{from_date} ...")
+        harvest_pdb_records(
+            database, from_date, args["pdb_max_in_flight"])
     if args["retry_prankweb"]:
-        counter = change_prankweb_failed_to_new(database)
-        database_service.save_database(data_directory, database)
+        with database:
+            counter = change_prankweb_failed_to_new(database)
         logger.info(f"Reverted {counter} prankweb failed tasks.")
     if args["retry_funpdbe"]:
-        counter = change_funpdbe_failed_to_predicted(database)
-        database_service.save_database(data_directory, database)
+        with database:
+            counter = change_funpdbe_failed_to_predicted(database)
         logger.info(f"Reverted {counter} FunPDBe failed tasks.")
     logger.info("Synchronizing with prankweb server ...")
-    prankweb_service.initialize(args["server"], args["server_directory"])
-    synchronize_prankweb_with_database(database, args["queue_limit"])
-    database["pdb"]["lastSynchronization"] = args["from"]
-    database_service.save_database(data_directory, database)
+    prankweb_service.initialize(
+        args["server"], args["server_directory"],
+        args["max_in_flight"], args["request_rate"])
+    with database:
+        synchronize_prankweb_with_database(database, args["queue_limit"])
+        pdb = database_service.get_section(database, "pdb")
+        pdb["lastSynchronization"] = from_date
+        database_service.set_section(database, "pdb", pdb)
     logger.info("Preparing predictions for FunPDBe ...")
     try:
-        prepare_funpdbe_files(args["p2rank_version"], data_directory, database)
+        prepare_funpdbe_files(
+            args["p2rank_version"], data_directory, database,
+            args["parallel"], args["rescan_funpdbe"])
     except:
-        database_service.save_database(data_directory, database)
         logger.info("Can't prepare functional PDBe files.")
-    database_service.save_database(data_directory, database)
+    database.commit()
+    if not args["skip_json_export"]:
+        database_service.export_json(database, data_directory)
     log_status_count(database)
+    database.close()
     if args["json_report_file"]:
         report.synchronize_report(args["json_report_file"])
     logger.info("All done")
@@ -118,78 +164,126 @@ def _init_logging():
     logging.getLogger().addHandler(handler)
 
 
+def select_default_from_date(database) -> str:
+    """Return date of an interrupted harvest, so it is resumed. Otherwise
+    return start of the day a week ago, so runs on the same day share
+    the date."""
+    cursor = database_service.get_section(database, "pdbHarvest")
+    if "from" in cursor:
+        return cursor["from"]
+    from_date = datetime.date.today() - datetime.timedelta(weeks=1)
+    return from_date.strftime("%Y-%m-%dT00:00:00Z")
+
+
+def harvest_pdb_records(database, from_date: str, max_in_flight: int):
+    """Add records released from given date to database. Fetched pages
+    are stored in the database with the records, so an interrupted
+    harvest with the same date continues where it stopped."""
+    cursor = database_service.get_section(database, "pdbHarvest")
+    if cursor.get("from", None) != from_date:
+        cursor = {"from": from_date, "completed": []}
+    counter = 0
+
+    def on_page(offset: int, records: typing.List[pdb_service.PdbRecord]):
+        nonlocal counter
+        counter += len(records)
+        logger.debug("New records: " + ",".join(
+            [record.code for record in records]))
+        with database:
+            add_pdb_to_database(database, records)
+            cursor["completed"].append(offset)
+            database_service.set_section(database, "pdbHarvest", cursor)
+
+    finished = pdb_service.harvest_deposited_from(
+        from_date, set(cursor["completed"]), on_page, max_in_flight)
+    logger.info(f"Found {counter} new records.")
+    if finished:
+        with database:
+            database_service.set_section(database, "pdbHarvest", {})
+
+
 def add_pdb_to_database(
         database, new_records: typing.List[pdb_service.PdbRecord]):
     """Add given records to database as new records."""
     from_date = datetime.datetime.today().strftime("%Y-%m-%dT%H:%M:%SZ")
     added_records = []
     for record in new_records:
-        if record.code in database["data"]:
-            continue
-        database["data"][record.code] = {
+        added = database_service.insert_record(database, record.code, {
             "status": EntryStatus.NEW.value,
             "createDate": from_date,
             "pdbReleaseDate": record.release,
-        }
-        added_records.append(record.code)
+        })
+        if added:
+            added_records.append(record.code)
     report.on_new_pdb_records(added_records)
 
 
 def change_prankweb_failed_to_new(database):
     """Prepare failed predictions for re-run."""
-    result = 0
-    for code, record in database["data"].items():
-        if record["status"] == EntryStatus.PRANKWEB_FAILED.value:
-            record["status"] = EntryStatus.NEW.value
-    return result
+    return database_service.change_status(
+        database, EntryStatus.PRANKWEB_FAILED, EntryStatus.NEW)
 
 
 def change_funpdbe_failed_to_predicted(database):
     """Prepare failed funPDBe conversions for re-run."""
-    result = 0
-    for code, record in database["data"].items():
-        if record["status"] == EntryStatus.FUNPDBE_FAILED.value:
-            record["status"] = EntryStatus.PREDICTED.value
-    return result
+    return database_service.change_status(
+        database, EntryStatus.FUNPDBE_FAILED, EntryStatus.PREDICTED)
 
 
 def synchronize_prankweb_with_database(database, queue_limit):
     """Synchronize database with prankweb."""
     # Check those that we track as queued.
     logger.info("Checking queued ...")
+    queued = database_service.list_records(
+        database, EntryStatus.PRANKWEB_QUEUED)
+    responses = prankweb_service.retrieve_info_batch(
+        [code for code, _ in queued])
     queued_count = 0
-    for code, record in database["data"].items():
-        if record["status"] == EntryStatus.PRANKWEB_QUEUED.value:
-            request_computation_from_prankweb_for_code(code, record)
+    for code, record in queued:
+        update_record_from_prankweb_response(code, record, responses[code])
+        database_service.update_record(database, code, record)
         if record["status"] == EntryStatus.PRANKWEB_QUEUED.value:
             queued_count += 1
     logger.info(f"Queued count: {queued_count}")
     # Start new predictions, so the queued size is under given limit.
-    for code, record in database["data"].items():
-        if queued_count >= queue_limit:
-            break
-        if record["status"] == EntryStatus.NEW.value:
-            request_computation_from_prankweb_for_code(code, record)
-        if record["status"] == EntryStatus.PRANKWEB_QUEUED.value:
-            queued_count += 1
-            logger.info(f"Started new prediction: '{code}'")
-
-
-def request_computation_from_prankweb_for_code(code: str, record):
-    """Request computation or check for status."""
-    response = prankweb_service.retrieve_info(code)
+    # Some of them may be already computed, so we request them in rounds.
+    new_records = database_service.list_records(database, EntryStatus.NEW)
+    while queued_count < queue_limit and new_records:
+        records = new_records[:queue_limit - queued_count]
+        new_records = new_records[len(records):]
+        responses = prankweb_service.retrieve_info_concurrent(
+            [code for code, _ in records])
+        # Responses are applied in the order of the database.
+        for code, record in records:
+            update_record_from_prankweb_response(code, record, responses[code])
+            database_service.update_record(database, code, record)
+            if record["status"] == EntryStatus.PRANKWEB_QUEUED.value:
+                queued_count += 1
+                logger.info(f"Started new prediction: '{code}'")
+
+
+def update_record_from_prankweb_response(
+        code: str, record, response: prankweb_service.PrankWebResponse):
+    """Update record status using response from prankweb."""
     if response.status == -1:
         # This indicates error with the connection.
         logging.warning(f"Can't connect to server to check '{code}'.")
         return
+    if response.status == 429:
+        # Server is busy, we try again in the next run.
+        logging.warning(f"Server is busy, can't check '{code}'.")
+        return
     if not 199 < response.status < 299:
         record["status"] = EntryStatus.PRANKWEB_FAILED.value
         logger.warning(
             f"Request failed for '{code}' {response.status}\n   {response.body}")
         return
-    # Make the time same as for the rest of the application.
-    record["prankwebCreatedDate"] = response.body["created"] + "Z"
-    record["prankwebCheckDate"] = response.body["lastChange"] + "Z"
+    # Make the time same as for the rest of the application. There are no
+    # times for a prediction that is just being created.
+    if response.body.get("created", None) is not None:
+        record["prankwebCreatedDate"] = response.body["created"] + "Z"
+    if response.body.get("lastChange", None) is not None:
+        record["prankwebCheckDate"] = response.body["lastChange"] + "Z"
     if response.body["status"] == "successful":
         record["status"] = EntryStatus.PREDICTED.value
         report.on_prediction_finished(code)
@@ -207,110 +301,275 @@ def request_computation_from_prankweb_for_code(code: str, record):
                  f" due to response '{response.body['status']}'")
 
 
-def prepare_funpdbe_files(p2rank_version: str, data_directory: str, database):
+def prepare_funpdbe_files(
+        p2rank_version: str, data_directory: str, database,
+        parallel: int = 1, rescan: bool = False):
+    """Convert predicted structures into funPDBe records using given
+    number of processes. Workers only convert the files, the statuses
+    and the report are updated here as the results arrive.
+    Converted records are converted again when they were converted by
+    other version of p2rank or the converter. With rescan all converted
+    records are checked, and converted again if their prediction changed."""
     ftp_directory = get_ftp_directory(data_directory)
     os.makedirs(ftp_directory, exist_ok=True)
-    configuration = funpdbe_configuration(p2rank_version)
+    configuration = funpdbe_configuration(p2rank_version, data_directory)
     os.makedirs(os.path.join(data_directory, "working"), exist_ok=True)
-    for code, record in database["data"].items():
-        prepare_funpdbe_file(
-            ftp_directory, data_directory, configuration, code, record)
+    records = database_service.list_records(database, EntryStatus.PREDICTED)
+    version = funpdbe_version(configuration)
+    outdated = [
+        (code, record) for code, record in
+        database_service.list_records(database, EntryStatus.CONVERTED)
+        if rescan or _is_funpdbe_outdated(record, version)
+    ]
+    logger.info(f"Checking {len(outdated)} converted records.")
+    records.extend(outdated)
+    tasks = [
+        (ftp_directory, data_directory, configuration, code,
+         record.get("funpdbeFingerprint", None))
+        for code, record in records
+    ]
+    if parallel > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=parallel,
+            initializer=_init_funpdbe_worker,
+            initargs=prankweb_service.get_settings())
+        results = executor.map(_prepare_funpdbe_task, tasks)
+    else:
+        executor = None
+        results = map(_prepare_funpdbe_task, tasks)
+    changes = collections.Counter()
+    validations = collections.Counter()
+    validation_time = 0.0
+    start = time.perf_counter()
+    try:
+        for (code, record), result in zip(records, results):
+            if result.validation_time is not None:
+                validation_time += result.validation_time
+                validations[result.status == EntryStatus.CONVERTED] += 1
+            if result.change != FunPdbeChange.SKIPPED:
+                _on_funpdbe_status(code, result.status)
+            record["status"] = result.status.value
+            if result.status == EntryStatus.CONVERTED:
+                record["funpdbeFingerprint"] = result.fingerprint
+                record["funpdbeVersion"] = version
+            if result.change is not None:
+                changes[result.change] += 1
+            # Store every conversion, so an interruption does not lose them.
+            with database:
+                database_service.update_record(database, code, record)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        logger.info(
+            "FunPDBe files summary: "
+            f"new: {changes[FunPdbeChange.NEW]}, "
+            f"regenerated: {changes[FunPdbeChange.REGENERATED]}, "
+            f"skipped: {changes[FunPdbeChange.SKIPPED]}")
+        _log_validation_throughput(
+            validations[True], validations[False],
+            validation_time, time.perf_counter() - start)
+
+
+def _is_funpdbe_outdated(record, version: str) -> bool:
+    # Records converted before the version was stored are checked
+    # only on rescan, we do not know what they were converted with.
+    stored_version = record.get("funpdbeVersion", None)
+    return stored_version is not None and stored_version != version
+
+
+def _log_validation_throughput(
+        valid: int, invalid: int, validation_time: float,
+        elapsed_time: float):
+    """Validation time is summed over all processes, elapsed time is the
+    duration of the whole step."""
+    count = valid + invalid
+    if count == 0:
+        return
+    logger.info(
+        f"Validated {count} FunPDBe files, {invalid} invalid, "
+        f"in {validation_time:.1f} s, "
+        f"{count / max(validation_time, 1e-6):.2f} files/s, "
+        f"{validation_time / count * 1000:.0f} ms per file. "
+        f"Preparation of FunPDBe files took {elapsed_time:.1f} s.")
+
+
+def _init_funpdbe_worker(*settings):
+    # Settings are not inherited when processes are not forked.
+    prankweb_service.initialize(*settings)
+
+
+def _prepare_funpdbe_task(task) -> "FunPdbeResult":
+    return prepare_funpdbe_file(*task)
+
+
+def _on_funpdbe_status(code: str, status: EntryStatus):
+    if status == EntryStatus.CONVERTED:
+        report.on_funpdbe_conversion_finished(code)
+    elif status == EntryStatus.EMPTY:
+        report.on_funpdbe_conversion_empty(code)
+    elif status == EntryStatus.FUNPDBE_FAILED:
+        report.on_funpdbe_conversion_failed(code)
+
+
+class FunPdbeChange(enum.Enum):
+    # There was no FunPDBe file for the record.
+    NEW = "new"
+    # The file was created again as the prediction or conversion changed.
+    REGENERATED = "regenerated"
+    # The file was up to date.
+    SKIPPED = "skipped"
+
+
+class FunPdbeResult(typing.NamedTuple):
+    status: EntryStatus
+    # Fingerprint of the conversion input, see funpdbe_fingerprint.
+    fingerprint: typing.Optional[str] = None
+    # None when there is no FunPDBe file.
+    change: typing.Optional[FunPdbeChange] = None
+    # Time spent validating the FunPDBe file, in seconds,
+    # None when the file was not validated.
+    validation_time: typing.Optional[float] = None
 
 
 def prepare_funpdbe_file(
         ftp_directory: str, data_directory: str,
         configuration: p2rank_to_funpdbe.Configuration,
-        code: str, record):
-    """Convert predicted structure into funPDBe record."""
-    if not record["status"] == EntryStatus.PREDICTED.value:
-        return
+        code: str, fingerprint: typing.Optional[str] = None) \
+        -> FunPdbeResult:
+    """Convert predicted structure into funPDBe record, return new status
+    of the record. The conversion is skipped when the fingerprint of the
+    last conversion is the same and the file exists."""
     working_directory = os.path.join(data_directory, "working", code)
     os.makedirs(working_directory, exist_ok=True)
-    predictions_file, residues_file = retrieve_prediction_files(
-        working_directory, code)
-    if residues_file is None or residues_file is None:
+    zip_path = retrieve_archive(working_directory, code)
+    if zip_path is None:
         logger.error(f"Can't obtain prediction files for {code}, "
                      f"record ignored.")
-        record["status"] = EntryStatus.FUNPDBE_FAILED.value
-        report.on_funpdbe_conversion_failed(code)
-        return
+        return FunPdbeResult(EntryStatus.FUNPDBE_FAILED)
+    target_directory = os.path.join(ftp_directory, code.lower()[1:3])
+    target_output = os.path.join(target_directory, f"{code.lower()}.json")
+    target_exists = os.path.exists(target_output)
+    digest = archive_digest(zip_path)
+    new_fingerprint = funpdbe_fingerprint(configuration, digest)
+    if target_exists and new_fingerprint == fingerprint:
+        shutil.rmtree(working_directory)
+        logger.debug(f"FunPDBe file for '{code}' is up to date.")
+        return FunPdbeResult(
+            EntryStatus.CONVERTED, new_fingerprint, FunPdbeChange.SKIPPED)
     working_output = os.path.join(working_directory, f"{code.lower()}.json")
     error_log_file = os.path.join(working_directory, "error.log")
     # Check for missing files.
-    if not os.path.exists(predictions_file) or \
-            not os.path.exists(residues_file):
+    predictions_file, residues_file = find_prediction_files(zip_path)
+    if predictions_file is None or residues_file is None:
         logger.error(f"Missing files for '{code}'.")
         with open(error_log_file, "w") as stream:
             stream.write(
-                f"Missing files '{predictions_file}', '{residues_file}")
-        record["status"] = EntryStatus.FUNPDBE_FAILED.value
-        report.on_funpdbe_conversion_failed(code)
-        return
-    # Try conversion.
+                f"Missing files '{predictions_file}', '{residues_file}' "
+                f"in '{zip_path}'")
+        return FunPdbeResult(EntryStatus.FUNPDBE_FAILED)
+    # Validate residues against the structure, if we can get it.
+    # The structure is the same as long as the prediction is the same.
+    residue_listing = residue_service.get_residue_listing(
+        get_residues_directory(data_directory), working_directory, code,
+        digest)
+    # Try conversion, files are read directly from the archive.
     try:
-        p2rank_to_funpdbe.convert_p2rank_to_pdbe(
-            configuration, code, predictions_file, residues_file,
-            working_output)
-        record["status"] = EntryStatus.CONVERTED.value
+        with zipfile.ZipFile(zip_path, "r") as zip_file, \
+                _open_zip_text(zip_file, predictions_file) as predictions, \
+                _open_zip_text(zip_file, residues_file) as residues:
+            validation_time = p2rank_to_funpdbe.convert_p2rank_to_pdbe(
+                configuration, code, predictions, residues,
+                working_output, residue_listing)
     except p2rank_to_funpdbe.EmptyPrediction:
         logger.error(f"Empty prediction for {code}, record ignored.")
-        record["status"] = EntryStatus.EMPTY.value
-        report.on_funpdbe_conversion_empty(code)
-        return
+        return FunPdbeResult(EntryStatus.EMPTY)
     except Exception as ex:
         logger.exception(f"Can't convert {code} to FunPDBe record.")
         with open(error_log_file, "w") as stream:
             stream.write(str(ex))
-        record["status"] = EntryStatus.FUNPDBE_FAILED.value
-        report.on_funpdbe_conversion_failed(code)
-        return
-    target_directory = os.path.join(ftp_directory, code.lower()[1:3])
+        validation_time = None
+        if isinstance(ex, p2rank_to_funpdbe.ValidationFailed):
+            validation_time = ex.validation_time
+        return FunPdbeResult(
+            EntryStatus.FUNPDBE_FAILED, validation_time=validation_time)
     os.makedirs(target_directory, exist_ok=True)
-    target_output = os.path.join(target_directory, f"{code.lower()}.json")
     shutil.move(working_output, target_output)
     shutil.rmtree(working_directory)
-    report.on_funpdbe_conversion_finished(code)
     logger.debug(f"Done processing '{code}'.")
+    change = FunPdbeChange.REGENERATED if target_exists else FunPdbeChange.NEW
+    return FunPdbeResult(
+        EntryStatus.CONVERTED, new_fingerprint, change, validation_time)
+
+
+def archive_digest(zip_path: str) -> str:
+    """Return digest of the prediction archive."""
+    digest = hashlib.sha256()
+    with open(zip_path, "rb") as stream:
+        while chunk := stream.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def funpdbe_fingerprint(
+        configuration: p2rank_to_funpdbe.Configuration, digest: str) -> str:
+    """Return fingerprint of everything the FunPDBe file is created from,
+    the digest is of the prediction archive, see archive_digest."""
+    content = {
+        "archive": digest,
+        "version": funpdbe_version(configuration),
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def funpdbe_version(configuration: p2rank_to_funpdbe.Configuration) -> str:
+    """Return version of p2rank and the converter, a change of any
+    of them requires new FunPDBe files."""
+    return f"{configuration.p2rank_version}/" \
+           f"{p2rank_to_funpdbe.CONVERTER_VERSION}"
 
 
 def get_ftp_directory(data_directory: str):
     return os.path.join(data_directory, "ftp")
 
 
-def retrieve_prediction_files(working_directory: str, code: str):
-    zip_path = retrieve_archive(working_directory, code)
-    if zip_path is None:
+def get_residues_directory(data_directory: str):
+    return os.path.join(data_directory, "residues")
+
+
+def find_prediction_files(zip_path: str) \
+        -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+    """Return names of predictions and residues files in the archive."""
+    try:
+        with zipfile.ZipFile(zip_path, "r") as zip_file:
+            names = set(zip_file.namelist())
+    except zipfile.BadZipFile:
+        logger.exception(f"Invalid archive '{zip_path}'.")
         return None, None
-    unpack_from_zip(
-        zip_path,
-        # We may have pdb or cif file.
-        {"structure.pdb_predictions.csv", "structure.pdb_residues.csv",
-         "structure.cif_predictions.csv", "structure.cif_residues.csv"},
-        working_directory
-    )
+    # We may have pdb or cif file, cif is preferred.
     predictions_file = None
-    predictions_pdb_file = os.path.join(
-        working_directory, "structure.pdb_predictions.csv")
-    if os.path.exists(predictions_pdb_file):
-        predictions_file = predictions_pdb_file
-    predictions_cif_file = os.path.join(
-        working_directory, "structure.cif_predictions.csv")
-    if os.path.exists(predictions_cif_file):
-        predictions_file = predictions_cif_file
-
+    for name in ["structure.pdb_predictions.csv",
+                 "structure.cif_predictions.csv"]:
+        if name in names:
+            predictions_file = name
     residues_file = None
-    residues_pdb_file = os.path.join(
-        working_directory, "structure.pdb_residues.csv")
-    if os.path.exists(residues_pdb_file):
-        residues_file = residues_pdb_file
-    residues_cif_file = os.path.join(
-        working_directory, "structure.cif_residues.csv")
-    if os.path.exists(residues_cif_file):
-        residues_file = residues_cif_file
+    for name in ["structure.pdb_residues.csv",
+                 "structure.cif_residues.csv"]:
+        if name in names:
+            residues_file = name
     return predictions_file, residues_file
 
 
+def _open_zip_text(zip_file: zipfile.ZipFile, name: str) -> typing.TextIO:
+    return io.TextIOWrapper(zip_file.open(name, "r"), encoding="utf-8")
+
+
 def retrieve_archive(working_directory: str, code: str):
+    """Return path to the prediction archive. Archive in a local server
+    directory is used in place, otherwise it is retrieved."""
+    local_path = prankweb_service.get_local_file(code, "prankweb.zip")
+    if local_path is not None:
+        return local_path
     download_path = os.path.join(working_directory, f"{code}.zip")
     try:
         prankweb_service.retrieve_archive(code, download_path)
@@ -320,30 +579,22 @@ def retrieve_archive(working_directory: str, code: str):
         return None
 
 
-def unpack_from_zip(zip_path: str, extract: typing.Set[str], destination: str):
-    with zipfile.ZipFile(zip_path, "r") as zip_file:
-        for file_name in zip_file.namelist():
-            if file_name not in extract:
-                continue
-            zip_file.extract(file_name, destination)
-
-
-def funpdbe_configuration(p2rank_version: str) \
+def funpdbe_configuration(p2rank_version: str, data_directory: str) \
         -> p2rank_to_funpdbe.Configuration:
     return p2rank_to_funpdbe.Configuration(
         "p2rank",
         "3.0",
         datetime.date.today().strftime("%d/%m/%Y"),
         prankweb_service.prediction_url_template(),
-        p2rank_version
+        p2rank_version,
+        os.path.join(data_directory, "funpdbe-schema.json")
     )
 
 
 def log_status_count(database):
     """Count and log the number of predictions for each type."""
     count_by_status = collections.defaultdict(int)
-    for code, record in database["data"].items():
-        count_by_status[record["status"]] += 1
+    count_by_status.update(database_service.count_by_status(database))
     message = "\n".join(
         [f"    {name}: {value}" for name, value in count_by_status.items()])
     report.on_counts(count_by_status)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import sqlite3
 import datetime
 import typing
 import argparse
@@ -17,6 +18,10 @@ def _read_arguments() -> typing.Dict[str, str]:
     parser.add_argument(
         "--prankweb-directory",
         help="Path to prankweb prediction directory to import.")
+    parser.add_argument(
+        "--prediction-index",
+        help="Path to prankweb prediction index, when set the codes from "
+             "the prediction directory are read from the index.")
     parser.add_argument(
         "--pdb-file",
         help="Path to file with PDB codes, each line with one code.")
@@ -31,14 +36,21 @@ def main(args):
     _init_logging()
     data_directory = args["data"]
     os.makedirs(data_directory, exist_ok=True)
-    database = database_service.load_database(data_directory)
+    database = database_service.open_database(data_directory)
     new_codes = []
-    if "server_directory" in args:
-        new_codes.extend(list_prankweb_predictions(args["server_directory"]))
-    if "pdb_file" in args:
+    if args["prankweb_directory"] is not None:
+        if args["prediction_index"] is not None:
+            new_codes.extend(list_indexed_predictions(
+                args["prediction_index"], args["prankweb_directory"]))
+        else:
+            new_codes.extend(
+                list_prankweb_predictions(args["prankweb_directory"]))
+    if args["pdb_file"] is not None:
         new_codes.extend(list_from_file(args["pdb_file"]))
-    add_pdb_to_database(database, new_codes)
-    database_service.save_database(data_directory, database)
+    with database:
+        add_pdb_to_database(database, new_codes)
+    database_service.export_json(database, data_directory)
+    database.close()
     logger.info("All done")
 
 
@@ -63,6 +75,23 @@ def list_prankweb_predictions(predictions_directory: str) -> typing.List[str]:
     ]
 
 
+def list_indexed_predictions(
+        index_path: str, predictions_directory: str) -> typing.List[str]:
+    # See executor-p2rank/prediction_index.py for the schema.
+    database = os.path.basename(os.path.normpath(predictions_directory))
+    connection = sqlite3.connect(index_path, timeout=30)
+    try:
+        return [
+            code.lower()
+            for (code,) in connection.execute(
+                "SELECT identifier FROM prediction WHERE database = ?",
+                (database,))
+            if "_" not in code
+        ]
+    finally:
+        connection.close()
+
+
 def list_from_file(path: str) -> typing.List[str]:
     with open(path, encoding="utf-8") as stream:
         return [
@@ -74,12 +103,10 @@ def list_from_file(path: str) -> typing.List[str]:
 def add_pdb_to_database(database, new_codes: typing.List[str]):
     from_date = datetime.datetime.today().strftime("%Y-%m-%dT%H:%M:%SZ")
     for code in new_codes:
-        if code in database["data"]:
-            continue
-        database["data"][code] = {
+        database_service.insert_record(database, code, {
             "status": EntryStatus.NEW.value,
             "importDate": from_date,
-        }
+        })
 
 
 if __name__ == "__main__":
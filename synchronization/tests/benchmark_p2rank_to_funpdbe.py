@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Compare the conversion to FunPDBe with the conversion that scanned all
+# residues for every pocket, on a generated structure with many chains.
+#
+#   python3 tests/benchmark_p2rank_to_funpdbe.py --chains 50
+#
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import p2rank_to_funpdbe  # noqa: E402
+from p2rank_to_funpdbe import ResidueRef  # noqa: E402
+
+AMINO_ACIDS = ["ALA", "GLY", "LEU", "SER", "VAL", "THR", "LYS", "ASP"]
+
+CONFIGURATION = p2rank_to_funpdbe.Configuration(
+    "p2rank", "3.0", "01/01/2024",
+    "https://prankweb.cz/analyze?database=v3&code={}", "2.4.2")
+
+
+def _read_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chains", type=int, default=50)
+    parser.add_argument("--residues-per-chain", type=int, default=400)
+    parser.add_argument("--pockets", type=int, default=300)
+    parser.add_argument("--pocket-size", type=int, default=40)
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+        predictions, residues = _generate_prediction(directory, arguments)
+        start = time.perf_counter()
+        reference = _convert_by_scanning(predictions, residues)
+        scanning_time = time.perf_counter() - start
+        start = time.perf_counter()
+        content = p2rank_to_funpdbe.create_funpdbe_content(
+            CONFIGURATION, "1abc", predictions, residues)
+        indexed_time = time.perf_counter() - start
+    print(f"Scanning residues: {scanning_time:.2f} s")
+    print(f"Indexed residues:  {indexed_time:.2f} s")
+    print(f"Identical output:  {content == reference}")
+    return 0 if content == reference else 1
+
+
+def _generate_prediction(directory: str, arguments):
+    residues = [
+        (chain, str(label), random.choice(AMINO_ACIDS))
+        for chain in _chain_names(arguments["chains"])
+        for label in range(1, arguments["residues_per_chain"] + 1)
+    ]
+    predictions_path = os.path.join(directory, "predictions.csv")
+    with open(predictions_path, "w") as stream:
+        stream.write("name, rank, score, center_x, center_y, center_z, "
+                     "residue_ids, surf_atom_ids\n")
+        for index in range(1, arguments["pockets"] + 1):
+            members = random.sample(residues, arguments["pocket_size"])
+            residue_ids = " ".join(f"{chain}_{label}"
+                                   for chain, label, _ in members)
+            stream.write(f"pocket{index}, {index}, {100 / index:.2f}, "
+                         f"1.0, 2.0, 3.0, {residue_ids}, 1 2 3\n")
+    residues_path = os.path.join(directory, "residues.csv")
+    with open(residues_path, "w") as stream:
+        stream.write("chain, residue_label, residue_name, score, zscore, "
+                     "probability, pocket\n")
+        for chain, label, name in residues:
+            score = random.uniform(0, 3)
+            stream.write(f"{chain}, {label}, {name}, {score:.4f}, 0.0, "
+                         f"{score / 3:.3f}, 0\n")
+    return predictions_path, residues_path
+
+
+def _chain_names(count: int):
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    names = list(letters) + [first + second
+                             for first in letters for second in letters]
+    return names[:count]
+
+
+def _convert_by_scanning(predictions_path: str, residues_path: str):
+    """Conversion before residues were indexed."""
+    with open(residues_path) as stream:
+        residues = p2rank_to_funpdbe._read_residues(stream)
+    with open(predictions_path) as stream:
+        pockets = p2rank_to_funpdbe._read_predictions(stream)
+    sites = []
+    chains_dictionary = {}
+    for pocket in pockets:
+        site = p2rank_to_funpdbe._create_site(pocket)
+        sites.append(site)
+        for residue in residues:
+            residue_ref = ResidueRef(residue["chains"], residue["label"])
+            if residue_ref in pocket["residues"]:
+                p2rank_to_funpdbe._add_residue_to_chains(
+                    p2rank_to_funpdbe._residue_to_site_data(
+                        residue, site["site_id"]),
+                    chains_dictionary)
+    chains = p2rank_to_funpdbe._flat_chains_dictionary(chains_dictionary)
+    return p2rank_to_funpdbe._create_output_file(
+        CONFIGURATION, "1abc", sites, chains)
+
+
+if __name__ == "__main__":
+    sys.exit(main(_read_arguments()))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts of the synchronization are imported as top-level modules.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
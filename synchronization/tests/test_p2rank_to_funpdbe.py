@@ -0,0 +1,34 @@
+import json
+import os
+
+import p2rank_to_funpdbe
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+CONFIGURATION = p2rank_to_funpdbe.Configuration(
+    "p2rank",
+    "3.0",
+    "01/01/2024",
+    "https://prankweb.cz/analyze?database=v3&code={}",
+    "2.4.2")
+
+
+def test_conversion_matches_golden_file():
+    # The golden file was created by the converter before residues were
+    # indexed, it scanned all residues for every pocket.
+    content = p2rank_to_funpdbe.create_funpdbe_content(
+        CONFIGURATION, "1abc",
+        os.path.join(FIXTURES, "1abc_predictions.csv"),
+        os.path.join(FIXTURES, "1abc_residues.csv"))
+    with open(os.path.join(FIXTURES, "1abc_funpdbe.json")) as stream:
+        expected = stream.read()
+    assert json.dumps(content, indent=2) == expected
+
+
+def test_conversion_reads_streams():
+    with open(os.path.join(FIXTURES, "1abc_predictions.csv")) as predictions, \
+            open(os.path.join(FIXTURES, "1abc_residues.csv")) as residues:
+        content = p2rank_to_funpdbe.create_funpdbe_content(
+            CONFIGURATION, "1abc", predictions, residues)
+    with open(os.path.join(FIXTURES, "1abc_funpdbe.json")) as stream:
+        assert content == json.load(stream)
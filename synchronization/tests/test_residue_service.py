@@ -0,0 +1,64 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+
+import p2rank_to_funpdbe
+import prankweb_service
+import residue_service
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+STRUCTURE = os.path.join(FIXTURES, "1abc_structure.cif")
+
+
+def _expected_listing() -> dict:
+    result = {}
+    with open(os.path.join(FIXTURES, "1abc_residues.csv")) as stream:
+        for row in list(csv.reader(stream))[1:]:
+            chain, label, name = [value.strip() for value in row[:3]]
+            result.setdefault(chain, {})[label] = name
+    result["A"]["101A"] = "HOH"
+    return result
+
+
+def test_read_mmcif_residues():
+    # Text fields in the file contain lines looking like mmCIF syntax.
+    assert residue_service.read_mmcif_residues(STRUCTURE) == \
+           _expected_listing()
+
+
+def test_read_gzipped_mmcif_residues(tmp_path):
+    path = str(tmp_path / "structure.cif.gz")
+    with open(STRUCTURE, "rb") as source, gzip.open(path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    assert residue_service.read_mmcif_residues(path) == _expected_listing()
+
+
+def test_listing_validates_funpdbe_file():
+    with open(os.path.join(FIXTURES, "1abc_funpdbe.json")) as stream:
+        content = json.load(stream)
+    residue_indexes = p2rank_to_funpdbe.ListingResidueIndexes(
+        content, residue_service.read_mmcif_residues(STRUCTURE))
+    assert residue_indexes.check_every_residue()
+    assert residue_indexes.mismatches == []
+
+
+def test_cached_listing_is_used_for_same_fingerprint(tmp_path, monkeypatch):
+    structure = str(tmp_path / "structure.cif")
+    shutil.copy(STRUCTURE, structure)
+    monkeypatch.setattr(
+        prankweb_service, "get_local_file", lambda code, name: structure)
+    cache = str(tmp_path / "residues")
+    first = residue_service.get_residue_listing(
+        cache, str(tmp_path), "1abc", "first")
+    assert first == _expected_listing()
+    # The cache is used, so the changed structure is not read.
+    with open(structure, "w") as stream:
+        stream.write("data_1ABC\n")
+    assert residue_service.get_residue_listing(
+        cache, str(tmp_path), "1abc", "first") == first
+    # New prediction has a new structure.
+    assert residue_service.get_residue_listing(
+        cache, str(tmp_path), "1abc", "second") is None
@@ -0,0 +1,22 @@
+#
+# Gunicorn configuration, used to clean up metrics of worker processes.
+# See src/metrics.py for more details.
+#
+import os
+import shutil
+
+
+def on_starting(server):
+    # Remove metrics of the previous run.
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR", None)
+    if directory is None:
+        return
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
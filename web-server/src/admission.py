@@ -0,0 +1,210 @@
+#
+# Admission control for requests that queue work for executors.
+#
+# Every client has a token bucket per queue, submission of a task takes
+# tokens from the bucket. Clients are identified by an API key, when
+# a valid one is provided in the X-API-Key header, or by IP address.
+# The buckets are stored in SQLite, so they are shared by all workers.
+# In addition, no tasks are admitted when the queue is too long.
+#
+# The admission control is used only when PRANKWEB_ADMISSION_DB is set.
+#
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+import typing
+
+import flask
+
+from .celery_client import prankweb
+from . import metrics
+
+logger = logging.getLogger("prankweb.admission")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (
+  key TEXT PRIMARY KEY,
+  tokens REAL NOT NULL,
+  updated REAL NOT NULL
+);
+"""
+
+# Buckets of clients not seen for this many seconds are removed.
+BUCKET_EXPIRATION = 24 * 60 * 60
+
+# Probability of removing expired buckets during admission.
+BUCKET_CLEANUP_PROBABILITY = 0.001
+
+# Queue depth is read from the broker at most once per this many seconds.
+QUEUE_DEPTH_CACHE_TIME = 5
+
+_queue_depth_cache: typing.Dict[str, typing.Tuple[float, int]] = {}
+
+_queue_depth_lock = threading.Lock()
+
+
+class Limits(typing.NamedTuple):
+    # Maximum number of tokens in a bucket.
+    capacity: float
+    # Tokens added to a bucket per second.
+    refill: float
+
+
+def _get_limits(api_key: bool) -> Limits:
+    if api_key:
+        return Limits(
+            float(os.environ.get("PRANKWEB_API_KEY_RATE_CAPACITY", 600)),
+            float(os.environ.get("PRANKWEB_API_KEY_RATE_REFILL", 5)))
+    return Limits(
+        float(os.environ.get("PRANKWEB_RATE_CAPACITY", 30)),
+        float(os.environ.get("PRANKWEB_RATE_REFILL", 0.5)))
+
+
+def _get_api_keys() -> typing.Set[str]:
+    value = os.environ.get("PRANKWEB_API_KEYS", "")
+    return {key.strip() for key in value.split(",") if key.strip()}
+
+
+def admit(queue: str, cost: int = 1):
+    """Return None if the client can submit given number of tasks
+    to the queue, else return 429 response.
+
+    A client with at least one token is admitted, even if the cost is
+    larger than the number of tokens. The bucket then goes into debt,
+    which the client must wait out before the next submission.
+    """
+    path = os.environ.get("PRANKWEB_ADMISSION_DB", None)
+    if path is None or cost <= 0:
+        return None
+    retry_after = _check_queue_depth(queue)
+    if retry_after is not None:
+        metrics.on_admission_rejected(queue, "queue")
+        return _too_many_requests(retry_after)
+    client, limits = _identify_client()
+    try:
+        retry_after = _take_tokens(
+            path, f"{queue}:{client}", limits, cost)
+    except sqlite3.Error:
+        # We rather admit the request than fail it.
+        logger.exception("Can't access admission database.")
+        return None
+    if retry_after is not None:
+        metrics.on_admission_rejected(queue, "client")
+        return _too_many_requests(retry_after)
+    return None
+
+
+def refund(queue: str, cost: int = 1):
+    """Return tokens taken by admit, use when the admitted request
+    did not submit the tasks."""
+    path = os.environ.get("PRANKWEB_ADMISSION_DB", None)
+    if path is None or cost <= 0:
+        return
+    client, limits = _identify_client()
+    try:
+        _return_tokens(path, f"{queue}:{client}", limits, cost)
+    except sqlite3.Error:
+        logger.exception("Can't access admission database.")
+
+
+def _too_many_requests(retry_after: float):
+    return "Too many requests, try again later.", 429, \
+        {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+def _identify_client() -> typing.Tuple[str, Limits]:
+    api_key = flask.request.headers.get("X-API-Key", None)
+    if api_key is not None and api_key in _get_api_keys():
+        return "key:" + api_key, _get_limits(True)
+    # The gateway provides address of the client.
+    address = flask.request.headers.get(
+        "X-Real-IP", flask.request.remote_addr)
+    return "ip:" + str(address), _get_limits(False)
+
+
+def _take_tokens(
+        path: str, key: str, limits: Limits,
+        cost: int) -> typing.Optional[float]:
+    """Return None if the tokens were taken, else seconds to wait."""
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        now = time.time()
+        # Lock the database, so the bucket is not changed by other worker.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM bucket WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                tokens = limits.capacity
+            else:
+                tokens = min(
+                    limits.capacity,
+                    row[0] + (now - row[1]) * limits.refill)
+            if tokens < 1:
+                connection.execute("ROLLBACK")
+                return (1 - tokens) / limits.refill
+            connection.execute(
+                "INSERT OR REPLACE INTO bucket (key, tokens, updated) "
+                "VALUES (?, ?, ?)", (key, tokens - cost, now))
+            if random.random() < BUCKET_CLEANUP_PROBABILITY:
+                connection.execute(
+                    "DELETE FROM bucket WHERE updated < ?",
+                    (now - BUCKET_EXPIRATION,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return None
+    finally:
+        connection.close()
+
+
+def _return_tokens(path: str, key: str, limits: Limits, cost: int):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        # The bucket is never filled over the capacity.
+        connection.execute(
+            "UPDATE bucket SET tokens = MIN(?, tokens + ?) WHERE key = ?",
+            (limits.capacity, cost, key))
+    finally:
+        connection.close()
+
+
+def _check_queue_depth(queue: str) -> typing.Optional[float]:
+    """Return None if the queue can accept more tasks,
+    else seconds to wait."""
+    max_depth = os.environ.get("PRANKWEB_MAX_QUEUE_DEPTH", None)
+    if max_depth is None:
+        return None
+    depth = _get_queue_depth(queue)
+    if depth is None or depth < int(max_depth):
+        return None
+    return float(os.environ.get("PRANKWEB_QUEUE_RETRY_AFTER", 60))
+
+
+def _get_queue_depth(queue: str) -> typing.Optional[int]:
+    """Return number of messages in the queue or None if not known."""
+    now = time.monotonic()
+    with _queue_depth_lock:
+        cached = _queue_depth_cache.get(queue, None)
+        if cached is not None and now - cached[0] < QUEUE_DEPTH_CACHE_TIME:
+            return cached[1]
+        try:
+            with prankweb.connection_for_read() as connection:
+                depth = connection.default_channel.queue_declare(
+                    queue=queue, passive=True).message_count
+        except Exception:
+            # For example the queue does not exist yet.
+            logger.exception(f"Can't read depth of queue '{queue}'.")
+            depth = None
+        _queue_depth_cache[queue] = (now, depth)
+        return depth
@@ -1,13 +1,23 @@
+import re
 import flask
 from flask import Blueprint, request
 from .database_v1 import register_database_v1
 from .database_v2 import register_database_v2
 from .database_v3 import register_database_v3
 
+from .database import POCKET_FIELDS
+from .celery_client import PREDICTION_QUEUE
+from . import admission
 from .docking_task import DockingTask
 
 api_v2 = Blueprint("api_v2", __name__)
 
+# Upper limit for waiting on a change, in seconds.
+MAX_INFO_WAIT = 30
+
+# Maximum number of predictions in one status request.
+MAX_STATUS_BATCH = 1000
+
 databases = {
     database.name(): database
     for database in [
@@ -24,9 +34,18 @@ databases = {
     methods=["GET"]
 )
 def route_get_info(database_name: str, prediction_name: str):
+    """Get prediction info.
+    With 'wait' and 'since' query parameters, the request blocks for up to
+    'wait' seconds until the lastChange of the prediction differs from
+    'since'."""
     database = databases.get(database_name, None)
     if database is None:
         return "", 404
+    wait = request.args.get("wait", 0, type=float)
+    since = request.args.get("since", None)
+    if wait > 0 and since is not None:
+        database.wait_for_info_change(
+            prediction_name.upper(), since, min(wait, MAX_INFO_WAIT))
     return database.get_info(prediction_name.upper())
 
 
@@ -38,7 +57,44 @@ def route_post(database_name: str):
     database = databases.get(database_name, None)
     if database is None:
         return "", 404
-    return database.create(flask.request.files)
+    # We check before the files are parsed, so we do not store them.
+    rejection = admission.admit(PREDICTION_QUEUE)
+    if rejection is not None:
+        return rejection
+    response = flask.make_response(database.create(flask.request.files))
+    if response.status_code != 201:
+        # Nothing was submitted, for example the database is read-only
+        # or the upload is invalid, so the client is not charged.
+        admission.refund(PREDICTION_QUEUE)
+    return response
+
+
+@api_v2.route(
+    "/prediction/<database_name>/status",
+    methods=["POST"]
+)
+def route_post_status(database_name: str):
+    """Get status of multiple predictions.
+    Request body should be a JSON object with the following fields:
+    - identifiers: list[str] (prediction identifiers)
+    - create: bool (optional, create missing predictions if possible)"""
+    database = databases.get(database_name, None)
+    if database is None:
+        return "", 404
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return "Request body must be a JSON object.", 400
+    identifiers = data.get("identifiers", None)
+    if not isinstance(identifiers, list) or \
+            not all(isinstance(item, str) for item in identifiers):
+        return "Field identifiers must be a list of strings.", 400
+    # Unlike URL path, the identifiers can contain any character.
+    if not all(re.fullmatch(r"[\-_,\w]+", item) for item in identifiers):
+        return "Invalid identifier.", 400
+    if len(identifiers) > MAX_STATUS_BATCH:
+        return f"At most {MAX_STATUS_BATCH} identifiers are allowed.", 400
+    identifiers = list(dict.fromkeys(item.upper() for item in identifiers))
+    return database.get_status(identifiers, bool(data.get("create", False)))
 
 
 @api_v2.route(
@@ -62,6 +118,32 @@ def route_get_file(database_name: str, prediction_name: str, file_name: str):
         return "", 404
     return database.get_file(prediction_name.upper(), file_name)
 
+
+@api_v2.route(
+    "/prediction/<database_name>/<prediction_name>/pockets",
+    methods=["GET"]
+)
+def route_get_pockets(database_name: str, prediction_name: str):
+    """Get slice of predicted pockets.
+    Query parameters:
+    - top: int (optional, number of pockets with the best rank)
+    - fields: str (optional, comma separated pocket fields)
+    - chains: str (optional, comma separated chains to include)"""
+    database = databases.get(database_name, None)
+    if database is None:
+        return "", 404
+    top = request.args.get("top", None, type=int)
+    if top is not None and top < 0:
+        return "Parameter top must not be negative.", 400
+    fields = request.args.get("fields", None)
+    fields = POCKET_FIELDS if fields is None else fields.split(",")
+    if not all(field in POCKET_FIELDS for field in fields):
+        return f"Fields must be from {', '.join(POCKET_FIELDS)}.", 400
+    chains = request.args.get("chains", None)
+    if chains is not None:
+        chains = chains.split(",")
+    return database.get_pockets(prediction_name.upper(), top, fields, chains)
+
 # docking routes
 
 @api_v2.route(
@@ -80,6 +162,22 @@ def route_post_docking_file(database_name: str, prediction_name: str):
     dt = DockingTask(database_name=database_name)
     return dt.post_task(prediction_name.upper(), data)
 
+@api_v2.route(
+    "/docking/<database_name>/<prediction_name>/batch",
+    methods=["POST"]
+)
+def route_post_docking_batch(database_name: str, prediction_name: str):
+    """Post a task docking multiple ligands to the server.
+    Request body should be a JSON object with the following fields:
+    - hash: str (a hash of the ligands with parameters)
+    - pocket: int (pocket number)
+    - ligands: list[str] (SMILES for the ligands)
+    - exhaustiveness: float (exhaustiveness value)
+    - bounding_box: dict (bounding box for the docking)"""
+    data = request.get_json(force=True) or {}
+    dt = DockingTask(database_name=database_name)
+    return dt.post_batch_task(prediction_name.upper(), data)
+
 @api_v2.route(
     "/docking/<database_name>/<prediction_name>/<task_hash>/public/<file_name>",
     methods=["GET"]
@@ -1,9 +1,12 @@
 from flask import Flask
-from .api_v2 import api_v2
+from .api_v2 import api_v2, databases
+from .upload import Request, get_max_request_size
+from . import metrics
 
 
 def create_app():
     app = Flask(__name__, static_folder=None)
+    app.request_class = Request
 
     @app.after_request
     def remove_header(response):
@@ -14,6 +17,7 @@ def create_app():
         del response.headers['content-disposition']
         return response
 
-    app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+    app.config['MAX_CONTENT_LENGTH'] = get_max_request_size()
     app.register_blueprint(api_v2, url_prefix="/api/v2/")
+    metrics.init_app(app, databases.keys())
     return app
@@ -1,13 +1,18 @@
 import os
 import celery
 
+PREDICTION_QUEUE = "p2rank"
+
+DOCKING_QUEUE = "docking"
+
 prankweb = celery.Celery("prankweb")
 
 prankweb.conf.update({
     "task_routes": {
         # the key is the name of the task, the value is the name of the queue
-        'prediction': 'p2rank',
-        'docking': 'docking',
+        'prediction': PREDICTION_QUEUE,
+        'docking': DOCKING_QUEUE,
+        'docking-batch': DOCKING_QUEUE,
     }
 })
 
@@ -32,3 +37,6 @@ def submit_directory_for_execution(directory):
 
 def submit_directory_for_docking(directory, taskId):
     prankweb.send_task("docking", args=[directory, taskId])
+
+def submit_directory_for_batch_docking(directory, taskId):
+    prankweb.send_task("docking-batch", args=[directory, taskId])
@@ -1,4 +1,6 @@
 #This file contains common structures and methods used by the web-server.
+import os
+import re
 
 extensions = {
     ".json": "application/json",
@@ -6,5 +8,24 @@ extensions = {
     ".zip": "application/zip"
 }
 
+# Identifiers of user uploads start with the creation date.
+_user_upload_shard_pattern = re.compile(r"(\d{4}-\d{2}-\d{2})-")
+
+
+def user_upload_directory(root: str, identifier: str) -> str:
+    """Return directory for a user-upload identifier.
+    Directories are sharded by the creation date, e.g.
+    '{root}/2024-01-31/2024-01-31-10-00-00-{uuid}'. Older predictions may
+    still be stored directly in the root directory."""
+    match = _user_upload_shard_pattern.match(identifier)
+    legacy = os.path.join(root, identifier)
+    if match is None:
+        return legacy
+    sharded = os.path.join(root, match.group(1), identifier)
+    if not os.path.exists(sharded) and os.path.exists(legacy):
+        return legacy
+    return sharded
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
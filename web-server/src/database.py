@@ -1,10 +1,41 @@
 import os
 import typing
 import re
+import time
 import flask
 import werkzeug.utils
 import abc
+import json
+import tempfile
+import itertools
+import gzip
+import urllib.parse
+import concurrent.futures
 from .commons import extensions
+from .file_watch import wait_for_file_change
+from . import metrics
+
+# Number of threads used to read info files for status of many predictions.
+STATUS_READ_THREADS = 16
+
+# Prediction directory without info file younger than this, in seconds,
+# is considered to be just created by another request.
+PENDING_CREATION_TIMEOUT = 60
+
+# Fields of info file included in status of many predictions.
+STATUS_FIELDS = ["id", "database", "created", "lastChange", "status"]
+
+# Content encodings with extension of precompressed files, by preference.
+PRECOMPRESSED_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Size of chunk when decompressing files for clients without gzip support.
+GZIP_CHUNK_SIZE = 64 * 1024
+
+# Pockets with one pocket per line, see executor-p2rank/output_prankweb.py .
+POCKETS_FILE = "pockets.jsonl"
+
+POCKET_FIELDS = [
+    "name", "rank", "score", "probability", "center", "residues", "surface"]
 
 
 class Database(metaclass=abc.ABCMeta):
@@ -19,6 +50,15 @@ class Database(metaclass=abc.ABCMeta):
     def get_info(self, identifier: str):
         ...
 
+    @abc.abstractmethod
+    def get_status(self, identifiers: typing.List[str], create: bool):
+        ...
+
+    @abc.abstractmethod
+    def wait_for_info_change(
+            self, identifier: str, since: str, timeout: float) -> None:
+        ...
+
     @abc.abstractmethod
     def get_log(self, identifier: str):
         ...
@@ -27,6 +67,13 @@ class Database(metaclass=abc.ABCMeta):
     def get_file(self, identifier: str, file_name: str):
         ...
 
+    @abc.abstractmethod
+    def get_pockets(
+            self, identifier: str, top: typing.Optional[int],
+            fields: typing.List[str],
+            chains: typing.Optional[typing.List[str]]):
+        ...
+
     @abc.abstractmethod
     def create(self, files):
         ...
@@ -44,6 +91,85 @@ class NestedReadOnlyDatabase(Database, metaclass=abc.ABCMeta):
             return "", 404
         return self._response_file(directory, "info.json")
 
+    def get_info_content(self, identifier: str) -> typing.Optional[dict]:
+        """Return content of the info file or None if there is none."""
+        directory = self._get_directory(identifier)
+        if directory is None:
+            return None
+        try:
+            with open(os.path.join(directory, "info.json"),
+                      encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return None
+
+    def create_from_identifier(self, identifier: str) -> typing.Optional[dict]:
+        """Create prediction for given identifier and return the info,
+        return None when this is not supported."""
+        return None
+
+    def _admit_creation(self, count: int):
+        """Return None if given number of predictions can be created,
+        else return a response rejecting the request."""
+        return None
+
+    def get_status(self, identifiers: typing.List[str], create: bool):
+        """Respond with status of multiple predictions."""
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=STATUS_READ_THREADS) as executor:
+            infos = list(executor.map(self.get_info_content, identifiers))
+        infos = [
+            info if info is not None else self._get_pending_info(identifier)
+            for identifier, info in zip(identifiers, infos)
+        ]
+        if create:
+            rejection = self._admit_creation(
+                sum(1 for info in infos if info is None))
+            if rejection is not None:
+                return rejection
+        result = {}
+        for identifier, info in zip(identifiers, infos):
+            if info is None and create:
+                info = self.create_from_identifier(identifier)
+            result[identifier] = _select_status_fields(info)
+        return flask.jsonify({"predictions": result})
+
+    def _get_pending_info(self, identifier: str) -> typing.Optional[dict]:
+        """Return info of a prediction that is being created by another
+        request, i.e. it has a directory but no info file yet."""
+        directory = self._get_directory(identifier)
+        if directory is None:
+            return None
+        try:
+            created = os.path.getmtime(directory)
+        except OSError:
+            return None
+        if time.time() - created > PENDING_CREATION_TIMEOUT:
+            return None
+        return {"id": identifier, "database": self.name(), "status": "queued"}
+
+    def wait_for_info_change(
+            self, identifier: str, since: str, timeout: float) -> None:
+        """Block till the info file has different lastChange than since,
+        is written to or timeout expires."""
+        directory = self._get_directory(identifier)
+        if directory is None or not os.path.isdir(directory):
+            return
+        info_path = os.path.join(directory, "info.json")
+
+        def is_changed(notified: bool) -> bool:
+            try:
+                with open(info_path, encoding="utf-8") as stream:
+                    info = json.load(stream)
+            except (OSError, ValueError):
+                # Missing or partially written file.
+                return False
+            # The lastChange has resolution of seconds, so we also react
+            # to any write of the file.
+            return notified or info.get("lastChange") != since
+
+        wait_for_file_change(directory, "info.json", timeout, is_changed)
+
     def get_log(self, identifier: str):
         directory = self._get_directory(identifier)
         if directory is None or not os.path.isdir(directory):
@@ -56,17 +182,36 @@ class NestedReadOnlyDatabase(Database, metaclass=abc.ABCMeta):
             return "", 404
         public_directory = os.path.join(directory, "public")
         file_name = self._secure_filename(file_name)
-        file_path = os.path.join(public_directory, file_name)
-        if os.path.isfile(file_path):
-            return self._response_file(public_directory, file_name)
-        gzip_file_name = file_name + ".gz"
-        gzip_path = os.path.join(public_directory, gzip_file_name)
-        if os.path.isfile(gzip_path):
-            return self._response_gzip_file(
-                public_directory,
-                file_name,
-                gzip_file_name)
-        return "", 404
+        response, variant = \
+            self._response_public_file(public_directory, file_name)
+        if response is None:
+            return "", 404
+        # The content depends on the Accept-Encoding.
+        response.vary.add("Accept-Encoding")
+        metrics.on_public_file(self.name(), variant, response.status_code)
+        return response
+
+    def get_pockets(
+            self, identifier: str, top: typing.Optional[int],
+            fields: typing.List[str],
+            chains: typing.Optional[typing.List[str]]):
+        """Respond with given fields of top pockets. When chains are given
+        only residues in the chains are included, pockets without
+        such residues are skipped."""
+        directory = self._get_directory(identifier)
+        if directory is None or not os.path.isdir(directory):
+            return "", 404
+        public_directory = os.path.join(directory, "public")
+        pockets_path = os.path.join(public_directory, POCKETS_FILE)
+        if os.path.isfile(pockets_path):
+            with open(pockets_path, encoding="utf-8") as stream:
+                return _response_pockets(
+                    (json.loads(line) for line in stream),
+                    top, fields, chains)
+        pockets = _create_pockets_file(public_directory)
+        if pockets is None:
+            return "", 404
+        return _response_pockets(iter(pockets), top, fields, chains)
 
     @staticmethod
     def _secure_filename(file_name: str) -> str:
@@ -83,14 +228,47 @@ class NestedReadOnlyDatabase(Database, metaclass=abc.ABCMeta):
         directory = identifier[1:3]
         return os.path.join(self.root, directory, identifier)
 
-    def _response_gzip_file(
-            self, directory: str, file_name: str, gzip_name: str,
-            mimetype=None):
-        if mimetype is None:
-            mimetype = self._mime_type(file_name)
-        response = flask.send_from_directory(
-            directory, gzip_name, mimetype=mimetype)
-        response.headers["Content-Encoding"] = "gzip"
+    def _response_public_file(self, directory: str, file_name: str) \
+            -> typing.Tuple[typing.Optional[flask.Response], str]:
+        """Respond with the best variant of the file the client accepts,
+        return response and name of the variant. Response is None
+        if there is no variant of the file."""
+        mimetype = self._mime_type(file_name)
+        for encoding, extension in PRECOMPRESSED_ENCODINGS:
+            if flask.request.accept_encodings[encoding] <= 0:
+                continue
+            if os.path.isfile(os.path.join(directory, file_name + extension)):
+                return self._send_public_file(
+                    directory, file_name + extension, mimetype,
+                    encoding), encoding
+        if os.path.isfile(os.path.join(directory, file_name)):
+            return self._send_public_file(
+                directory, file_name, mimetype, None), "identity"
+        # Files like structure are stored only compressed.
+        gzip_path = os.path.join(directory, file_name + ".gz")
+        if os.path.isfile(gzip_path):
+            return flask.Response(
+                _read_gzip_file(gzip_path), mimetype=mimetype), "decompressed"
+        return None, "missing"
+
+    def _send_public_file(
+            self, directory: str, file_name: str, mimetype: str,
+            encoding: typing.Optional[str]):
+        """Send the file, or let the gateway send it when configured.
+        In both cases conditional and range requests are supported."""
+        accel_prefix = os.environ.get("PRANKWEB_ACCEL_REDIRECT", None)
+        if accel_prefix is None:
+            response = flask.send_from_directory(
+                directory, file_name, mimetype=mimetype)
+        else:
+            path = os.path.relpath(
+                os.path.join(directory, file_name),
+                self._get_database_directory())
+            response = flask.Response(mimetype=mimetype)
+            response.headers["X-Accel-Redirect"] = \
+                accel_prefix.rstrip("/") + "/" + urllib.parse.quote(path)
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
         return response
 
     def _response_file(self, directory: str, file_name: str, mimetype=None):
@@ -112,6 +290,71 @@ class NestedReadOnlyDatabase(Database, metaclass=abc.ABCMeta):
         return get_database_directory()
 
 
+def _select_status_fields(info: typing.Optional[dict]) \
+        -> typing.Optional[dict]:
+    if info is None:
+        return None
+    return {key: info.get(key, None) for key in STATUS_FIELDS}
+
+
+def _read_gzip_file(path: str) -> typing.Iterator[bytes]:
+    with gzip.open(path, "rb") as stream:
+        while chunk := stream.read(GZIP_CHUNK_SIZE):
+            yield chunk
+
+
+def _response_pockets(
+        pockets: typing.Iterator[dict], top: typing.Optional[int],
+        fields: typing.List[str], chains: typing.Optional[typing.List[str]]):
+    if chains is not None:
+        pockets = (
+            pocket for pocket in
+            (_filter_pocket_chains(pocket, chains) for pocket in pockets)
+            if pocket["residues"]
+        )
+    # As pockets are sorted by rank, we read only what we need.
+    result = [
+        {key: pocket[key] for key in fields if key in pocket}
+        for pocket in itertools.islice(pockets, top)
+    ]
+    return flask.jsonify({"pockets": result})
+
+
+def _filter_pocket_chains(pocket: dict, chains: typing.List[str]) -> dict:
+    # Residues are stored as '{chain}_{number}'.
+    return {
+        **pocket,
+        "residues": [
+            residue for residue in pocket.get("residues", [])
+            if residue.split("_", 1)[0] in chains
+        ],
+    }
+
+
+def _create_pockets_file(public_directory: str) \
+        -> typing.Optional[typing.List[dict]]:
+    """Create pockets file for predictions computed before it was
+    introduced and return the pockets, return None for no prediction."""
+    prediction_path = os.path.join(public_directory, "prediction.json")
+    try:
+        with open(prediction_path, encoding="utf-8") as stream:
+            pockets = json.load(stream)["pockets"]
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        descriptor, swap_path = tempfile.mkstemp(
+            dir=public_directory, suffix=".swp")
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            for pocket in pockets:
+                stream.write(json.dumps(pocket, separators=(",", ":")))
+                stream.write("\n")
+        os.replace(swap_path, os.path.join(public_directory, POCKETS_FILE))
+    except OSError:
+        # The file is only an optimization, we can do without it.
+        pass
+    return pockets
+
+
 def get_database_directory() -> str:
     dc = os.environ.get(
         "PRANKWEB_DATA_PREDICTIONS",
@@ -1,4 +1,6 @@
 import os
+import sys
+import abc
 import datetime
 import json
 import typing
@@ -7,8 +9,35 @@ import dataclasses
 import time
 import uuid
 import re
+import hashlib
+from werkzeug.datastructures import FileStorage
 from .database import Database, NestedReadOnlyDatabase
-from .celery_client import submit_directory_for_execution
+from .celery_client import submit_directory_for_execution, PREDICTION_QUEUE
+from .upload import StagedUpload
+from .commons import user_upload_directory
+from . import admission
+from . import metrics
+
+try:
+    # The module is shared with executor-p2rank, see web-server/Dockerfile.
+    import prediction_index
+except ImportError:
+    # Outside of Docker, use the module from the repository.
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..", "..", "executor-p2rank"))
+    import prediction_index
+
+
+# How long to wait for another request to initialize a prediction,
+# in seconds.
+CREATE_CONFLICT_WAIT = 1.0
+
+# Directory, in user-upload database, with index of predictions by content.
+CONTENT_INDEX_DIRECTORY = ".content-index"
+
+# File in prediction directory with the content key.
+CONTENT_KEY_FILE = "content-key"
 
 
 @dataclasses.dataclass
@@ -37,7 +66,55 @@ class Prediction:
     chains: typing.Optional[list[str]] = None
 
 
-class DatabaseV3(NestedReadOnlyDatabase):
+class OnDemandDatabase(NestedReadOnlyDatabase, metaclass=abc.ABCMeta):
+    """Database where a missing prediction is created on the first request."""
+
+    def get_info(self, identifier: str):
+        directory = self._get_directory(identifier)
+        if directory is None:
+            return "", 404
+        if os.path.exists(directory):
+            return self._response_file(directory, "info.json")
+        rejection = admission.admit(PREDICTION_QUEUE)
+        if rejection is not None:
+            return rejection
+        return _create_new_prediction(
+            self._new_prediction(identifier, directory))
+
+    def create_from_identifier(
+            self, identifier: str) -> typing.Optional[typing.Dict]:
+        directory = self._get_directory(identifier)
+        if directory is None:
+            return None
+        prediction = self._new_prediction(identifier, directory)
+        try:
+            os.makedirs(prediction.directory)
+        except OSError:
+            # Somebody else created the prediction in the meantime,
+            # as for a single prediction we wait for the initialization.
+            return self._wait_for_info_content(identifier)
+        return _initialize_new_prediction(prediction)
+
+    def _wait_for_info_content(self, identifier: str) -> typing.Optional[dict]:
+        deadline = time.monotonic() + CREATE_CONFLICT_WAIT
+        while True:
+            info = self.get_info_content(identifier)
+            if info is not None:
+                return info
+            if time.monotonic() > deadline:
+                return self._get_pending_info(identifier)
+            time.sleep(0.1)
+
+    def _admit_creation(self, count: int):
+        return admission.admit(PREDICTION_QUEUE, count)
+
+    @abc.abstractmethod
+    def _new_prediction(self, identifier: str, directory: str) -> Prediction:
+        """Return definition of a new prediction for given identifier."""
+        ...
+
+
+class DatabaseV3(OnDemandDatabase):
 
     def __init__(self):
         super().__init__()
@@ -53,14 +130,11 @@ class DatabaseV3(NestedReadOnlyDatabase):
         return super().create(files)
 
     def get_info(self, identifier: str):
-        identifier = identifier.upper()
-        directory = self._get_directory(identifier)
-        if directory is None:
-            return "", 404
-        if os.path.exists(directory):
-            return self._response_file(directory, "info.json")
+        return super().get_info(identifier.upper())
+
+    def _new_prediction(self, identifier: str, directory: str) -> Prediction:
         pdb_code, chains = _parser_identifier(identifier)
-        prediction = Prediction(
+        return Prediction(
             directory=directory,
             identifier=identifier,
             database=self.name(),
@@ -71,10 +145,9 @@ class DatabaseV3(NestedReadOnlyDatabase):
             chains=chains,
             metadata={},
         )
-        return _create_new_prediction(prediction)
 
 
-class DatabaseV3ConservationHmm(NestedReadOnlyDatabase):
+class DatabaseV3ConservationHmm(OnDemandDatabase):
 
     def __init__(self):
         super().__init__()
@@ -85,14 +158,9 @@ class DatabaseV3ConservationHmm(NestedReadOnlyDatabase):
     def name(self) -> str:
         return "v3-conservation-hmm"
 
-    def get_info(self, identifier: str):
-        directory = self._get_directory(identifier)
-        if directory is None:
-            return "", 404
-        if os.path.exists(directory):
-            return self._response_file(directory, "info.json")
+    def _new_prediction(self, identifier: str, directory: str) -> Prediction:
         pdb_code, chains = _parser_identifier(identifier)
-        prediction = Prediction(
+        return Prediction(
             directory=directory,
             identifier=identifier,
             database=self.name(),
@@ -103,7 +171,6 @@ class DatabaseV3ConservationHmm(NestedReadOnlyDatabase):
             conservation="hmm",
             metadata={},
         )
-        return _create_new_prediction(prediction)
 
 
 class DatabaseV3UserUpload(NestedReadOnlyDatabase):
@@ -121,30 +188,85 @@ class DatabaseV3UserUpload(NestedReadOnlyDatabase):
         if "configuration" not in files or "structure" not in files:
             return "", 400
         identifier = _create_identifier()
-        user_configuration = json.load(files["configuration"])
+        try:
+            user_configuration = json.load(files["configuration"])
+        except ValueError:
+            return "", 400
         structure_name = self._secure_filename(files["structure"].filename)
         prediction = _configuration_to_prediction(
-            self.root, identifier, self.name(),
+            self._get_directory(identifier), identifier, self.name(),
             user_configuration, structure_name)
         if not _is_prediction_valid(prediction):
             return "", 400
         # Create prediction directories and files.
-        os.makedirs(prediction.directory)
-        info = _prepare_prediction_directory(prediction)
         input_directory = os.path.join(prediction.directory, "input")
+        os.makedirs(input_directory)
         structure_path = os.path.join(input_directory, structure_name)
-        files["structure"].save(structure_path)
+        prediction.metadata["structureSha256"] = \
+            _save_uploaded_file(files["structure"], structure_path)
+        content_key = _content_key(prediction)
+        original = self._find_by_content(content_key)
+        if original is not None:
+            # Same input was already computed, there is no need to run
+            # the prediction again.
+            os.remove(structure_path)
+            info = _prepare_alias_directory(
+                prediction, original, self._get_directory(original["id"]))
+            return flask.make_response(flask.jsonify(info), 201)
+        info = _prepare_prediction_directory(prediction)
+        self._register_content(content_key, prediction)
         submit_directory_for_execution(prediction.directory)
+        metrics.on_submission(prediction.database, "prediction")
         return flask.make_response(flask.jsonify(info), 201)
 
     def _get_directory(self, identifier: str) -> typing.Optional[str]:
         """Return directory for task with given identifier."""
         if not re.match("[\-_,\w]+", identifier):
             return None
-        return os.path.join(self.root, identifier)
-
-
-class DatabaseV3AlphaFold(NestedReadOnlyDatabase):
+        return user_upload_directory(self.root, identifier)
+
+    def _content_index_file(self, content_key: str) -> str:
+        return os.path.join(
+            self.root, CONTENT_INDEX_DIRECTORY, content_key + ".json")
+
+    def _find_by_content(self, content_key: str) -> typing.Optional[dict]:
+        """Return info of a successful prediction with given content key."""
+        index_file = self._content_index_file(content_key)
+        try:
+            with open(index_file, encoding="utf-8") as stream:
+                identifier = json.load(stream)["identifier"]
+        except (OSError, ValueError, KeyError):
+            return None
+        info = self.get_info_content(identifier)
+        if info is None:
+            # The original prediction was removed, so we evict the entry.
+            _remove_file(index_file)
+            return None
+        if info["status"] != "successful":
+            return None
+        return info
+
+    def _register_content(self, content_key: str, prediction: Prediction):
+        """Register the prediction as a source for predictions with same
+        content, unless there already is a usable one."""
+        index_file = self._content_index_file(content_key)
+        try:
+            with open(index_file, encoding="utf-8") as stream:
+                identifier = json.load(stream)["identifier"]
+            info = self.get_info_content(identifier)
+            if info is not None and info["status"] != "failed":
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        _save_json_atomic(index_file, {"identifier": prediction.identifier})
+        # Allow removal of the index entry together with the prediction.
+        with open(os.path.join(prediction.directory, CONTENT_KEY_FILE), "w",
+                  encoding="utf-8") as stream:
+            stream.write(content_key)
+
+
+class DatabaseV3AlphaFold(OnDemandDatabase):
 
     def __init__(self):
         super().__init__()
@@ -159,13 +281,8 @@ class DatabaseV3AlphaFold(NestedReadOnlyDatabase):
         # Post is not supported.
         return super().create(files)
 
-    def get_info(self, identifier: str):
-        directory = self._get_directory(identifier)
-        if directory is None:
-            return "", 404
-        if os.path.exists(directory):
-            return self._response_file(directory, "info.json")
-        prediction = Prediction(
+    def _new_prediction(self, identifier: str, directory: str) -> Prediction:
+        return Prediction(
             directory=directory,
             identifier=identifier,
             database=self.name(),
@@ -177,10 +294,9 @@ class DatabaseV3AlphaFold(NestedReadOnlyDatabase):
                 "predictedStructure": True
             },
         )
-        return _create_new_prediction(prediction)
 
 
-class DatabaseV3AlphaFoldConservationHmm(NestedReadOnlyDatabase):
+class DatabaseV3AlphaFoldConservationHmm(OnDemandDatabase):
 
     def __init__(self):
         super().__init__()
@@ -195,13 +311,8 @@ class DatabaseV3AlphaFoldConservationHmm(NestedReadOnlyDatabase):
         # Post is not supported.
         return super().create(files)
 
-    def get_info(self, identifier: str):
-        directory = self._get_directory(identifier)
-        if directory is None:
-            return "", 404
-        if os.path.exists(directory):
-            return self._response_file(directory, "info.json")
-        prediction = Prediction(
+    def _new_prediction(self, identifier: str, directory: str) -> Prediction:
+        return Prediction(
             directory=directory,
             identifier=identifier,
             database=self.name(),
@@ -213,7 +324,6 @@ class DatabaseV3AlphaFoldConservationHmm(NestedReadOnlyDatabase):
                 "predictedStructure": True
             },
         )
-        return _create_new_prediction(prediction)
 
 
 def _parser_identifier(identifier: str):
@@ -230,9 +340,16 @@ def _create_new_prediction(prediction: Prediction, force=False):
     except OSError:
         if not force:
             return _prediction_can_not_be_created(prediction)
+    info = _initialize_new_prediction(prediction)
+    return flask.make_response(flask.jsonify(info), 201)
+
+
+def _initialize_new_prediction(prediction: Prediction):
+    """Prepare existing prediction directory and submit it for execution."""
     info = _prepare_prediction_directory(prediction)
     submit_directory_for_execution(prediction.directory)
-    return flask.make_response(flask.jsonify(info), 201)
+    metrics.on_submission(prediction.database, "prediction")
+    return info
 
 
 def _prediction_can_not_be_created(prediction: Prediction):
@@ -240,8 +357,10 @@ def _prediction_can_not_be_created(prediction: Prediction):
     # the task before us, so we wait some time, so they can finish the
     # initialization.
     time.sleep(1)
-    if os.path.isdir(prediction.directory) and \
-            os.path.isfile(_info_file(prediction)):
+    existing = os.path.isdir(prediction.directory) and \
+        os.path.isfile(_info_file(prediction))
+    metrics.on_create_conflict(prediction.database, "prediction", existing)
+    if existing:
         # Somebody else created the task.
         return flask.send_from_directory(
             prediction.directory, "info.json",
@@ -258,6 +377,7 @@ def _prepare_prediction_directory(prediction: Prediction):
     """Initialize content of a directory for given task."""
     info = _create_info_file(prediction)
     _save_json(_info_file(prediction), info)
+    prediction_index.on_status_change(prediction.directory, info)
     input_directory = os.path.join(prediction.directory, "input")
     os.makedirs(input_directory, exist_ok=True)
     _save_json(
@@ -291,13 +411,84 @@ def _save_json(path: str, content):
         json.dump(content, stream, ensure_ascii=True)
 
 
+def _save_json_atomic(path: str, content):
+    path_swp = path + ".swp"
+    _save_json(path_swp, content)
+    os.replace(path_swp, path)
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _content_key(prediction: Prediction) -> str:
+    """Return key identifying the prediction input."""
+    content = {
+        "structure": prediction.metadata["structureSha256"],
+        "extension": prediction.structure_file.rsplit(".", 1)[-1].lower(),
+        "p2rank_configuration": prediction.p2rank_configuration,
+        "conservation": prediction.conservation,
+        "structure_sealed": prediction.structure_sealed,
+        "chains": sorted(prediction.chains),
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _prepare_alias_directory(
+        prediction: Prediction, original: dict, original_directory: str):
+    """Initialize prediction that shares results with the original one."""
+    _prepare_prediction_directory(prediction)
+    for name in ["public", "log"]:
+        os.symlink(
+            os.path.relpath(
+                os.path.join(original_directory, name),
+                prediction.directory),
+            os.path.join(prediction.directory, name))
+    info = _create_info_file(prediction)
+    info["status"] = "successful"
+    info["metadata"] = {
+        **original.get("metadata", {}),
+        **prediction.metadata,
+        "predictionName": _structure_name(prediction.structure_file),
+        "aliasOf": original["id"],
+    }
+    _save_json_atomic(_info_file(prediction), info)
+    prediction_index.on_status_change(prediction.directory, info)
+    return info
+
+
+def _structure_name(structure_file: str) -> str:
+    """Same as the name assigned by the executor."""
+    if "." not in structure_file:
+        return structure_file
+    return structure_file[:structure_file.rindex(".")]
+
+
+def _save_uploaded_file(file: FileStorage, path: str) -> str:
+    """Save the file to given path and return SHA-256 of its content."""
+    if isinstance(file.stream, StagedUpload):
+        # The file is already on the disk, and we know the hash.
+        file.stream.move_to(path)
+        return file.stream.hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "wb") as stream:
+        for chunk in iter(lambda: file.stream.read(64 * 1024), b""):
+            digest.update(chunk)
+            stream.write(chunk)
+    return digest.hexdigest()
+
+
 def _create_identifier():
     today = datetime.datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
     return today + "-" + str(uuid.uuid4()).upper()
 
 
 def _configuration_to_prediction(
-        root_directory: str, identifier: str, database: str,
+        directory: str, identifier: str, database: str,
         user_configuration, structure_file: str):
     chains = list({
         chain.upper()
@@ -312,7 +503,7 @@ def _configuration_to_prediction(
     conservation = "conservation" in model
 
     return Prediction(
-        directory=os.path.join(root_directory, identifier),
+        directory=directory,
         identifier=identifier,
         database=database,
         chains=chains,
@@ -0,0 +1,219 @@
+#
+# Registry of docking tasks for one prediction.
+#
+# Directory layout:
+#   info.json               {"identifier": ..., "taskCount": ...}
+#   index/{sha256(hash)}    identifier of the task with given hash
+#   {taskId}/info.json      state of the task, written by the executor
+#   {taskId}/input.json     input of the task
+#   .lock                   lock used when adding tasks
+#
+# Older registries store states of all tasks in a 'tasks' list
+# in the info.json file. They are converted when a task is added,
+# the state in a task directory takes precedence over the list.
+#
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import typing
+
+INFO_FILE = "info.json"
+
+INDEX_DIRECTORY = "index"
+
+LOCK_FILE = ".lock"
+
+# Seconds to wait before another attempt to take the lock.
+LOCK_RETRY_INTERVAL = 0.01
+
+
+class AddedTask(typing.NamedTuple):
+    # State of the task.
+    info: dict
+    # True if the task was created, false if it already existed.
+    created: bool
+    # True if this is the first task of the prediction.
+    first: bool
+
+
+def find_task(directory: str, task_hash: str) -> typing.Optional[int]:
+    """Return identifier of a task with given hash."""
+    try:
+        with open(_index_file(directory, task_hash), encoding="utf-8") as stream:
+            return int(stream.read())
+    except (OSError, ValueError):
+        pass
+    # Registry may not be converted yet.
+    registry = _load_json_or_none(os.path.join(directory, INFO_FILE))
+    for task in (registry or {}).get("tasks", []):
+        if task["initialData"]["hash"] == task_hash:
+            return task["id"]
+    return None
+
+
+def load_tasks(directory: str) -> typing.Optional[dict]:
+    """Return content of the registry with list of all tasks,
+    return None if there is no registry."""
+    registry = _load_json_or_none(os.path.join(directory, INFO_FILE))
+    if registry is None:
+        return None
+    tasks = registry.get("tasks", [])
+    task_count = registry.get("taskCount", len(tasks))
+    result = []
+    for task_id in range(task_count):
+        task = _load_json_or_none(_task_info_file(directory, task_id))
+        if task is None and task_id < len(tasks):
+            task = tasks[task_id]
+        if task is not None:
+            result.append(task)
+    return {"identifier": registry["identifier"], "tasks": result}
+
+
+def add_task(
+        directory: str, identifier: str, data: dict) -> AddedTask:
+    """Add a task with given input, unless there is one with the same hash.
+    Input with 'ligands' list instead of 'smiles' defines a batch task.
+    New tasks are in queued state, it is up to the caller to submit them."""
+    os.makedirs(directory, exist_ok=True)
+    with _lock(directory):
+        registry_file = os.path.join(directory, INFO_FILE)
+        registry = _load_json_or_none(registry_file)
+        first = registry is None
+        if first:
+            registry = {"identifier": identifier, "taskCount": 0}
+        elif "tasks" in registry:
+            registry = _convert_registry(directory, registry)
+        task_id = find_task(directory, data["hash"])
+        if task_id is not None:
+            info = _load_json_or_none(_task_info_file(directory, task_id))
+            return AddedTask(info, False, False)
+        task_id = registry["taskCount"]
+        info = _create_info(task_id, data)
+        os.makedirs(os.path.join(directory, str(task_id)), exist_ok=True)
+        _save_json(os.path.join(directory, str(task_id), "input.json"), data)
+        _save_json(_task_info_file(directory, task_id), info)
+        # Index is written last, so others see only complete tasks.
+        _save_index(directory, data["hash"], task_id)
+        registry["taskCount"] = task_id + 1
+        _save_json(registry_file, registry)
+        return AddedTask(info, True, first)
+
+
+def _convert_registry(directory: str, registry: dict) -> dict:
+    """Move states of tasks from the registry to the task directories."""
+    tasks = registry["tasks"]
+    for task in tasks:
+        task_id = task["id"]
+        os.makedirs(os.path.join(directory, str(task_id)), exist_ok=True)
+        # The executor may be already writing the state.
+        _create_json(_task_info_file(directory, task_id), task)
+        _save_index(directory, task["initialData"]["hash"], task_id)
+    result = {"identifier": registry["identifier"], "taskCount": len(tasks)}
+    _save_json(os.path.join(directory, INFO_FILE), result)
+    return result
+
+
+@contextlib.contextmanager
+def _lock(directory: str):
+    with open(os.path.join(directory, LOCK_FILE), "a") as stream:
+        # Blocking flock would block the whole gevent worker, sleep is
+        # cooperative as gunicorn patches it.
+        while True:
+            try:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(LOCK_RETRY_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+
+
+def _index_file(directory: str, task_hash: str) -> str:
+    # The hash is provided by a client, so we can't use it as a file name.
+    name = hashlib.sha256(task_hash.encode("utf-8")).hexdigest()
+    return os.path.join(directory, INDEX_DIRECTORY, name)
+
+
+def _save_index(directory: str, task_hash: str, task_id: int):
+    os.makedirs(os.path.join(directory, INDEX_DIRECTORY), exist_ok=True)
+    path = _index_file(directory, task_hash)
+    with _temporary_file(path) as (stream, swap_path):
+        stream.write(str(task_id))
+    os.replace(swap_path, path)
+
+
+def _task_info_file(directory: str, task_id: int) -> str:
+    return os.path.join(directory, str(task_id), INFO_FILE)
+
+
+def _create_info(task_id: int, data: dict) -> dict:
+    now = datetime.datetime.today().strftime("%Y-%m-%dT%H:%M:%S")
+    result = {
+        "id": task_id,
+        "created": now,
+        "lastChange": now,
+        "status": "queued",
+        "initialData": {
+            "hash": data["hash"],
+            "pocket": data["pocket"],
+            "exhaustiveness": data["exhaustiveness"],
+        }
+    }
+    if "ligands" in data:
+        # Batch task, the executor reports progress for every ligand.
+        result["initialData"]["ligands"] = data["ligands"]
+        result["progress"] = {
+            "total": len(data["ligands"]),
+            "successful": 0,
+            "failed": 0,
+        }
+    else:
+        result["initialData"]["smiles"] = data["smiles"]
+    return result
+
+
+def _load_json_or_none(path: str) -> typing.Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_json(path: str, content: typing.Any):
+    """Replace the file, so readers never see partial content."""
+    with _temporary_file(path) as (stream, swap_path):
+        json.dump(content, stream, ensure_ascii=True)
+    os.replace(swap_path, path)
+
+
+def _create_json(path: str, content: typing.Any):
+    """Create the file only if it does not exist."""
+    with _temporary_file(path) as (stream, swap_path):
+        json.dump(content, stream, ensure_ascii=True)
+    try:
+        os.link(swap_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(swap_path)
+
+
+@contextlib.contextmanager
+def _temporary_file(path: str):
+    descriptor, swap_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path),
+        suffix=".swp")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            yield stream, swap_path
+    except BaseException:
+        os.remove(swap_path)
+        raise
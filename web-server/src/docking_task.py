@@ -1,26 +1,18 @@
 import os
 import flask
-import time
-import json
-import datetime
-import dataclasses
 import typing
 import re
 import werkzeug.utils
 
-from .commons import extensions
-from .celery_client import submit_directory_for_docking
+from .commons import extensions, user_upload_directory
+from .celery_client import submit_directory_for_docking, \
+    submit_directory_for_batch_docking, DOCKING_QUEUE
+from . import admission
+from . import docking_registry
+from . import metrics
 
-@dataclasses.dataclass
-class TaskInfo:
-    # Directory with given task.
-    directory: str
-    # User identifier of given task.
-    identifier: str
-    # Data for given task.
-    data: typing.Optional[dict] = None
-    # Task numeric identifier - decided by the server.
-    taskId: typing.Optional[int] = None
+# Maximum number of ligands in one batch task.
+MAX_BATCH_LIGANDS = 500
 
 class DockingTask:
     """
@@ -46,22 +38,11 @@ class DockingTask:
         if directory is None or not os.path.isdir(directory):
             return "", 404
     
-        try:
-            #we have to find the task id in the info file
-            with open(_info_file_str(directory), "r") as f:
-                found = False
-                fileData = json.load(f)
-                for task in fileData["tasks"]:
-                    if task["initialData"]["hash"] == data_hash:
-                        directory = os.path.join(directory, str(task["id"]))
-                        found = True
-                        break
-                if not found: #could not find the task in the info file
-                    return "", 404
-        
-        except OSError:
-            return "", 500
-        
+        task_id = docking_registry.find_task(directory, data_hash)
+        if task_id is None: #could not find the task in the registry
+            return "", 404
+        directory = os.path.join(directory, str(task_id))
+
         #if we successfully found the task directory, we can return the file, if it exists
 
         public_directory = os.path.join(directory, "public")
@@ -81,73 +62,84 @@ class DockingTask:
     def post_task(self, prediction_id: str, data: dict):
         """
         Posts a task with a given identifier and given data.
-        Updates/creates the info file, saves the input data and submits the task to Celery.
+        Adds the task to the registry of the prediction and submits it to Celery, unless it already exists.
         """
-        directory = self._get_directory(prediction_id)
-        if directory is None:
-            return "", 404
-
         if data is None: #user did not provide any data with the post request
             return "", 400
 
-        required_fields = ["hash", "pocket", "smiles", "exhaustiveness", "bounding_box"]
-        for field in required_fields:
-            if field not in data:
-                return f"Field {field} is missing.", 400
-        
+        error = _validate_input(data, ["smiles"])
+        if error is not None:
+            return error, 400
+
         # those boundaries are arbitrary - given in the tsx task file
         if len(data["smiles"]) > 300:
             return "The requested SMILES is too long.", 400
 
-        try:
-            exhaustiveness = int(data["exhaustiveness"])
-            # the exhaustiveness parameter must be a number between 1 and 64
-            if exhaustiveness < 1 or exhaustiveness > 64:
-                raise ValueError
-        except ValueError:
-            return "The exhaustiveness parameter must be a number between 1 and 64.", 400
+        return self._add_task(prediction_id, data, submit_directory_for_docking, 1)
+
+    def post_batch_task(self, prediction_id: str, data: dict):
+        """
+        Posts a task docking a list of ligands into one pocket.
+        All ligands are docked by one executor task, progress is reported in the task status.
+        """
+        if data is None: #user did not provide any data with the post request
+            return "", 400
 
-        taskinfo = TaskInfo(directory=directory, identifier=prediction_id, data=data)
+        error = _validate_input(data, ["ligands"])
+        if error is not None:
+            return error, 400
+
+        ligands = data["ligands"]
+        if not isinstance(ligands, list) or len(ligands) == 0 or \
+                not all(isinstance(smiles, str) for smiles in ligands):
+            return "Field ligands must be a non-empty list of SMILES.", 400
+        if len(ligands) > MAX_BATCH_LIGANDS:
+            return f"At most {MAX_BATCH_LIGANDS} ligands are allowed.", 400
+        if any(len(smiles) > 300 for smiles in ligands):
+            return "The requested SMILES is too long.", 400
 
-        if os.path.exists(directory) and os.path.exists(_info_file(taskinfo)):
-            #if the info file exists, we have to append the new info to the existing file
-            try:
-                with open(_info_file(taskinfo), "r+") as f:
-                    fileData = json.load(f)
-                    #we check if the task already exists
-                    for task in fileData["tasks"]:
-                        if task["initialData"]["hash"] == data["hash"]:
-                            return self._response_file(directory, "info.json")
+        # Every ligand is a docking, so the admission is for all of them.
+        return self._add_task(prediction_id, data, submit_directory_for_batch_docking, len(ligands))
 
-                    taskinfo.taskId = len(fileData["tasks"])
-                    fileData["tasks"].append(_create_info(taskinfo))
-                    f.seek(0)
-                    f.write(json.dumps(fileData))
-                
-                _save_input(taskinfo, data)
-                submit_directory_for_docking(taskinfo.directory, taskinfo.taskId)
-                return self._response_file(taskinfo.directory, "info.json")
-            except:
-                #something went wrong on our side
-                return "", 500
-        
-        #else we create a new info file
-        os.makedirs(directory, exist_ok=True)
-        taskinfo = TaskInfo(directory=directory, identifier=prediction_id, data=data, taskId=0)
-        _save_input(taskinfo, data)
-        return _create_docking_task_file(taskinfo)
+    def _add_task(self, prediction_id: str, data: dict, submit: typing.Callable[[str, int], None], cost: int):
+        """
+        Adds the task to the registry and submits it, unless it already exists.
+        """
+        directory = self._get_directory(prediction_id)
+        if directory is None:
+            return "", 404
+
+        #existing task is only returned, so it is not charged
+        if docking_registry.find_task(directory, data["hash"]) is None:
+            rejection = admission.admit(DOCKING_QUEUE, cost)
+            if rejection is not None:
+                return rejection
+
+        try:
+            added = docking_registry.add_task(directory, prediction_id, data)
+        except OSError:
+            #something went wrong on our side
+            return "", 500
+
+        if added.created:
+            submit(directory, added.info["id"])
+            metrics.on_submission(self.database_name, "docking")
+
+        if added.first:
+            return flask.make_response(flask.jsonify(added.info), 201)
+        return self.get_all_tasks(prediction_id)
     
     def get_all_tasks(self, prediction_id: str):
         """
-        Returns the info file for a given prediction.
+        Returns all tasks for a given prediction.
         """
         directory = self._get_directory(prediction_id)
         if directory is None:
             return "", 404
-        if os.path.exists(directory) and os.path.exists(_info_file_str(directory)):
-            return self._response_file(directory, "info.json")
-        
-        return "", 404
+        tasks = docking_registry.load_tasks(directory)
+        if tasks is None:
+            return "", 404
+        return flask.jsonify(tasks)
     
     def _get_directory(self, prediction_id: str) -> typing.Optional[str]:
         """
@@ -156,7 +148,7 @@ class DockingTask:
         if not re.match("[_,\w]+", prediction_id):
             return None
         if "user-upload" in self.database_name:
-            return os.path.join(self.root_path, prediction_id)
+            return user_upload_directory(self.root_path, prediction_id)
         directory = prediction_id[1:3]
         return os.path.join(self.root_path, directory, prediction_id)        
     
@@ -187,91 +179,27 @@ class DockingTask:
         ext = file_name[file_name.rindex("."):]
         return extensions.get(ext, "text/plain")
 
-def _save_input(taskinfo: TaskInfo, data: dict):
+def _validate_input(data: dict, ligand_fields: typing.List[str]) -> typing.Optional[str]:
     """
-    Save input data for given task.
+    Returns a message describing invalid input or None for valid input.
     """
-    os.makedirs(os.path.join(taskinfo.directory, str(taskinfo.taskId)), exist_ok=True)
-    with open(os.path.join(taskinfo.directory, str(taskinfo.taskId), "input.json"), "w+") as f:
-        f.write(json.dumps(data))
+    required_fields = ["hash", "pocket", *ligand_fields, "exhaustiveness", "bounding_box"]
+    for field in required_fields:
+        if field not in data:
+            return f"Field {field} is missing."
 
-def _info_file(taskinfo: TaskInfo) -> str:
-    """
-    Returns a path to info file for given task.
-    """
-    return os.path.join(taskinfo.directory, "info.json")
-
-def _info_file_str(directory: str) -> str:
-    """
-    Returns a path to info file for given task.
-    """
-    return os.path.join(directory, "info.json")
-
-def _prepare_prediction_directory(taskinfo: TaskInfo):
-    """
-    Initialize contents of a directory for given task.
-    This only happens once per prediction for one type of a task.
-    """
-    taskinfo.taskId = 0
-    info = _create_info(taskinfo)
-    json_info_skeleton = {"tasks": [info], "identifier": taskinfo.identifier}
-    _save_json(_info_file(taskinfo), json_info_skeleton)
-    return info
+    if not isinstance(data["hash"], str):
+        return "Field hash must be a string."
 
-def _save_json(path: str, content: any):
-    """
-    Saves content as a JSON file.
-    """
-    with open(path, "w", encoding="utf-8") as stream:
-        json.dump(content, stream, ensure_ascii=True)
-
-def _create_info(taskinfo: TaskInfo):
-    """
-    Returns a JSON object with info about one task.
-    """
-    now = datetime.datetime.today().strftime("%Y-%m-%dT%H:%M:%S")
-    return {
-        "id": taskinfo.taskId,
-        "created": now,
-        "lastChange": now,
-        "status": "queued",
-        "initialData": {
-            "hash": taskinfo.data["hash"],
-            "pocket": taskinfo.data["pocket"],
-            "smiles": taskinfo.data["smiles"],
-            "exhaustiveness": taskinfo.data["exhaustiveness"],
-        }
-    }
-
-def _create_docking_task_file(taskinfo: TaskInfo, force=False):
-    """
-    Creates a directory for a task and initializes it.
-    """
     try:
-        os.makedirs(taskinfo.directory, exist_ok=True)
-    except OSError:
-        if not force:
-            return _prediction_can_not_be_created(taskinfo)
-    info = _prepare_prediction_directory(taskinfo)
-    submit_directory_for_docking(taskinfo.directory, taskinfo.taskId)
-    return flask.make_response(flask.jsonify(info), 201)
+        exhaustiveness = int(data["exhaustiveness"])
+        # the exhaustiveness parameter must be a number between 1 and 64
+        if exhaustiveness < 1 or exhaustiveness > 64:
+            raise ValueError
+    except (TypeError, ValueError):
+        return "The exhaustiveness parameter must be a number between 1 and 64."
+
+    return None
 
-def _prediction_can_not_be_created(taskinfo: TaskInfo):
-    """
-    Handles a situation when a prediction can not be created.
-    """
-    # Not the best, but it is possible that someone else created
-    # the task before us, so we wait some time, so they can finish the
-    # initialization.
-    time.sleep(1)
-    if os.path.isdir(taskinfo.directory) and \
-            os.path.isfile(_info_file(taskinfo)):
-        # Somebody else created the task.
-        return flask.send_from_directory(
-            taskinfo.directory, "info.json",
-            mimetype="application/json")
-    else:
-        return "", 500
-    
 if __name__ == "__main__":
     pass
@@ -0,0 +1,113 @@
+#
+# Wait for changes of files in a directory.
+#
+# On Linux we use inotify, so a waiting request consumes no CPU. The file
+# descriptor is waited on using select, which is cooperative when running
+# under gevent workers. Elsewhere, we fall back to polling the file.
+#
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import typing
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE_SELF = 0x00000400
+
+_IN_NONBLOCK = os.O_NONBLOCK
+
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_POLL_INTERVAL = 1.0
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        library = ctypes.util.find_library("c")
+        if library is None:
+            _libc = False
+        else:
+            _libc = ctypes.CDLL(library, use_errno=True)
+            if not hasattr(_libc, "inotify_init1"):
+                _libc = False
+    return _libc
+
+
+def wait_for_file_change(
+        directory: str, file_name: str, timeout: float,
+        is_changed: typing.Callable[[bool], bool]) -> bool:
+    """Block until is_changed returns true or timeout expires.
+
+    The is_changed is evaluated at the start and every time given file in
+    the directory is written or replaced. The argument is true when
+    the call is a reaction to a notification about the file.
+    Return value of the last is_changed call is returned.
+    """
+    libc = _load_libc()
+    fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC) if libc else -1
+    if fd < 0:
+        return _poll_for_change(timeout, is_changed)
+    try:
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE \
+               | _IN_DELETE_SELF
+        watch = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+        if watch < 0:
+            return _poll_for_change(timeout, is_changed)
+        # We check only after we start watching, so we do not miss a change.
+        if is_changed(False):
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                return False
+            if not _read_events_for(fd, os.fsencode(file_name)):
+                continue
+            if is_changed(True):
+                return True
+    finally:
+        os.close(fd)
+
+
+def _read_events_for(fd: int, file_name: bytes) -> bool:
+    """Drain pending events, return true if any is related to the file."""
+    try:
+        buffer = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return False
+    result = False
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(buffer):
+        _, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+        offset += _EVENT_HEADER.size
+        name = buffer[offset:offset + name_length].rstrip(b"\0")
+        offset += name_length
+        if name == file_name or mask & _IN_DELETE_SELF:
+            result = True
+    return result
+
+
+def _poll_for_change(
+        timeout: float, is_changed: typing.Callable[[bool], bool]) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        if is_changed(False):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(_POLL_INTERVAL, remaining))
@@ -0,0 +1,128 @@
+#
+# Prometheus metrics of the web-server.
+#
+# Gunicorn runs multiple worker processes, so when PROMETHEUS_MULTIPROC_DIR
+# is set the metrics are stored in files in the directory and aggregated
+# on scrape, see gunicorn.conf.py . The variable must be set before
+# prometheus_client is imported.
+#
+import os
+import time
+import typing
+
+import flask
+import prometheus_client
+from prometheus_client import multiprocess
+
+REQUEST_LATENCY = prometheus_client.Histogram(
+    "prankweb_http_request_duration_seconds",
+    "Time to produce a response, without sending of streamed content.",
+    ["method", "route", "database"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
+
+REQUESTS = prometheus_client.Counter(
+    "prankweb_http_requests_total",
+    "Number of responses.",
+    ["method", "route", "database", "status"])
+
+RESPONSE_SIZE = prometheus_client.Histogram(
+    "prankweb_http_response_size_bytes",
+    "Size of responses with known content length.",
+    ["route"],
+    buckets=[2 ** exponent for exponent in range(8, 28, 2)])
+
+PUBLIC_FILES = prometheus_client.Counter(
+    "prankweb_public_file_responses_total",
+    "Responses with public files by served variant and status, "
+    "status 304 is a client cache hit.",
+    ["database", "variant", "status"])
+
+SUBMISSIONS = prometheus_client.Counter(
+    "prankweb_task_submissions_total",
+    "Number of tasks submitted for execution.",
+    ["database", "task"])
+
+ADMISSION_REJECTIONS = prometheus_client.Counter(
+    "prankweb_admission_rejections_total",
+    "Number of submissions rejected by admission control, reason is "
+    "'client' for client over its limit or 'queue' for long queue.",
+    ["queue", "reason"])
+
+CREATE_CONFLICTS = prometheus_client.Counter(
+    "prankweb_task_create_conflicts_total",
+    "Number of tasks whose directory could not be created, "
+    "result is 'existing' when other request created the task.",
+    ["database", "task", "result"])
+
+
+# Database names are part of URLs, only known names are used as labels,
+# so requests can not create new time series.
+_databases: typing.FrozenSet[str] = frozenset()
+
+UNKNOWN_DATABASE = "unknown"
+
+
+def init_app(app: flask.Flask, databases: typing.Iterable[str]):
+    """Register request instrumentation and the /metrics endpoint,
+    databases are names of known databases."""
+    global _databases
+    _databases = frozenset(databases)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", _metrics_response)
+
+
+def _before_request():
+    flask.g.metrics_start = time.perf_counter()
+
+
+def _after_request(response: flask.Response):
+    start = flask.g.pop("metrics_start", None)
+    if start is None:
+        return response
+    request = flask.request
+    route = request.endpoint or "unknown"
+    database = (request.view_args or {}).get("database_name", None)
+    database = "" if database is None else _database_label(database)
+    REQUEST_LATENCY.labels(request.method, route, database) \
+        .observe(time.perf_counter() - start)
+    REQUESTS.labels(
+        request.method, route, database, str(response.status_code)).inc()
+    # Content send by the gateway is not included.
+    if response.content_length is not None \
+            and "X-Accel-Redirect" not in response.headers:
+        RESPONSE_SIZE.labels(route).observe(response.content_length)
+    return response
+
+
+def _database_label(database: str) -> str:
+    return database if database in _databases else UNKNOWN_DATABASE
+
+
+def _metrics_response():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return flask.Response(
+        prometheus_client.generate_latest(registry),
+        mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def on_public_file(database: str, variant: str, status: int):
+    PUBLIC_FILES.labels(
+        _database_label(database), variant, str(status)).inc()
+
+
+def on_submission(database: str, task: str):
+    SUBMISSIONS.labels(_database_label(database), task).inc()
+
+
+def on_admission_rejected(queue: str, reason: str):
+    ADMISSION_REJECTIONS.labels(queue, reason).inc()
+
+
+def on_create_conflict(database: str, task: str, existing: bool):
+    result = "existing" if existing else "failed"
+    CREATE_CONFLICTS.labels(_database_label(database), task, result).inc()
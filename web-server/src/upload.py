@@ -0,0 +1,108 @@
+#
+# Handling of uploaded files.
+#
+# Files in multipart requests are streamed by werkzeug to a staging
+# directory next to the databases. The content is hashed and size-checked
+# as it is written, so oversized uploads are rejected before they fill the
+# disk and accepted uploads can be moved to place without copying.
+#
+import hashlib
+import os
+import shutil
+import tempfile
+import typing
+
+import flask
+import werkzeug.exceptions
+
+from .database import get_database_directory
+
+# Default limit for size of one uploaded file in bytes.
+DEFAULT_MAX_UPLOAD_SIZE = 8 * 1024 * 1024
+
+# Extra space for request content beside the uploaded files.
+REQUEST_OVERHEAD = 1024 * 1024
+
+
+def get_max_upload_size() -> int:
+    """Return maximum size of one uploaded file in bytes."""
+    return int(os.environ.get(
+        "PRANKWEB_MAX_UPLOAD_SIZE", DEFAULT_MAX_UPLOAD_SIZE))
+
+
+def get_max_request_size() -> int:
+    return get_max_upload_size() + REQUEST_OVERHEAD
+
+
+def get_staging_directory() -> str:
+    return os.path.join(get_database_directory(), "upload-staging")
+
+
+class StagedUpload:
+    """Uploaded file written to the staging directory.
+
+    The file is removed on close, unless it was moved using move_to.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        os.makedirs(directory, exist_ok=True)
+        self._stream = tempfile.NamedTemporaryFile(
+            dir=directory, prefix="upload-", delete=False)
+        self.path = self._stream.name
+        self.size = 0
+        self._max_size = max_size
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self._max_size:
+            # The parser drops the file, so we need to clean up now.
+            self.close()
+            raise werkzeug.exceptions.RequestEntityTooLarge(
+                f"Uploaded file is larger than {self._max_size} bytes.")
+        self._hash.update(data)
+        return self._stream.write(data)
+
+    def hexdigest(self) -> str:
+        """Return SHA-256 of the content."""
+        return self._hash.hexdigest()
+
+    def move_to(self, path: str) -> None:
+        self._stream.flush()
+        shutil.move(self.path, path)
+        self.path = None
+
+    def close(self) -> None:
+        self._stream.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+            self.path = None
+
+    def __getattr__(self, name: str):
+        # Reading, seeking, ... is delegated to the file.
+        return getattr(self._stream, name)
+
+
+class Request(flask.Request):
+    """Request class that streams uploaded files to the staging directory."""
+
+    _staged_uploads: typing.Optional[typing.List[StagedUpload]] = None
+
+    def _get_file_stream(
+            self,
+            total_content_length: typing.Optional[int],
+            content_type: typing.Optional[str],
+            filename: typing.Optional[str] = None,
+            content_length: typing.Optional[int] = None) -> typing.IO[bytes]:
+        result = StagedUpload(get_staging_directory(), get_max_upload_size())
+        if self._staged_uploads is None:
+            self._staged_uploads = []
+        # Keep track of the files, as the parser may fail before it
+        # returns them.
+        self._staged_uploads.append(result)
+        return result
+
+    def close(self) -> None:
+        super().close()
+        for upload in self._staged_uploads or []:
+            upload.close()
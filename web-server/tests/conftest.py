@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the web-server as the 'src' package.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,24 @@
+import flask
+
+from src.api_v2 import api_v2
+
+
+def _create_app() -> flask.Flask:
+    app = flask.Flask(__name__)
+    app.register_blueprint(api_v2, url_prefix="/api/v2")
+    return app
+
+
+def test_rejected_prediction_is_not_charged(tmp_path, monkeypatch):
+    monkeypatch.setenv(
+        "PRANKWEB_ADMISSION_DB", str(tmp_path / "admission.sqlite"))
+    monkeypatch.setenv("PRANKWEB_RATE_CAPACITY", "1")
+    client = _create_app().test_client()
+    # The database is read-only, so nothing is submitted.
+    for _ in range(3):
+        response = client.post("/api/v2/prediction/v2")
+        assert response.status_code == 403
+    # The invalid upload is rejected as well.
+    for _ in range(3):
+        response = client.post("/api/v2/prediction/v3-user-upload")
+        assert response.status_code == 400
@@ -0,0 +1,33 @@
+import flask
+
+from src import metrics
+
+
+def _create_app() -> flask.Flask:
+    app = flask.Flask(__name__)
+
+    @app.route("/prediction/<database_name>/<prediction_name>")
+    def get_prediction(database_name: str, prediction_name: str):
+        return "", 404
+
+    metrics.init_app(app, ["v3"])
+    return app
+
+
+def _database_labels() -> set:
+    return {
+        sample.labels["database"]
+        for metric in metrics.REQUESTS.collect()
+        for sample in metric.samples
+    }
+
+
+def test_unknown_database_adds_no_label_value():
+    client = _create_app().test_client()
+    client.get("/prediction/v3/2SRC")
+    labels = _database_labels()
+    client.get("/prediction/random-name/2SRC")
+    client.get("/prediction/other-random-name/2SRC")
+    assert "random-name" not in _database_labels()
+    assert _database_labels() - labels <= {metrics.UNKNOWN_DATABASE}
+    assert "v3" in _database_labels()